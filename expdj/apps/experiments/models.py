@@ -1,6 +1,9 @@
 import collections
+import datetime
 import operator
+import os
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
@@ -8,6 +11,7 @@ from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.db.models import DO_NOTHING, Q
 from django.db.models.signals import m2m_changed
+from django.utils import timezone
 from guardian.shortcuts import assign_perm, get_users_with_perms, remove_perm
 from jsonfield import JSONField
 from polymorphic.models import PolymorphicModel
@@ -380,3 +384,84 @@ def contributors_changed(sender, instance, action, **kwargs):
 
 
 m2m_changed.connect(contributors_changed, sender=Battery.contributors.through)
+
+
+class ExportJob(models.Model):
+    '''An export job writes the results of a battery, or some of its experiments,
+    to a file in MEDIA_ROOT in the background. Jobs are keyed by the battery,
+    experiments, format and the state of the results (count and last finish
+    time), so repeat exports of an unchanged battery reuse the same file.
+    '''
+    FORMAT_CHOICES = (
+        ("tsv", "tab separated"),
+        ("tsv.gz", "gzipped tab separated"),
+        ("parquet", "parquet"),
+    )
+    (PENDING, RUNNING, FINISHED, FAILED) = (
+        "PENDING", "RUNNING", "FINISHED", "FAILED")
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (FINISHED, "Finished"),
+        (FAILED, "Failed"),
+    )
+
+    key = models.CharField(
+        max_length=200,
+        unique=True,
+        help_text="hash of the battery, experiments, format and results state")
+    battery = models.ForeignKey(Battery, related_name="export_jobs")
+    experiment_tags = JSONField(
+        null=True,
+        blank=True,
+        help_text="exp_ids of the experiments exported, or all if empty")
+    export_format = models.CharField(
+        max_length=20,
+        choices=FORMAT_CHOICES,
+        default="tsv")
+    owner = models.ForeignKey(User, null=True, blank=True)
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=PENDING)
+    result_count = models.PositiveIntegerField(
+        default=0, help_text="The number of results to export")
+    results_written = models.PositiveIntegerField(
+        default=0, help_text="The number of results exported so far")
+    output_file = models.CharField(max_length=500, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    add_date = models.DateTimeField('date requested', auto_now_add=True)
+    modify_date = models.DateTimeField('date modified', auto_now=True)
+
+    def __unicode__(self):
+        return "<%s_%s>" % (self.battery, self.key)
+
+    def get_absolute_url(self):
+        return reverse('export_job_status', args=[str(self.id)])
+
+    def get_download_name(self):
+        if self.experiment_tags:
+            name = "expfactory_experiment_%s" % "_".join(self.experiment_tags)
+        else:
+            name = "expfactory_battery_%s" % self.battery_id
+        return "%s.%s" % (name, self.export_format)
+
+    def get_progress(self):
+        if self.status == self.FINISHED or self.result_count == 0:
+            return 100
+        return min(100, int(100.0 * self.results_written / self.result_count))
+
+    def is_stale(self):
+        '''a pending or running job that hasn't changed for EXPORT_JOB_LEASE
+        seconds was lost, eg its worker was killed'''
+        lease = datetime.timedelta(seconds=settings.EXPORT_JOB_LEASE)
+        return self.status in [self.PENDING, self.RUNNING] and \
+            self.modify_date < timezone.now() - lease
+
+    def is_ready(self):
+        return (self.status == self.FINISHED and
+                self.output_file is not None and
+                os.path.exists(self.output_file))
+
+    class Meta:
+        app_label = 'experiments'
@@ -10,12 +10,16 @@ from expdj.apps.experiments.views import (add_battery, add_experiment,
                                           change_experiment_order,
                                           delete_battery,
                                           delete_experiment_template,
-                                          dummy_battery, edit_battery,
-                                          edit_experiment,
+                                          download_export, dummy_battery,
+                                          edit_battery, edit_experiment,
                                           edit_experiment_template,
                                           enable_cookie_view,
                                           experiment_results_dashboard,
-                                          experiments_view,
+                                          experiments_view, export_battery,
+                                          export_battery_job,
+                                          export_experiment,
+                                          export_experiment_job,
+                                          export_job_status,
                                           generate_battery_user, intro_battery,
                                           modify_experiment, preview_battery,
                                           preview_experiment, remove_condition,
@@ -112,6 +116,20 @@ urlpatterns = [
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/delete$',
         delete_battery, name='delete_battery'),
 
+    # Export
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/export$',
+        export_battery, name='export_battery'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/export/job$',
+        export_battery_job, name='export_battery_job'),
+    url(r'^results/(?P<eid>\d+|[A-Z]{8})/export$',
+        export_experiment, name='export_experiment'),
+    url(r'^results/(?P<eid>\d+|[A-Z]{8})/export/job$',
+        export_experiment_job, name='export_experiment_job'),
+    url(r'^exports/(?P<jid>\d+)/$',
+        export_job_status, name='export_job_status'),
+    url(r'^exports/(?P<jid>\d+)/download$',
+        download_export, name='download_export'),
+
     # Deployment
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/preview$',
         preview_battery,
@@ -1,16 +1,25 @@
+import collections
+import csv
+import gzip
+import hashlib
 import json
 import os
 import random
 import re
 import shutil
 import tempfile
+import uuid
 from datetime import datetime
 
+import numpy
 import pandas
 from cognitiveatlas.api import get_concept, get_task
-from django.db.models import Min
-from expfactory.experiment import get_experiments
-from expfactory.survey import export_questions
+from django.core.cache import caches
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Count, Max, Min
+from expfactory.battery import get_experiment_run, get_load_static
+from expfactory.experiment import get_experiments, load_experiment
+from expfactory.survey import export_questions, generate_survey
 from expfactory.utils import copy_directory
 from expfactory.vm import custom_battery_download
 from git import Repo
@@ -23,7 +32,11 @@ from expdj.apps.experiments.models import (CognitiveAtlasConcept,
                                            ExperimentStringVariable,
                                            ExperimentTemplate,
                                            ExperimentVariable)
-from expdj.apps.turk.models import Result
+from expdj.apps.turk.models import (Assignment, BatteryVariableIndex, Result,
+                                    get_battery_variables, get_worker_progress,
+                                    rebuild_variable_index,
+                                    set_last_experiment)
+from expdj.apps.turk.utils import load_json
 from expdj.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT, EXP_REPO
 
 media_dir = os.path.join(BASE_DIR, MEDIA_ROOT)
@@ -107,6 +120,10 @@ def install_experiments(experiment_tags=None, repo_type="experiments"):
 
     for experiment in experiments:
         try:
+            # Previously rendered payloads are keyed by the old version
+            for installed in ExperimentTemplate.objects.filter(
+                    exp_id=experiment[0]["exp_id"]):
+                invalidate_experiment_payload(installed)
             performance_variable = None
             rejection_variable = None
             if "experiment_variables" in experiment[0]:
@@ -142,6 +159,7 @@ def install_experiments(experiment_tags=None, repo_type="experiments"):
             )
 
             new_experiment.save()
+            invalidate_experiment_payload(new_experiment)
             experiment_folder = "%s/%s" % (tmpdir, experiment[0]["exp_id"])
             output_folder = "%s/%s/%s" % (media_dir,
                                           repo_type, experiment[0]["exp_id"])
@@ -154,6 +172,88 @@ def install_experiments(experiment_tags=None, repo_type="experiments"):
     # shutil.rmtree(tmpdir)
     return errored_experiments
 
+# DEPLOYMENT PAYLOADS ####################################################
+
+# Deployments passed to deploy_battery, used to invalidate cached payloads
+DEPLOYMENTS = ["docker-local", "docker-mturk", "docker-preview"]
+
+# Survey forms are rendered once with this action, the result id is filled
+# in per request
+RESULT_ID_PLACEHOLDER = "{{result.id}}"
+
+
+def get_experiment_payload_key(template, deployment):
+    return "experiment-payload:%s:%s:%s" % (template.exp_id,
+                                           template.version,
+                                           deployment)
+
+
+def invalidate_experiment_payload(template):
+    '''invalidate_experiment_payload removes the cached payloads of an
+    experiment template for all deployments, called when it is (re)installed
+    :param template: the ExperimentTemplate object
+    '''
+    caches["experiments"].delete_many([get_experiment_payload_key(template, deployment)
+                       for deployment in DEPLOYMENTS])
+
+
+def render_experiment_payload(experiment_folder, experiment_type, exp_id,
+                              deployment):
+    '''render_experiment_payload reads an installed experiment from disk and
+    returns the static load block, run code and (for surveys) validation,
+    without any per result substitutions
+    '''
+    payload = {"load": get_load_static([experiment_folder], url_prefix="/"),
+               "run": "",
+               "validation": None}
+
+    if experiment_type in ["experiments"]:
+        payload["run"] = get_experiment_run(
+            [experiment_folder], deployment=deployment)[exp_id]
+    elif experiment_type in ["games"]:
+        experiment = load_experiment(experiment_folder)
+        payload["run"] = experiment[0]["deployment_variables"]["run"]
+    elif experiment_type in ["surveys"]:
+        experiment = load_experiment(experiment_folder)
+        runcode, validation = generate_survey(
+            experiment, experiment_folder,
+            form_action="/local/%s/" % RESULT_ID_PLACEHOLDER,
+            csrf_token=True)
+
+        # Field will be filled in by browser cookie, and hidden fields are
+        # added for data
+        csrf_field = '<input type="hidden" name="csrfmiddlewaretoken" value="hello">'
+        csrf_field = '%s\n<input type="hidden" name="djstatus" value="FINISHED">' % (
+            csrf_field)
+        csrf_field = '%s\n<input type="hidden" name="url" value="chickenfingers">' % (
+            csrf_field)
+        payload["run"] = runcode.replace("{% csrf_token %}", csrf_field)
+        payload["validation"] = validation
+
+    return payload
+
+
+def get_experiment_payload(template, experiment_type, deployment):
+    '''get_experiment_payload returns the rendered load block and run code for
+    an experiment, cached per (exp_id, version, deployment) so the files
+    under media/<experiment_type>/<exp_id> are only parsed once per install
+    :param template: the ExperimentTemplate object
+    :param experiment_type: experiments, games, or surveys
+    :param deployment: the deployment, one of DEPLOYMENTS
+    '''
+    cache = caches["experiments"]
+    key = get_experiment_payload_key(template, deployment)
+    payload = cache.get(key)
+    if payload is None:
+        experiment_folder = os.path.join(media_dir, experiment_type,
+                                         template.exp_id)
+        payload = render_experiment_payload(experiment_folder,
+                                            experiment_type,
+                                            template.exp_id,
+                                            deployment)
+        cache.set(key, payload)
+    return payload
+
 # EXPERIMENTS AND BATTERIES ##############################################
 
 
@@ -184,6 +284,54 @@ def make_experiment_lookup(tags, battery=None):
     return experiment_lookup
 
 
+class BatteryContext(object):
+    '''BatteryContext holds the experiments of a battery for the duration of
+    a request, so that finding and selecting the next experiment for a
+    worker takes a fixed number of queries
+    :param battery: the Battery object
+    '''
+
+    def __init__(self, battery):
+        self.battery = battery
+        self._experiments = None
+        self._progress = None
+
+    @property
+    def experiments(self):
+        if self._experiments is None:
+            self._experiments = list(
+                self.battery.experiments.select_related("template"))
+        return self._experiments
+
+    @property
+    def experiment_count(self):
+        return len(self.experiments)
+
+    def get_worker_experiments(self, worker, completed=False):
+        '''get_worker_experiments returns the battery experiments the worker
+        has (or has not) completed
+        :param completed: boolean, default False to return uncompleted experiments
+        '''
+        worker_templates = set(
+            self.get_worker_progress(worker).completed_experiments)
+        return [e for e in self.experiments
+                if (e.template_id in worker_templates) == completed]
+
+    def get_worker_progress(self, worker):
+        '''get_worker_progress returns the WorkerBatteryProgress of the worker'''
+        if self._progress is None or self._progress.worker_id != worker.id:
+            self._progress = get_worker_progress(worker, self.battery)
+        return self._progress
+
+    def set_last_experiment(self, worker, template):
+        '''set_last_experiment records the experiment served to the worker'''
+        set_last_experiment(self.get_worker_progress(worker), template)
+
+    def get_template_experiments(self, template):
+        '''get_template_experiments returns the battery experiments for a template'''
+        return [e for e in self.experiments if e.template_id == template.pk]
+
+
 def get_battery_results(battery, exp_id=None, clean=False):
     '''get_battery_results filters down to a battery, and optionally, an experiment of interest
     :param battery: expdj.models.Battery
@@ -222,90 +370,297 @@ def get_battery_results(battery, exp_id=None, clean=False):
     return df
 
 
-def make_results_df(battery, results):
+RESULTS_HEADER = ['worker_id',
+                  'worker_platform',
+                  'worker_browser',
+                  'battery_name',
+                  'battery_owner',
+                  'battery_owner_email',
+                  'experiment_completed',
+                  'experiment_include_bonus',
+                  'experiment_include_catch',
+                  'experiment_exp_id',
+                  'experiment_name',
+                  'experiment_reference',
+                  'experiment_cognitive_atlas_task_id']
+
+
+def flatten_trials(taskdata):
+    '''flatten_trials returns one dictionary per trial in a result taskdata,
+    merging the trial level keys with the keys of the nested "trialdata"
+    :param taskdata: the taskdata of a Result, a list of trials
+    '''
+    trials = []
+    for trial in taskdata:
+        row = dict((k, v) for k, v in trial.items() if k != "trialdata")
+        row.update(trial["trialdata"])
+        trials.append(row)
+    return trials
+
+
+def get_result_columns(variables):
+    '''get_result_columns returns the export column names for trial variables,
+    all are prefixed with result_ and uniqueid is renamed to result_id
+    :param variables: a list of trial variable names
+    '''
+    return ["result_id" if x == "uniqueid" else "result_%s" % x
+            for x in variables]
 
-    variables = get_unique_variables(results)
-    tags = get_unique_experiments(results)
-    lookup = make_experiment_lookup(tags, battery)
-    header = ['worker_id',
-              'worker_platform',
-              'worker_browser',
-              'battery_name',
-              'battery_owner',
-              'battery_owner_email',
-              'experiment_completed',
-              'experiment_include_bonus',
-              'experiment_include_catch',
-              'experiment_exp_id',
-              'experiment_name',
-              'experiment_reference',
-              'experiment_cognitive_atlas_task_id']
-    column_names = header + variables
-    df = pandas.DataFrame(columns=column_names)
-    for result in results:
+
+def get_results_variables(results):
+    '''get_results_variables returns the sorted union of trial variable names
+    across completed results. Querysets are read one taskdata at a time with
+    a server side cursor, so memory does not grow with the number of results.
+    :param results: a queryset or list of turk.models.Result objects
+    '''
+    if hasattr(results, "iterator"):
+        taskdatas = results.filter(completed=True).values_list(
+            "data__taskdata", flat=True).iterator()
+        taskdatas = (load_json(taskdata) for taskdata in taskdatas)
+    else:
+        taskdatas = (r.taskdata for r in results if r.completed)
+
+    variables = set()
+    for taskdata in taskdatas:
         try:
-            if result.completed:
-                worker_id = result.worker_id
-                for t in range(len(result.taskdata)):
-                    row_id = "%s_%s_%s" % (
-                        result.experiment.exp_id, worker_id, t)
-                    trial = result.taskdata[t]
-
-                    # Add worker and battery information
-                    df.loc[row_id,
-                           ["worker_id",
-                            "worker_platform",
-                            "worker_browser",
-                            "battery_name",
-                            "battery_owner",
-                            "battery_owner_email"]] = [worker_id,
-                                                       result.platform,
-                                                       result.browser,
-                                                       battery.name,
-                                                       battery.owner.username,
-                                                       battery.owner.email]
-
-                    # Look up the experiment
-                    exp = lookup[result.experiment.exp_id]
-                    df.loc[row_id,
-                           ["experiment_completed",
-                            "experiment_include_bonus",
-                            "experiment_include_catch",
-                            "experiment_exp_id",
-                            "experiment_name",
-                            "experiment_reference",
-                            "experiment_cognitive_atlas_task_id"]] = [result.completed,
-                                                                      exp["include_bonus"],
-                                                                      exp["include_catch"],
-                                                                      exp["experiment"].exp_id,
-                                                                      exp["experiment"].name,
-                                                                      exp["experiment"].reference,
-                                                                      exp["experiment"].cognitive_atlas_task_id]
-
-                    # Parse data
-                    for key in trial.keys():
-                        if key != "trialdata":
-                            df.loc[row_id, key] = trial[key]
-                    for key in trial["trialdata"].keys():
-                        df.loc[row_id, key] = trial["trialdata"][key]
+            for trial in flatten_trials(taskdata):
+                variables.update(trial.keys())
         except BaseException:
             pass
+    return sorted(variables)
+
 
-    # Change all names that don't start with experiment or worker or
-    # experiment to be result
-    result_variables = [x for x in column_names if x not in header]
-    for result_variable in result_variables:
-        df = df.rename(
-            columns={
-                result_variable: "result_%s" %
-                result_variable})
-        final_names = ["result_%s" % x for x in variables]
+def iter_results_trials(battery, results, callback=None):
+    '''iter_results_trials yields a (row_id, values, trial) tuple for every trial
+    of the completed results, where values follow RESULTS_HEADER and trial is
+    the flattened trial dictionary. Results that can't be parsed are skipped.
+    :param battery: expdj.models.Battery
+    :param results: a queryset or list of turk.models.Result objects
+    :param callback: called with the number of results read after each one
+    '''
+    if hasattr(results, "iterator"):
+        results = results.filter(completed=True).select_related(
+            "data").iterator()
+
+    battery_values = [battery.name,
+                      battery.owner.username,
+                      battery.owner.email]
+    lookup = dict()
+
+    for count, result in enumerate(results):
+        if callback is not None and count > 0:
+            callback(count)
+        if not result.completed:
+            continue
+        exp_id = result.experiment_id
+        if exp_id not in lookup:
+            lookup.update(make_experiment_lookup([exp_id], battery))
+        exp = lookup.get(exp_id)
+        try:
+            trials = flatten_trials(result.taskdata)
+        except BaseException:
+            trials = None
+        if exp is None or trials is None:
+            continue
+
+        # Worker, battery and experiment information is shared by all trials
+        template = exp["experiment"]
+        values = [result.worker_id, result.platform, result.browser]
+        values += battery_values
+        values += [result.completed,
+                   exp["include_bonus"],
+                   exp["include_catch"],
+                   template.exp_id,
+                   template.name,
+                   template.reference,
+                   template.cognitive_atlas_task_id]
+        for t, trial in enumerate(trials):
+            yield "%s_%s_%s" % (exp_id, result.worker_id, t), values, trial
+
+
+def iter_results_rows(battery, results, variables=None, callback=None):
+    '''iter_results_rows yields the export header, and then one list of values
+    per trial, for writing results to a tab separated file as they are read.
+    Missing values are empty strings, and unicode is encoded as utf-8.
+    :param battery: expdj.models.Battery
+    :param results: a queryset or list of turk.models.Result objects
+    :param variables: the trial variables to export, default is all of them
+    :param callback: passed on to iter_results_trials, to report progress
+    '''
+    if variables is None:
+        variables = get_results_variables(results)
+    yield RESULTS_HEADER + get_result_columns(variables)
 
-    # rename uniqueid to result id
-    if "result_uniqueid" in df.columns:
-        df = df.rename(columns={'result_uniqueid': 'result_id'})
+    for _, values, trial in iter_results_trials(battery, results, callback):
+        row = values + [trial.get(x, "") for x in variables]
+        yield [x.encode("utf-8") if isinstance(x, unicode) else
+               "" if x is None else x for x in row]
+
+
+def make_results_df(battery, results):
+    '''make_results_df flattens completed results into a data frame with one
+    row per trial. Values are collected into column lists in a single pass
+    over the results, and the data frame is constructed once at the end.
+    :param battery: expdj.models.Battery
+    :param results: a queryset or list of turk.models.Result objects
+    '''
+    header = [[] for _ in RESULTS_HEADER]
+    variables = dict()
+    index = []
+
+    for row_id, values, trial in iter_results_trials(battery, results):
+        row = len(index)
+        index.append(row_id)
+        for column, value in zip(header, values):
+            column.append(value)
+
+        # Variables are padded with missing values up to the current row
+        for key, value in trial.items():
+            column = variables.get(key)
+            if column is None:
+                column = variables[key] = []
+            if len(column) < row:
+                column.extend([numpy.nan] * (row - len(column)))
+            column.append(value)
+
+    # All names that don't start with worker, battery or experiment are result
+    names = sorted(variables.keys())
+    data = collections.OrderedDict(zip(RESULTS_HEADER, header))
+    for name, column_name in zip(names, get_result_columns(names)):
+        column = variables[name]
+        column.extend([numpy.nan] * (len(index) - len(column)))
+        data[column_name] = column
+
+    return pandas.DataFrame(data, index=index, columns=list(data.keys()))
 
-    return df
+
+# EXPORTS ################################################################
+
+export_dir = os.path.join(media_dir, "exports")
+
+
+def get_export_results(battery, experiment_tags=None):
+    '''get_export_results returns the completed results of a battery to export
+    :param battery: expdj.models.Battery
+    :param experiment_tags: only include these experiment exp_ids [optional]
+    '''
+    results = Result.objects.filter(battery=battery, completed=True)
+    if experiment_tags is not None:
+        if isinstance(experiment_tags, basestring):
+            experiment_tags = [experiment_tags]
+        results = results.filter(experiment__exp_id__in=experiment_tags)
+    return results
+
+
+def get_export_variables(battery, experiment_tags=None):
+    '''get_export_variables returns the trial variables to export for a battery
+    from the variable index. Experiments with completed results that are not
+    indexed yet (eg, before the index_battery_variables command is run) are
+    indexed first, so the header always covers all results.
+    :param battery: expdj.models.Battery
+    :param experiment_tags: only include these experiment exp_ids [optional]
+    '''
+    results = get_export_results(battery, experiment_tags)
+    completed = set(results.order_by().values_list(
+        "experiment_id", flat=True).distinct())
+    indexed = set(BatteryVariableIndex.objects.filter(
+        battery=battery,
+        experiment_id__in=completed).values_list("experiment_id", flat=True))
+    for exp_id in completed - indexed:
+        rebuild_variable_index(battery, exp_id)
+    return get_battery_variables(battery, sorted(completed))
+
+
+def get_export_key(battery, experiment_tags=None, export_format="tsv"):
+    '''get_export_key returns a key for an export of battery results, and the
+    number of results to export. The key includes the result count and the last
+    finish time, so it only changes when results are completed or removed.
+    :param battery: expdj.models.Battery
+    :param experiment_tags: only include these experiment exp_ids [optional]
+    :param export_format: one of ExportJob.FORMAT_CHOICES
+    '''
+    results = get_export_results(battery, experiment_tags)
+    state = results.aggregate(count=Count("id"), last=Max("finishtime"))
+    last = "" if state["last"] is None else state["last"].isoformat()
+    tags = ",".join(sorted(experiment_tags or []))
+    key = "%s|%s|%s|%s|%s" % (battery.id, tags, export_format,
+                              state["count"], last)
+    return hashlib.md5(key.encode("utf-8")).hexdigest(), state["count"]
+
+
+def get_export_file(key, export_format="tsv"):
+    '''get_export_file returns the path of the export file for a key'''
+    return os.path.join(export_dir, "%s.%s" % (key, export_format))
+
+
+def write_results_parquet(rows, filename, chunk_size=10000):
+    '''write_results_parquet writes rows from iter_results_rows to a parquet
+    file, in row groups of chunk_size. All columns are stored as strings, as
+    trial variables don't have a consistent type across experiments.
+    Requires pyarrow, which is not installed by default.
+    '''
+    import pyarrow
+    import pyarrow.parquet
+
+    header = next(rows)
+    schema = pyarrow.schema([(name, pyarrow.string()) for name in header])
+    writer = pyarrow.parquet.ParquetWriter(filename, schema)
+
+    def write_chunk(chunk):
+        columns = [pyarrow.array(list(column), type=pyarrow.string())
+                   for column in zip(*chunk)]
+        writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append([x.decode("utf-8") if isinstance(x, str) else
+                          unicode(x) for x in row])
+            if len(chunk) == chunk_size:
+                write_chunk(chunk)
+                chunk = []
+        if chunk:
+            write_chunk(chunk)
+    finally:
+        writer.close()
+
+
+def write_results_export(battery, filename, experiment_tags=None,
+                         export_format="tsv", callback=None):
+    '''write_results_export writes results to a tsv, tsv.gz or parquet file.
+    The file is written to a temporary name and renamed when complete, so a
+    partial export is never served.
+    :param battery: expdj.models.Battery
+    :param filename: the full path of the file to write
+    :param experiment_tags: only include these experiment exp_ids [optional]
+    :param export_format: one of ExportJob.FORMAT_CHOICES
+    :param callback: called with the number of results read, for progress
+    '''
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    results = get_export_results(battery, experiment_tags)
+    variables = get_export_variables(battery, experiment_tags)
+    rows = iter_results_rows(battery, results, variables, callback)
+    # a stale job may be run again while its first run is still writing
+    tmpfile = "%s.%s.tmp" % (filename, uuid.uuid4().hex)
+
+    try:
+        if export_format == "parquet":
+            write_results_parquet(rows, tmpfile)
+        else:
+            if export_format == "tsv.gz":
+                handle = gzip.open(tmpfile, "wb")
+            else:
+                handle = open(tmpfile, "wb")
+            with handle:
+                writer = csv.writer(handle, delimiter="\t")
+                for row in rows:
+                    writer.writerow(row)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    os.rename(tmpfile, filename)
 
 
 # COGNITIVE ATLAS FUNCTIONS ##############################################
@@ -354,6 +709,66 @@ def update_credits(experiment, cid):
 
     experiment.save()
 
+# BATTERY DASHBOARD ######################################################
+
+# Assignment lists of the battery page, and the status of their assignments
+ASSIGNMENT_BUCKETS = collections.OrderedDict([("accepted", Assignment.APPROVED),
+                                              ("submit", Assignment.SUBMITTED),
+                                              ("rejected", Assignment.REJECTED),
+                                              ("none", None)])
+ASSIGNMENTS_PER_PAGE = 50
+
+
+def get_assignment_counts(battery):
+    '''get_assignment_counts returns the number of assignments of a battery
+    in each bucket, and the "total", with one grouped query
+    :param battery: the battery object
+    '''
+    buckets = dict((status, bucket)
+                   for bucket, status in ASSIGNMENT_BUCKETS.items())
+    counts = dict((bucket, 0) for bucket in ASSIGNMENT_BUCKETS)
+    counts["total"] = 0
+    rows = Assignment.objects.filter(hit__battery=battery).order_by().values(
+        "status").annotate(count=Count("id"))
+    for row in rows:
+        if row["status"] in buckets:
+            counts[buckets[row["status"]]] += row["count"]
+        counts["total"] += row["count"]
+    return counts
+
+
+def get_battery_assignments(battery, page=None, per_page=ASSIGNMENTS_PER_PAGE,
+                            counts=None):
+    '''get_battery_assignments returns one page of the assignments of a
+    battery (newest first) with their worker and HIT, fetched in one query
+    and bucketed by status, and the page
+    :param battery: the battery object
+    :param page: the page number, invalid numbers give the first (or last) page
+    :param counts: the result of get_assignment_counts, to not count again
+    '''
+    if counts is None:
+        counts = get_assignment_counts(battery)
+    assignments = Assignment.objects.filter(hit__battery=battery).select_related(
+        "worker", "hit").order_by("-id")
+    paginator = Paginator(assignments, per_page)
+    # the total is known from the grouped counts
+    paginator.count = counts["total"]
+    try:
+        page = paginator.page(page)
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+
+    buckets = dict((status, bucket)
+                   for bucket, status in ASSIGNMENT_BUCKETS.items())
+    assignments = collections.OrderedDict(
+        (bucket, []) for bucket in ASSIGNMENT_BUCKETS)
+    for assignment in page.object_list:
+        if assignment.status in buckets:
+            assignments[buckets[assignment.status]].append(assignment)
+    return assignments, page
+
 # EXPERIMENT SELECTION ###################################################
 
 
@@ -372,10 +787,12 @@ def select_ordered(experiments, selection_number=1):
     '''select_ordered will return a list of the next "selection_number"
     of experiments. Lower numbers are returned first, and if multiple numbers
     are specified for orders, these will be selected from randomly.
-    :param experiments: the list of Experiment objects to select from
+    :param experiments: the list (or queryset) of Experiment objects to select from
     :param selection_number: the number of experiments to choose (default 1)
     '''
-    next_value = experiments.aggregate(Min('order'))["order__min"]
+    if not experiments:
+        return []
+    next_value = min(e.order for e in experiments)
     experiment_choices = [e for e in experiments if e.order == next_value]
     return select_random_n(experiment_choices, selection_number)
 
@@ -10,19 +10,21 @@ import uuid
 import numpy
 import pandas
 from django.contrib.auth.decorators import login_required
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.forms.models import model_to_dict
-from django.http import HttpResponse, JsonResponse
+from django.http import (HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
 from django.http.response import (Http404, HttpResponseForbidden,
                                   HttpResponseRedirect)
 from django.shortcuts import (get_object_or_404, redirect, render,
                               render_to_response)
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_protect, ensure_csrf_cookie
-from expfactory.battery import get_experiment_run, get_load_static
-from expfactory.experiment import load_experiment
-from expfactory.survey import generate_survey
 from expfactory.views import embed_experiment
+from sendfile import sendfile
 
 import expdj.settings as settings
 from expdj.apps.experiments.forms import (BatteryForm, BlacklistForm,
@@ -30,22 +32,32 @@ from expdj.apps.experiments.forms import (BatteryForm, BlacklistForm,
                                           ExperimentTemplateForm)
 from expdj.apps.experiments.models import (Battery, CreditCondition,
                                            Experiment, ExperimentTemplate,
-                                           ExperimentVariable)
-from expdj.apps.experiments.utils import (complete_survey_result,
+                                           ExperimentVariable, ExportJob)
+from expdj.apps.experiments.utils import (RESULT_ID_PLACEHOLDER,
+                                          BatteryContext,
+                                          complete_survey_result,
+                                          get_assignment_counts,
+                                          get_battery_assignments,
                                           get_battery_results,
+                                          get_experiment_payload,
                                           get_experiment_selection,
                                           get_experiment_type,
-                                          install_experiments, make_results_df,
-                                          remove_keys, select_experiments,
-                                          update_credits)
+                                          get_export_file, get_export_key,
+                                          get_export_results,
+                                          get_export_variables,
+                                          install_experiments,
+                                          iter_results_rows, remove_keys,
+                                          select_experiments, update_credits)
 from expdj.apps.main.views import google_auth_view
-from expdj.apps.turk.models import (HIT, Assignment, Blacklist, Bonus, Result,
-                                    get_worker)
-from expdj.apps.turk.tasks import (assign_experiment_credit,
-                                   check_battery_dependencies, check_blacklist,
-                                   experiment_reward, update_assignments)
-from expdj.apps.turk.utils import get_worker_experiments
-from expdj.apps.users.models import User
+from expdj.apps.turk.models import (HIT, Blacklist, Bonus, Result,
+                                    get_battery_experiments, get_worker,
+                                    rebuild_battery_progress,
+                                    update_worker_progress,
+                                    update_variable_index)
+from expdj.apps.turk.tasks import (check_battery_dependencies, export_results,
+                                   process_completed_result,
+                                   schedule_assignments_refresh)
+from expdj.apps.users.models import User, get_user_role_key
 from expdj.settings import BASE_DIR, DOMAIN_NAME, MEDIA_ROOT, STATIC_ROOT
 
 media_dir = os.path.join(BASE_DIR, MEDIA_ROOT)
@@ -53,6 +65,23 @@ media_dir = os.path.join(BASE_DIR, MEDIA_ROOT)
 ### AUTHENTICATION ####################################################
 
 
+def get_user_role(user):
+    '''get_user_role returns the role of the expfactory User for a django
+    user (or an empty string), cached in the permissions cache
+    :param user: the django user, from request.user
+    '''
+    if user.is_anonymous():
+        return ""
+    cache = caches["permissions"]
+    key = get_user_role_key(user.id)
+    role = cache.get(key)
+    if role is None:
+        role = User.objects.filter(
+            user=user).values_list("role", flat=True).first() or ""
+        cache.set(key, role)
+    return role
+
+
 def check_experiment_edit_permission(request):
     if request.user.is_superuser:
         return True
@@ -62,26 +91,14 @@ def check_experiment_edit_permission(request):
 def check_mturk_access(request):
     if request.user.is_superuser:
         return True
-
-    user_roles = User.objects.filter(user=request.user)
-    if len(user_roles) == 0:
-        return False
-    elif user_roles[0].role == "MTURK":
-        return True
-    return False
+    return get_user_role(request.user) == "MTURK"
 
 
 def check_battery_create_permission(request):
     if not request.user.is_anonymous():
         if request.user.is_superuser:
             return True
-
-    user_roles = User.objects.filter(user=request.user)
-    if len(user_roles) == 0:
-        return False
-    elif user_roles[0].role in ["MTURK", "LOCAL"]:
-        return True
-    return False
+    return get_user_role(request.user) in ["MTURK", "LOCAL"]
 
 
 def check_battery_delete_permission(request, battery):
@@ -200,12 +217,11 @@ def view_experiment(request, eid, bid=None):
 def view_battery(request, bid):
     battery = get_battery(bid, request)
 
-    # Get associated HITS, update all
+    # Get associated HITS, their assignments are synced in the background
+    # unless they were recently
     hits = HIT.objects.filter(battery=battery)
-
-    # Use task to update assignments
     for hit in hits:
-        update_assignments.apply_async([hit.id])
+        schedule_assignments_refresh(hit)
 
     # Generate anonymous link
     anon_link = "%s/batteries/%s/%s/anon" % (
@@ -220,20 +236,10 @@ def view_battery(request, bid):
     delete_permission = check_battery_edit_permission(request, battery)
     mturk_permission = check_mturk_access(request)
 
-    # Render assignment details
-    assignments = dict()
-    assignments["accepted"] = [
-        a for a in Assignment.objects.filter(
-            hit__battery=battery) if a.status == "A"]
-    assignments["none"] = [
-        a for a in Assignment.objects.filter(
-            hit__battery=battery) if a.status is None]
-    assignments["submit"] = [
-        a for a in Assignment.objects.filter(
-            hit__battery=battery) if a.status == "S"]
-    assignments["rejected"] = [
-        a for a in Assignment.objects.filter(
-            hit__battery=battery) if a.status == "R"]
+    # Render assignment counts, and one page of assignment details
+    assignment_counts = get_assignment_counts(battery)
+    assignments, assignment_page = get_battery_assignments(
+        battery, page=request.GET.get("page"), counts=assignment_counts)
 
     context = {'battery': battery,
                'edit_permission': edit_permission,
@@ -242,7 +248,9 @@ def view_battery(request, bid):
                'hits': hits,
                'anon_link': anon_link,
                'gmail_link': gmail_link,
-               'assignments': assignments}
+               'assignments': assignments,
+               'assignment_counts': assignment_counts,
+               'assignment_page': assignment_page}
 
     return render(request, 'experiments/battery_details.html', context)
 
@@ -460,23 +468,23 @@ def serve_battery(request, bid, userid=None):
     deployment = "docker-local"
 
     # Does the worker have experiments remaining?
-    uncompleted_experiments = get_worker_experiments(worker, battery)
+    battery_context = BatteryContext(battery)
+    uncompleted_experiments = battery_context.get_worker_experiments(worker)
     experiments_left = len(uncompleted_experiments)
     if experiments_left == 0:
         # Thank you for your participation - no more experiments!
         return render_to_response("turk/worker_sorry.html")
 
     task_list = select_experiments(battery, uncompleted_experiments)
-    experimentTemplate = ExperimentTemplate.objects.filter(
-        exp_id=task_list[0].template.exp_id)[0]
+    experimentTemplate = task_list[0].template
     experiment_type = get_experiment_type(experimentTemplate)
-    task_list = battery.experiments.filter(template=experimentTemplate)
+    task_list = battery_context.get_template_experiments(experimentTemplate)
+    battery_context.set_last_experiment(worker, experimentTemplate)
 
     # Generate a new results object for the worker, assignment, experiment
     result, _ = Result.objects.update_or_create(
         worker=worker, experiment=experimentTemplate, battery=battery, defaults={
             "browser": browser, "platform": platform})
-    result.save()
 
     context = {"worker_id": worker.id,
                "uniqueId": result.id}
@@ -498,13 +506,14 @@ def serve_battery(request, bid, userid=None):
         template=template,
         next_page=next_page,
         result=result,
-        experiments_left=experiments_left - 1
+        experiments_left=experiments_left - 1,
+        battery_context=battery_context
     )
 
 
 def deploy_battery(deployment, battery, experiment_type, context, task_list,
                    template, result, next_page=None, last_experiment=False,
-                   experiments_left=None):
+                   experiments_left=None, battery_context=None):
     '''deploy_battery is a general function for returning the final view to deploy a battery, either local or MTurk
     :param deployment: either "docker-mturk" or "docker-local"
     :param battery: models.Battery object
@@ -516,6 +525,7 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
     :param result: the result object, turk.models.Result
     :param last_experiment: boolean if true will redirect the user to a page to submit the result (for surveys)
     :param experiments_left: integer indicating how many experiments are left in battery.
+    :param battery_context: the BatteryContext of the request, if there is one
     '''
     if next_page is None:
         next_page = "javascript:window.location.reload();"
@@ -524,34 +534,29 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
     # Check the user blacklist status
     try:
         blacklist = Blacklist.objects.get(
-            worker=result.worker, battery=battery)
+            worker_id=result.worker_id, battery=battery)
         if blacklist.active:
             return render_to_response("experiments/blacklist.html")
     except BaseException:
         pass
 
-    # Get experiment folders
-    experiment_folders = [
-        os.path.join(
-            media_dir,
-            experiment_type,
-            x.template.exp_id) for x in task_list]
-    context["experiment_load"] = get_load_static(
-        experiment_folders, url_prefix="/")
-
-    # Get code to run the experiment (not in external file)
-    runcode = ""
+    # Rendered load block and run code are cached per experiment version,
+    # only the per result substitutions are done here
+    experiment = task_list[0].template
+    payload = get_experiment_payload(experiment, experiment_type, deployment)
+    context["experiment_load"] = payload["load"]
+    runcode = payload["run"]
 
     # Experiments templates
     if experiment_type in ["experiments"]:
-        runcode = get_experiment_run(
-            experiment_folders, deployment=deployment)[
-            task_list[0].template.exp_id]
         if result is not None:
             runcode = runcode.replace("{{result.id}}", str(result.id))
         runcode = runcode.replace("{{next_page}}", next_page)
         if experiments_left is not None:
-            total_experiments = battery.experiments.count()
+            if battery_context is not None:
+                total_experiments = battery_context.experiment_count
+            else:
+                total_experiments = battery.experiments.count()
             expleft_msg = "</p><p>Experiments left in battery {0:d} out of {1:d}</p>"
             expleft_msg = expleft_msg.format(
                 experiments_left, total_experiments)
@@ -569,28 +574,12 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
             runcode = runcode.replace(
                 ">Next Experiment</button>",
                 ">Finished</button>")
-    elif experiment_type in ["games"]:
-        experiment = load_experiment(experiment_folders[0])
-        runcode = experiment[0]["deployment_variables"]["run"]
     elif experiment_type in ["surveys"]:
-        experiment = load_experiment(experiment_folders[0])
         resultid = ""
         if result is not None:
             resultid = result.id
-        runcode, validation = generate_survey(
-            experiment, experiment_folders[0], form_action="/local/%s/" %
-            resultid, csrf_token=True)
-
-        # Field will be filled in by browser cookie, and hidden fields are
-        # added for data
-        csrf_field = '<input type="hidden" name="csrfmiddlewaretoken" value="hello">'
-        csrf_field = '%s\n<input type="hidden" name="djstatus" value="FINISHED">' % (
-            csrf_field)
-        csrf_field = '%s\n<input type="hidden" name="url" value="chickenfingers">' % (
-            csrf_field)
-
-        runcode = runcode.replace("{% csrf_token %}", csrf_field)
-        context["validation"] = validation
+        runcode = runcode.replace(RESULT_ID_PLACEHOLDER, str(resultid))
+        context["validation"] = payload["validation"]
 
         if last_experiment:
             context["last_experiment"] = last_experiment
@@ -604,12 +593,51 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
 
 # These views are to work with backbone.js
 
+def get_sync_error(data):
+    '''get_sync_error returns why the data posted to sync by an experiment
+    can't be saved, or None if it can
+    :param data: the data parsed from the body of the request
+    '''
+    def is_index(value):
+        return isinstance(value, (int, long)) and \
+            not isinstance(value, bool) and value >= 0
+
+    if not isinstance(data, dict) or "djstatus" not in data:
+        return "djstatus is required"
+    if "trials" in data:
+        if not isinstance(data["trials"], list):
+            return "trials must be a list"
+        if not is_index(data.get("start")):
+            return "start must be the index of the first trial"
+        if data.get("currenttrial") is not None and \
+                not is_index(data["currenttrial"]):
+            return "currenttrial must be a trial index"
+    elif not isinstance(data.get("taskdata"), dict) or \
+            "data" not in data["taskdata"]:
+        return "trials or taskdata is required"
+    return None
+
 
 @ensure_csrf_cookie
 def sync(request, rid=None):
     '''localsync
     view/method for running experiments to get data from the server
     :param rid: the result object ID, obtained before user sees page
+
+    Experiments can post only the trials recorded since their last sync,
+    which are appended to the result without rewriting its taskdata:
+
+        {"trials": [...], "start": <index of the first trial>,
+         "currenttrial": <current trial>, "djstatus": ...}
+
+    or, as older clients do, the full taskdata on every request:
+
+        {"taskdata": {"data": [...], "currenttrial": ...}, "djstatus": ...}
+
+    The run code generated by expfactory for deployed batteries posts the
+    full taskdata, trials are only sent by clients calling saveData of
+    expfactory.js. Malformed data is answered with a 400, and trials posted
+    after the result is completed with a 409, as they would not be saved.
     '''
 
     if request.method == "POST":
@@ -619,11 +647,33 @@ def sync(request, rid=None):
             result, _ = Result.objects.get_or_create(id=rid)
             battery = result.battery
             experiment_template = get_experiment_type(result.experiment)
+            save_result = True
             if experiment_template == "experiments":
-                data = json.loads(request.body)
-                result.taskdata = data["taskdata"]["data"]
-                result.current_trial = data["taskdata"]["currenttrial"]
+                try:
+                    data = json.loads(request.body)
+                except ValueError:
+                    data = None
+                error = get_sync_error(data)
+                if error is not None:
+                    return JsonResponse({"message": error}, status=400)
                 djstatus = data["djstatus"]
+                if "trials" in data:
+                    # the row lock keeps chunks from being appended while
+                    # the finishing request assembles them
+                    with transaction.atomic():
+                        if Result.objects.select_for_update().values_list(
+                                "completed", flat=True).get(id=result.id):
+                            return JsonResponse(
+                                {"message": "result %s is completed" %
+                                 result.id}, status=409)
+                        result.append_trials(
+                            data["trials"], start=data["start"],
+                            current_trial=data.get("currenttrial"))
+                    save_result = False
+                else:
+                    result.taskdata = data["taskdata"]["data"]
+                    result.current_trial = data["taskdata"]["currenttrial"]
+                    result.trial_chunks.all().delete()
             elif experiment_template == "games":
                 data = json.loads(request.body)
                 redirect_url = data["redirect_url"]
@@ -640,31 +690,39 @@ def sync(request, rid=None):
                 result.taskdata = complete_survey_result(
                     result.experiment.exp_id, data)
 
-            result.save()
-
             # if the worker finished the current experiment
             if djstatus == "FINISHED":
 
-                # Mark experiment as completed
+                # Mark experiment as completed, saved with the taskdata
                 result.completed = True
                 result.finishtime = timezone.now()
                 result.version = result.experiment.version
-                result.save()
+                save_result = True
+
+            # Only the changed columns of the result are written, the
+            # progress of the worker is updated with the completed result
+            if save_result:
+                with transaction.atomic():
+                    if djstatus == "FINISHED":
+                        # chunks posted meanwhile wait, then are rejected
+                        Result.objects.select_for_update().filter(
+                            id=result.id).exists()
+                        result.assemble_trials()
+                    result.save()
+                    if djstatus == "FINISHED":
+                        progress = update_worker_progress(result)
+
+            if djstatus == "FINISHED":
+                update_variable_index(result)
 
-                # Fire a task to check blacklist status, add bonus
-                check_blacklist.apply_async([result.id])
-                experiment_reward.apply_async([result.id])
+                # Fire a task to check blacklist status, add bonus, and
+                # allocate credit if the battery is finished
+                process_completed_result.apply_async([result.id])
 
                 data = dict()
                 data["finished_battery"] = "NOTFINISHED"
                 data["djstatus"] = djstatus
-                completed_experiments = get_worker_experiments(
-                    result.worker, battery, completed=True)
-                completed_experiments = numpy.unique(
-                    [x.template.exp_id for x in completed_experiments]).tolist()
-                if len(completed_experiments) == battery.experiments.count():
-                    assign_experiment_credit.apply_async(
-                        [result.worker.id], countdown=60)
+                if progress is not None and progress.finished:
                     data["finished_battery"] = "FINISHED"
 
                 # Refresh the page if we've completed a survey or game
@@ -793,6 +851,8 @@ def delete_experiment_template(request, eid, do_redirect=True):
     experiment_instances = Experiment.objects.filter(template=experiment)
     experiment_type = get_experiment_type(experiment)
     if check_experiment_edit_permission(request):
+        batteries = list(Battery.objects.filter(
+            experiments__template=experiment).distinct())
         # Static Files
         [e.delete() for e in experiment_instances]
         static_files_dir = os.path.join(
@@ -811,6 +871,9 @@ def delete_experiment_template(request, eid, do_redirect=True):
         except BaseException:
             pass
         experiment.delete()
+        # the batteries lost the experiment and its results
+        for battery in batteries:
+            rebuild_battery_progress(battery)
 
     if do_redirect:
         return redirect('experiments')
@@ -899,6 +962,7 @@ def save_experiment(request, bid):
         current_experiments.append(experiment)
         battery.experiments = current_experiments
         battery.save()
+        rebuild_battery_progress(battery)
 
     return HttpResponseRedirect(battery.get_absolute_url())
 
@@ -1004,6 +1068,7 @@ def remove_experiment(request, bid, eid):
     if check_battery_edit_permission(request, battery):
         battery.experiments = [
             x for x in battery.experiments.all() if x.id != experiment.id]
+        rebuild_battery_progress(battery)
     battery.save()
 
     # If experiment is not linked to other batteries, delete it
@@ -1155,6 +1220,8 @@ def subject_management(request, bid):
 @login_required
 def export_battery(request, bid):
     battery = get_battery(bid, request)
+    if not check_battery_edit_permission(request, battery):
+        return HttpResponseForbidden()
     output_name = "expfactory_battery_%s.tsv" % (battery.id)
     return export_experiments(battery, output_name)
 
@@ -1164,6 +1231,8 @@ def export_battery(request, bid):
 @login_required
 def export_experiment(request, eid):
     battery = Battery.objects.filter(experiments__id=eid)[0]
+    if not check_battery_edit_permission(request, battery):
+        return HttpResponseForbidden()
     experiment = get_experiment(eid, request)
     output_name = "expfactory_experiment_%s.tsv" % (experiment.template.exp_id)
     return export_experiments(
@@ -1173,38 +1242,122 @@ def export_experiment(request, eid):
 # General function to export some number of experiments
 
 
-def export_experiments(battery, output_name, experiment_tags=None):
+class Echo(object):
+    '''a file-like object that returns what is written to it, so a csv.writer
+    can produce the lines of a streaming response
+    '''
+
+    def write(self, value):
+        return value
+
 
-    # Get all results associated with Battery
-    results = Result.objects.filter(battery=battery)
-    response = HttpResponse(content_type='text/csv')
+def export_experiments(battery, output_name, experiment_tags=None):
+    '''export_experiments streams a tab separated file with one row per trial
+    of the completed results. The header comes from the variable index, and
+    results are read with a server side cursor and written as they are read,
+    so memory does not grow with the battery size.
+    :param battery: the battery to export results for
+    :param output_name: the file name for the download
+    :param experiment_tags: export only these experiment exp_ids [optional]
+    '''
+    # Specifying individual experiments removes between trial stufs
+    results = get_export_results(battery, experiment_tags)
+    variables = get_export_variables(battery, experiment_tags)
+    writer = csv.writer(Echo(), delimiter='\t')
+    rows = iter_results_rows(battery, results, variables)
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows),
+                                     content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="%s"' % (
         output_name)
-    writer = csv.writer(response, delimiter='\t')
+    return response
 
-    # Make a results pandas dataframe
-    df = make_results_df(battery, results)
+# Background exports -------------------------------------------------------
 
-    # Specifying individual experiments removes between trial stufs
-    if experiment_tags is not None:
-        if isinstance(experiment_tags, str):
-            experiment_tags = [experiment_tags]
-        df = df[df.experiment_exp_id.isin(experiment_tags)]
 
-    # The program reading in values should fill in appropriate nan value
-    df[df.isnull()] = ""
+@login_required
+def export_battery_job(request, bid):
+    battery = get_battery(bid, request)
+    return export_job(request, battery)
 
-    # Write header
-    writer.writerow(df.columns.tolist())
 
-    for row in df.iterrows():
-        try:
-            values = row[1].tolist()
-            writer.writerow(values)
-        except BaseException:
-            pass
+@login_required
+def export_experiment_job(request, eid):
+    battery = Battery.objects.filter(experiments__id=eid)[0]
+    experiment = get_experiment(eid, request)
+    return export_job(request, battery, [experiment.template.exp_id])
+
+
+def get_export_job_context(job):
+    context = {"id": job.id,
+               "status": job.status,
+               "format": job.export_format,
+               "progress": job.get_progress(),
+               "result_count": job.result_count,
+               "results_written": job.results_written,
+               "status_url": job.get_absolute_url()}
+    if job.is_ready():
+        context["download_url"] = reverse("download_export", args=[job.id])
+    if job.error is not None:
+        context["error"] = job.error
+    return context
 
-    return response
+
+def export_job(request, battery, experiment_tags=None):
+    '''export_job returns the status of a background export of battery results,
+    and enqueues the export if there is no file for the current results yet.
+    Failed jobs, and finished jobs with a missing file, are enqueued again.
+    :param battery: the battery to export results for
+    :param experiment_tags: export only these experiment exp_ids [optional]
+    '''
+    if not check_battery_edit_permission(request, battery):
+        return HttpResponseForbidden()
+
+    export_format = request.GET.get("format", "tsv")
+    if export_format not in dict(ExportJob.FORMAT_CHOICES):
+        return JsonResponse({"message": "Unknown export format %s" %
+                             export_format}, status=400)
+
+    key, result_count = get_export_key(battery, experiment_tags, export_format)
+    job, created = ExportJob.objects.get_or_create(
+        key=key,
+        defaults={"battery": battery,
+                  "experiment_tags": experiment_tags,
+                  "export_format": export_format,
+                  "owner": request.user,
+                  "result_count": result_count,
+                  "output_file": get_export_file(key, export_format)})
+
+    restart = job.status == ExportJob.FAILED or (
+        job.status == ExportJob.FINISHED and not job.is_ready())
+    if created or restart or job.is_stale():
+        if restart:
+            job.status = ExportJob.PENDING
+            job.save()
+        export_results.apply_async([job.id])
+
+    return JsonResponse(get_export_job_context(job))
+
+
+@login_required
+def export_job_status(request, jid):
+    job = get_object_or_404(ExportJob, pk=jid)
+    if not check_battery_edit_permission(request, job.battery):
+        return HttpResponseForbidden()
+    if job.is_stale():
+        export_results.apply_async([job.id])
+    return JsonResponse(get_export_job_context(job))
+
+
+@login_required
+def download_export(request, jid):
+    '''download_export serves a finished export file with the sendfile backend'''
+    job = get_object_or_404(ExportJob, pk=jid)
+    if not check_battery_edit_permission(request, job.battery):
+        return HttpResponseForbidden()
+    if not job.is_ready():
+        raise Http404
+    return sendfile(request, job.output_file, attachment=True,
+                    attachment_filename=job.get_download_name())
 
 #### RESULTS VISUALIZATION ###############################################
 
@@ -1229,9 +1382,7 @@ def battery_results_context(request, bid):
     battery = get_battery(bid, request)
 
     # Check if battery has results
-    results = Result.objects.filter(battery=battery, completed=True)
-    completed_experiments = numpy.unique(
-        [r.experiment.exp_id for r in results]).tolist()
+    completed_experiments = get_battery_experiments(battery)
     experiments = ExperimentTemplate.objects.filter(
         exp_id__in=completed_experiments)
     context = {'battery': battery,
@@ -12,4 +12,5 @@ class BatteryResultAPIList(generics.ListAPIView):
         battery_id = self.kwargs.get('bid')
         if (Battery.objects.get(pk=battery_id).owner is not self.request.user.pk):
             raise exceptions.PermissionDenied()
-        return Result.objects.filter(battery__id=battery_id)
+        return Result.objects.filter(
+            battery__id=battery_id).select_related("data")
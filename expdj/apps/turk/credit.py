@@ -0,0 +1,405 @@
+'''Evaluation of the credit conditions of an experiment on a result.
+
+The variable of a condition is an expression, compiled once: a trial
+variable (rt), optionally summarized over the trials (mean_rt, p95_rt,
+count_rt) and filtered by other variables (mean_rt[correct==true]). The
+trial variables that the conditions refer to are read from the taskdata in
+one pass, into a columnar view of numpy arrays, and each condition is
+compared with all of the trials at once. The outcome holds both the
+rejection (blacklist) and the bonus decisions, used by
+process_completed_result.
+'''
+
+import re
+import threading
+
+import numpy
+
+from expdj.apps.experiments.models import CreditCondition
+from expdj.apps.experiments.utils import get_experiment_type
+from expdj.apps.turk.utils import get_summary_values, is_number, iter_trials
+
+OPERATORS = dict(CreditCondition.OPERATOR_CHOICES)
+
+NUMBER_TYPES = set([int, long, float])
+
+# a trial without the variable
+MISSING = object()
+
+
+# COLUMNAR TRIALS ######################################################
+
+def parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_boolean(value):
+    value = ("%s" % value).strip().lower()
+    if value in ["true", "1"]:
+        return True
+    if value in ["false", "0"]:
+        return False
+    return None
+
+
+class TrialColumn(object):
+    '''TrialColumn holds the values of a variable in the trials of a result,
+    split by type into arrays of numbers, booleans and other values, each
+    with the positions of its values in the trials. Trials without the
+    variable are MISSING, and in no group.'''
+
+    def __init__(self, values):
+        self.values = values
+        groups = {"number": ([], []), "boolean": ([], []), "other": ([], [])}
+        types = set(map(type, values))
+        # most variables have values of one kind, and need no split
+        if types and types.issubset(NUMBER_TYPES):
+            groups["number"] = (range(len(values)), values)
+        elif types == set([bool]):
+            groups["boolean"] = (range(len(values)), values)
+        else:
+            self._split(values, groups)
+        self.groups = [
+            (parse_number, self._arrays(groups["number"], float)),
+            (parse_boolean, self._arrays(groups["boolean"], bool)),
+            (lambda value: value, self._arrays(groups["other"], object)),
+        ]
+        self.positions = numpy.sort(numpy.concatenate(
+            [positions for _, (positions, _) in self.groups]))
+
+    @staticmethod
+    def _split(values, groups):
+        for position, value in enumerate(values):
+            if value is MISSING:
+                continue
+            if isinstance(value, bool):
+                group = "boolean"
+            elif is_number(value):
+                group = "number"
+            else:
+                group = "other"
+            groups[group][0].append(position)
+            groups[group][1].append(value)
+
+    @staticmethod
+    def _arrays(group, dtype):
+        positions, values = group
+        if dtype is object:
+            # filled one by one, values that are lists of equal length (eg
+            # jsPsych responses) would make a 2-D array
+            array = numpy.empty(len(values), dtype=object)
+            for index, value in enumerate(values):
+                array[index] = value
+        else:
+            array = numpy.array(values, dtype=dtype)
+        return numpy.array(positions, dtype=int), array
+
+    def __len__(self):
+        return len(self.positions)
+
+    def take(self, positions):
+        '''take returns the values at positions, as a list'''
+        return [self.values[position] for position in positions]
+
+    def match(self, operator, value):
+        '''match returns the sorted positions of the trial values that meet the
+        condition, compared with the value as a number, a boolean or as it is,
+        following the type of the trial value
+        :param operator: one of CreditCondition.OPERATOR_CHOICES, eg "EQUALS"
+        :param value: the value of the condition
+        '''
+        func = OPERATORS.get(operator)
+        matches = []
+        if func is not None:
+            for parse, (positions, values) in self.groups:
+                comparator = parse(value)
+                if len(positions) == 0 or comparator is None:
+                    continue
+                matches.append(positions[numpy.asarray(
+                    func(values, comparator), dtype=bool)])
+        if not matches:
+            return numpy.array([], dtype=int)
+        return numpy.sort(numpy.concatenate(matches))
+
+
+class TrialTable(object):
+    '''TrialTable is a columnar view of the trials of a taskdata: a TrialColumn
+    for each variable read, aligned by trial. The trials are read in one pass.
+    A trialdata value wins over a trial level one, as in the exports, and
+    taskdata that isn't a list of trials has no trials. Trials in the older
+    layout, a list in the trialdata, are read too (see iter_trials).'''
+
+    def __init__(self, taskdata, names):
+        values = dict((name, []) for name in names)
+        appends = [(name, values[name].append) for name in names]
+        for trial in iter_trials(taskdata):
+            trialdata = trial.get("trialdata")
+            if not isinstance(trialdata, dict):
+                trialdata = {}
+            for name, append in appends:
+                if name in trialdata:
+                    append(trialdata[name])
+                elif name in trial:
+                    append(trial[name])
+                else:
+                    append(MISSING)
+        self.columns = dict((name, TrialColumn(column))
+                            for name, column in values.items())
+
+
+# VARIABLE EXPRESSIONS #################################################
+
+# summary statistic prefixes of variable names, eg mean_rt, and p95_rt for
+# the 95th percentile
+SUMMARY_PREFIXES = {"avg": "mean",
+                    "mean": "mean",
+                    "average": "mean",
+                    "med": "median",
+                    "median": "median",
+                    "sum": "sum",
+                    "total": "sum",
+                    "max": "max",
+                    "min": "min",
+                    "std": "std",
+                    "count": "count"}
+
+PERCENTILE_PREFIX = re.compile(r"^p(\d{1,2}(\.\d+)?|100)$")
+
+# comparisons of filters, longest first
+FILTER_OPERATORS = [("==", "EQUALS"),
+                    ("!=", "NOTEQUALTO"),
+                    ("<=", "LESSTHANEQUALTO"),
+                    (">=", "GREATERTHANEQUALTO"),
+                    ("<", "LESSTHAN"),
+                    (">", "GREATERTHAN")]
+
+EXPRESSION = re.compile(r"^(?P<name>[^\[\]]+)(\[(?P<filters>[^\[\]]*)\])?$")
+
+
+def summarize(summary, values):
+    '''summarize returns a summary statistic of the values of a variable, or
+    None if it has no numeric (or boolean) values. count counts all values.
+    :param summary: a value of SUMMARY_PREFIXES, or a percentile, eg p95
+    :param values: the values of the variable in the trials
+    '''
+    if summary == "count":
+        return len(values)
+    numbers = get_summary_values(values)
+    if not numbers:
+        return None
+    if summary.startswith("p"):
+        return float(numpy.percentile(numbers, float(summary[1:])))
+    return float(getattr(numpy, summary)(numbers))
+
+
+def parse_filter(text):
+    '''parse_filter returns a (variable, operator, value) tuple for a filter
+    like correct==true, or None if it isn't one'''
+    for symbol, operator in FILTER_OPERATORS:
+        variable, found, value = text.partition(symbol)
+        variable, value = variable.strip(), value.strip()
+        if found and variable and value:
+            if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+                value = value[1:-1]
+            return variable, operator, value
+    return None
+
+
+class VariablePlan(object):
+    '''VariablePlan is a compiled variable expression: the values of a trial
+    variable in the trials that pass the filters, or a summary of them. A
+    summary expression is first looked up as a variable, eg a trial variable
+    named total_points is not the sum of points.'''
+
+    def __init__(self, expression, variable, summary=None, filters=None):
+        self.expression = expression
+        self.variable = variable
+        self.summary = summary
+        self.filters = filters or []
+        self.alias = None
+        if summary is not None and not self.filters:
+            self.alias = expression
+        self.names = set([variable] + [f[0] for f in self.filters])
+        if self.alias is not None:
+            self.names.add(self.alias)
+
+    def __repr__(self):
+        return "<VariablePlan:%s>" % self.expression
+
+    def evaluate(self, table):
+        '''evaluate returns a TrialColumn with the values of the expression in
+        a TrialTable that has the columns of the plan names'''
+        if self.alias is not None and len(table.columns[self.alias]):
+            column = table.columns[self.alias]
+            return TrialColumn(column.take(column.positions))
+
+        column = table.columns[self.variable]
+        positions = column.positions
+        for name, operator, value in self.filters:
+            positions = numpy.intersect1d(
+                positions, table.columns[name].match(operator, value),
+                assume_unique=True)
+        values = column.take(positions)
+        if self.summary is None:
+            return TrialColumn(values)
+        summary = summarize(self.summary, values)
+        return TrialColumn([] if summary is None else [summary])
+
+
+def compile_variable(expression):
+    '''compile_variable parses a variable expression into a VariablePlan, eg
+    rt, mean_rt, p95_rt or mean_rt[correct==true,key_press!=-1]. An expression
+    that doesn't parse is a plain variable name.
+    :param expression: the name of a credit condition ExperimentVariable
+    '''
+    expression = expression.strip()
+    match = EXPRESSION.match(expression)
+    if match is None:
+        return VariablePlan(expression, expression)
+    name = match.group("name").strip()
+    filters = []
+    if match.group("filters") is not None:
+        for text in match.group("filters").split(","):
+            condition = parse_filter(text)
+            if condition is None:
+                return VariablePlan(expression, expression)
+            filters.append(condition)
+
+    prefix, _, variable = name.partition("_")
+    prefix = prefix.lower()
+    summary = SUMMARY_PREFIXES.get(prefix)
+    if summary is None and PERCENTILE_PREFIX.match(prefix):
+        summary = prefix
+    if summary is None or not variable:
+        return VariablePlan(expression, name, filters=filters)
+    return VariablePlan(expression, variable, summary, filters)
+
+
+# compiled plans, by expression. There is one for each ExperimentVariable
+# name used in a process, so the cache is not bounded.
+_plans = dict()
+_plans_lock = threading.Lock()
+
+
+def get_variable_plan(expression):
+    '''get_variable_plan returns the cached VariablePlan of an expression,
+    compiling it on first use
+    :param expression: the name of a credit condition ExperimentVariable
+    '''
+    plan = _plans.get(expression)
+    if plan is None:
+        plan = compile_variable(expression)
+        with _plans_lock:
+            _plans[expression] = plan
+    return plan
+
+
+def evaluate_variables(taskdata, expressions):
+    '''evaluate_variables returns a TrialColumn with the values of each
+    variable expression in a taskdata, reading the trials once
+    :param taskdata: the taskdata of a Result, a list of trials
+    :param expressions: variable expressions, eg ["rt", "mean_correct"]
+    '''
+    plans = dict((e, get_variable_plan(e)) for e in expressions)
+    names = set()
+    for plan in plans.values():
+        names.update(plan.names)
+    table = TrialTable(taskdata, names)
+    return dict((e, plan.evaluate(table)) for e, plan in plans.items())
+
+
+# CREDIT CONDITIONS ####################################################
+
+class CreditOutcome(object):
+    '''CreditOutcome holds the decisions of the credit conditions on a result:
+    the description of the first rejection found, if any, and an (amount,
+    description) tuple for each bonus condition that was met'''
+
+    def __init__(self):
+        self.rejection = None
+        self.bonuses = []
+
+    def __repr__(self):
+        return "<CreditOutcome:rejection[%s],bonuses[%s]>" % (
+            self.rejection, len(self.bonuses))
+
+
+def describe_condition(condition, value):
+    return "%s %s %s %s" % (condition.variable.name, value,
+                            condition.operator, condition.value)
+
+
+def evaluate_credit_conditions(taskdata, conditions, rejection_variable_id=None,
+                               performance_variable_id=None):
+    '''evaluate_credit_conditions compares the trials of a taskdata with the
+    credit conditions of an experiment. Conditions on the rejection variable
+    give the rejection, conditions on the performance variable with an amount
+    give bonuses. Other conditions are not evaluated.
+    :param taskdata: the taskdata of a Result, a list of trials
+    :param conditions: experiments.models.CreditCondition objects
+    :param rejection_variable_id: the id of the rejection ExperimentVariable
+    :param performance_variable_id: the id of the performance ExperimentVariable
+    '''
+    outcome = CreditOutcome()
+    conditions = [c for c in conditions if c.variable_id is not None and
+                  c.variable_id in [rejection_variable_id,
+                                    performance_variable_id]]
+    if not conditions:
+        return outcome
+
+    columns = evaluate_variables(taskdata,
+                                 set(c.variable.name for c in conditions))
+    for condition in conditions:
+        column = columns[condition.variable.name]
+        matches = column.match(condition.operator, condition.value)
+        if len(matches) == 0:
+            continue
+        if condition.variable_id == rejection_variable_id and \
+                outcome.rejection is None:
+            outcome.rejection = describe_condition(
+                condition, column.values[matches[0]])
+        if condition.variable_id == performance_variable_id and \
+                condition.amount is not None:
+            outcome.bonuses.append((condition.amount, describe_condition(
+                condition, column.values[matches[-1]])))
+    return outcome
+
+
+def get_result_experiment(result):
+    '''get_result_experiment returns the experiments.models.Experiment of the
+    battery of a result that deploys its template, or None
+    '''
+    return result.battery.experiments.filter(
+        template_id=result.experiment_id).first()
+
+
+def evaluate_result(result, experiment, rejection=True, bonus=True):
+    '''evaluate_result evaluates the credit conditions of an experiment on a
+    completed result. Rejection is only checked when the experiment includes
+    catch trials and the battery blacklist is active, and bonuses when the
+    experiment includes a bonus and battery bonuses are active.
+    :param result: a turk.models.Result
+    :param experiment: the experiments.models.Experiment of the result
+    :param rejection: evaluate the rejection conditions
+    :param bonus: evaluate the bonus conditions
+    '''
+    template = result.experiment
+    battery = result.battery
+    rejection_variable_id = None
+    performance_variable_id = None
+    if rejection and experiment.include_catch and battery.blacklist_active:
+        rejection_variable_id = template.rejection_variable_id
+    if bonus and experiment.include_bonus and battery.bonus_active:
+        performance_variable_id = template.performance_variable_id
+    # Surveys and games not yet implemented
+    if not result.completed or \
+            get_experiment_type(template) != "experiments" or \
+            (rejection_variable_id is None and performance_variable_id is None):
+        return CreditOutcome()
+    conditions = experiment.credit_conditions.select_related("variable")
+    return evaluate_credit_conditions(result.taskdata, conditions,
+                                      rejection_variable_id,
+                                      performance_variable_id)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk.models import rebuild_battery_progress
+
+
+class Command(BaseCommand):
+    help = ("Compute the progress of workers in existing batteries, and the "
+            "workers that completed them")
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_ids', nargs='*', type=int,
+                            help="ids of batteries to index, default is all")
+
+    def handle(self, *args, **options):
+        batteries = Battery.objects.all()
+        if options['battery_ids']:
+            batteries = batteries.filter(id__in=options['battery_ids'])
+
+        for battery in batteries:
+            completed = rebuild_battery_progress(battery)
+            self.stdout.write("%s: %s workers completed" % (battery.name,
+                                                             completed))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk.models import Result, rebuild_variable_index
+
+
+class Command(BaseCommand):
+    help = ("Build the variable index (trial variables and experiments with "
+            "completed results) for existing batteries")
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_ids', nargs='*', type=int,
+                            help="ids of batteries to index, default is all")
+
+    def handle(self, *args, **options):
+        batteries = Battery.objects.all()
+        if options['battery_ids']:
+            batteries = batteries.filter(id__in=options['battery_ids'])
+
+        for battery in batteries:
+            exp_ids = Result.objects.filter(
+                battery=battery).order_by().values_list(
+                "experiment_id", flat=True).distinct()
+            indexed = 0
+            for exp_id in exp_ids:
+                if rebuild_variable_index(battery, exp_id) is not None:
+                    indexed += 1
+            self.stdout.write("%s: indexed %s experiments" % (battery.name,
+                                                               indexed))
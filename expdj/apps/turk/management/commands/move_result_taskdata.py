@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from expdj.apps.turk.models import (hold_result_taskdata,
+                                    restore_result_taskdata)
+
+
+class Command(BaseCommand):
+    help = ("Move the taskdata of results from the turk_result column to "
+            "turk_resultdata: hold it before migrate, restore it after")
+
+    def add_arguments(self, parser):
+        parser.add_argument('step', choices=['hold', 'restore'],
+                            help="hold before migrate, restore after it")
+        parser.add_argument('--database', default='default',
+                            help="the database to move the taskdata in")
+
+    def handle(self, *args, **options):
+        if options['step'] == 'hold':
+            count = hold_result_taskdata(using=options['database'])
+            done = "held"
+        else:
+            count = restore_result_taskdata(using=options['database'])
+            done = "restored"
+
+        if count is None:
+            self.stdout.write("No taskdata to %s" % options['step'])
+        else:
+            self.stdout.write("The taskdata of %s results was %s" % (count,
+                                                                    done))
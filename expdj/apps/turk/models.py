@@ -2,29 +2,44 @@
 # -*- coding: utf-8 -*-
 import collections
 import datetime
+import logging
 
 import boto
+import numpy
 from boto.mturk.price import Price
 from boto.mturk.qualification import (AdultRequirement, LocaleRequirement,
                                       NumberHitsApprovedRequirement,
                                       PercentAssignmentsApprovedRequirement,
                                       Qualifications, Requirement)
 from boto.mturk.question import ExternalQuestion
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import DO_NOTHING, Q
-from django.db.models.signals import pre_init
+from django.db import (DEFAULT_DB_ALIAS, IntegrityError, connection,
+                       connections, models, transaction)
+from django.db.models import (DO_NOTHING, Case, Exists, F, OuterRef, Q,
+                              Value, When)
+from django.db.models.expressions import Combinable
+from django.db.models.functions import Cast
+from django.db.models.signals import post_migrate, pre_init
 from django.utils import timezone
 from jsonfield import JSONField
+from redis.exceptions import RedisError
 
 from expdj.apps.experiments.models import (Battery, Experiment,
                                            ExperimentTemplate)
 from expdj.apps.turk.utils import (amazon_string_to_datetime, get_connection,
                                    get_credentials, get_time_difference,
-                                   to_dict)
+                                   get_summary_values, get_trial_value,
+                                   get_trial_variables, iter_trials,
+                                   load_json, to_dict)
 from expdj.settings import BASE_DIR, DOMAIN_NAME
 
+logger = logging.getLogger(__name__)
+
 
 def init_connection_callback(sender, **signal_args):
     """Mechanical Turk connection signal callback
@@ -41,6 +56,10 @@ def init_connection_callback(sender, **signal_args):
         AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY_ID, sender)
 
 
+class RequestRateExceeded(Exception):
+    """The request rate to Amazon is used up"""
+
+
 class DisposeException(Exception):
     """Unable to Dispose of HIT Exception"""
 
@@ -52,7 +71,118 @@ class DisposeException(Exception):
     __str__ = __unicode__
 
 
-class Worker(models.Model):
+class ChangedFieldsMixin(object):
+    '''ChangedFieldsMixin keeps the values a model instance was loaded (or
+    last saved) with, so that save() of an existing row only writes the
+    columns that changed, and nothing when none did. JSON fields are compared
+    by identity: a new value has to be assigned (not changed in place) for
+    them to be written.
+    '''
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ChangedFieldsMixin, cls).from_db(
+            db, field_names, values)
+        instance.reset_changed_fields(field_names)
+        return instance
+
+    def reset_changed_fields(self, attnames=None):
+        '''reset_changed_fields records the current values of the fields as
+        saved, eg after they were written with a queryset update
+        :param attnames: the field attnames, defaults to all loaded fields
+        '''
+        if attnames is None:
+            attnames = [f.attname for f in self._meta.concrete_fields]
+        saved = self.__dict__.setdefault("_saved_values", {})
+        for attname in attnames:
+            if attname not in self.__dict__:
+                continue
+            value = self.__dict__[attname]
+            # the value of an expression is only known in the database
+            if isinstance(value, Combinable):
+                saved.pop(attname, None)
+            else:
+                saved[attname] = value
+
+    def get_changed_fields(self):
+        '''get_changed_fields returns the names of the fields that changed
+        since the instance was loaded or saved, or None if it wasn't
+        '''
+        saved = self.__dict__.get("_saved_values")
+        if saved is None:
+            return None
+        changed = []
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname not in self.__dict__:
+                continue
+            value = self.__dict__[field.attname]
+            if field.attname not in saved:
+                changed.append(field.name)
+            elif isinstance(field, JSONField):
+                if value is not saved[field.attname]:
+                    changed.append(field.name)
+            elif not self._same_value(field, value, saved[field.attname]):
+                changed.append(field.name)
+        return changed
+
+    @staticmethod
+    def _same_value(field, value, saved):
+        try:
+            return field.to_python(value) == saved
+        except (ValidationError, TypeError):
+            return False
+
+    def save(self, *args, **kwargs):
+        if not args and not self._state.adding and \
+                not kwargs.get("force_insert") and \
+                kwargs.get("update_fields") is None:
+            changed = self.get_changed_fields()
+            if changed is not None:
+                kwargs["update_fields"] = changed
+        super(ChangedFieldsMixin, self).save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            self.reset_changed_fields()
+        else:
+            self.reset_changed_fields([self._meta.get_field(name).attname
+                                       for name in update_fields])
+
+
+def bulk_update(instances, fields, batch_size=100):
+    '''bulk_update writes fields of many instances of a model with one UPDATE
+    per batch, setting each column with a CASE over the primary keys. It
+    returns the number of UPDATE queries.
+    :param instances: saved instances of one model
+    :param fields: names of the fields to write
+    :param batch_size: instances per UPDATE
+    '''
+    instances = [instance for instance in instances if instance.pk is not None]
+    if not instances or not fields:
+        return 0
+    model = instances[0].__class__
+    fields = [model._meta.get_field(name) for name in fields]
+    queries = 0
+    for start in range(0, len(instances), batch_size):
+        batch = instances[start:start + batch_size]
+        values = dict()
+        for field in fields:
+            case = Case(*[When(pk=instance.pk,
+                               then=Value(getattr(instance, field.attname),
+                                          output_field=field))
+                          for instance in batch], output_field=field)
+            # postgres types a CASE of parameters (or NULLs) as text
+            if connection.vendor == "postgresql":
+                case = Cast(case, output_field=field)
+            values[field.attname] = case
+        model.objects.filter(pk__in=[i.pk for i in batch]).update(**values)
+        queries += 1
+        for instance in batch:
+            if isinstance(instance, ChangedFieldsMixin):
+                instance.reset_changed_fields([f.attname for f in fields])
+    return queries
+
+
+class Worker(ChangedFieldsMixin, models.Model):
     id = models.CharField(
         primary_key=True,
         max_length=200,
@@ -76,7 +206,7 @@ class Worker(models.Model):
 
 
 def get_worker(worker_id, create=True):
-    '''get a worker
+    '''get a worker, and count the visit
     :param create: update or create
     :param worker_id: the unique identifier for the worker
     '''
@@ -84,26 +214,37 @@ def get_worker(worker_id, create=True):
     now = timezone.now()
 
     if create:
-        worker, _ = Worker.objects.update_or_create(id=worker_id)
+        worker, created = Worker.objects.get_or_create(
+            id=worker_id, defaults={"session_count": 1,
+                                    "visit_count": 1,
+                                    "last_visit_time": now})
+        if created:  # this is the first session
+            return worker
     else:
         worker = Worker.objects.filter(id=worker_id)[0]
 
+    # Counts are incremented in the database, so concurrent visits all count
+    updates = {"visit_count": F("visit_count") + 1,
+               "last_visit_time": now}
     if worker.last_visit_time is not None:  # minutes
         time_difference = get_time_difference(worker.last_visit_time, now)
         # If more than an hour has passed, this is a new session
         if time_difference >= 60.0:
+            updates["session_count"] = F("session_count") + 1
             worker.session_count += 1
     else:  # this is the first session
+        updates["session_count"] = 1
         worker.session_count = 1
 
-    # Update the last visit time to be now
+    Worker.objects.filter(id=worker.id).update(**updates)
     worker.visit_count += 1
     worker.last_visit_time = now
-    worker.save()
+    worker.reset_changed_fields(["session_count", "visit_count",
+                                 "last_visit_time"])
     return worker
 
 
-class HIT(models.Model):
+class HIT(ChangedFieldsMixin, models.Model):
     """An Amazon Mechanical Turk Human Intelligence Task as a Django Model"""
 
     def __str__(self):
@@ -504,23 +645,16 @@ class HIT(models.Model):
         # 'CurrencyCode', 'Reward', 'Expiration', 'expired']
 
         self.save()
+        cache_hit_status(self)
 
         if do_update_assignments:
             self.update_assignments()
 
-    def update_assignments(self, page_number=1, page_size=10, update_all=True):
-        self.generate_connection()
-        assignments = self.connection.get_assignments(self.mturk_id,
-                                                      page_size=page_size,
-                                                      page_number=page_number)
-        for mturk_assignment in assignments:
-            assert mturk_assignment.HITId == self.mturk_id
-            djurk_assignment = Assignment.objects.get_or_create(
-                mturk_id=mturk_assignment.AssignmentId, hit=self)[0]
-            djurk_assignment.update(mturk_assignment, hit=self)
-        if update_all and int(assignments.PageNumber) *\
-                page_size < int(assignments.TotalNumResults):
-            self.update_assignments(page_number + 1, page_size, update_all)
+    def update_assignments(self, page_size=None, acquire_request=None):
+        """Update all assignments of the HIT with one Mechanical Turk
+        listing, see sync_assignments"""
+        return sync_assignments(self, page_size=page_size,
+                                acquire_request=acquire_request)
 
     class Meta:
         verbose_name = "HIT"
@@ -530,7 +664,37 @@ class HIT(models.Model):
         return u"HIT: %s" % self.mturk_id
 
 
-class Assignment(models.Model):
+def get_hit_status_key(hit_id):
+    return "hit-status:%s" % hit_id
+
+
+def cache_hit_status(hit):
+    '''cache_hit_status keeps the status of a HIT, as last read from Amazon,
+    for the worker facing views. It expires after two refresh intervals.
+    '''
+    caches["mturk"].set(get_hit_status_key(hit.id), hit.status,
+                        2 * settings.HIT_REFRESH_INTERVAL)
+
+
+def get_hit_status(hit):
+    '''get_hit_status returns the status of a HIT without contacting Amazon,
+    and whether it is fresh. The cached status is fresh, when it has expired
+    the status saved with the HIT by the last refresh is returned. When the
+    cache can't be read (eg, redis is down) the saved status is returned as
+    fresh, so that serving the HIT doesn't queue a refresh through it.
+    :param hit: the HIT object
+    '''
+    try:
+        status = caches["mturk"].get(get_hit_status_key(hit.id))
+    except RedisError as e:
+        logger.warning("HIT status cache unavailable: %s", e)
+        return hit.status, True
+    if status is None:
+        return hit.status, False
+    return status, True
+
+
+class Assignment(ChangedFieldsMixin, models.Model):
     '''An Amazon Mechanical Turk Assignment'''
 
     (_SUBMITTED, _APPROVED, _REJECTED) = ("Submitted", "Approved", "Rejected")
@@ -586,6 +750,14 @@ class Assignment(models.Model):
         default=False,
         verbose_name="participant completed the entire assignment")
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["hit", "status"],
+                         name="assignment_hit_status_idx"),
+            models.Index(fields=["mturk_id"],
+                         name="assignment_mturk_id_idx"),
+        ]
+
     def create(self):
         init_connection_callback(sender=self.hit)
 
@@ -623,24 +795,14 @@ class Assignment(models.Model):
 
         This instance's attributes are updated.
         """
-        self.hit.generate_connection()
-        assignment = None
-
         if mturk_assignment is None:
-            hit = self.hit.connection.get_hit(self.hit.mturk_id)[0]
-            for a in self.hit.connection.get_assignments(hit.HITId):
-                # While we have the query, we may as well update
-                if a.AssignmentId == self.mturk_id:
-                    # That's this record. Hold onto so we can update below
-                    assignment = a
-                else:
-                    other_assignments = Assignment.objects.filter(
-                        mturk_id=a.AssignmentId)
-                    # Amazon can reuse Assignment ids, so there is an
-                    # occasional duplicate
-                    for other_assignment in other_assignments:
-                        if other_assignment.worker_id == a.WorkerId:
-                            other_assignment.update(a)
+            # While we have the listing, we may as well update all of the HIT
+            if self.pk is None:
+                self.save()
+            sync_assignments(self.hit)
+            self.refresh_from_db()
+            self.reset_changed_fields()
+            return
         else:
             assert isinstance(
                 mturk_assignment,
@@ -649,7 +811,7 @@ class Assignment(models.Model):
 
         if assignment is not None:
             self.status = self.reverse_status_lookup[assignment.AssignmentStatus]
-            self.worker_id = get_worker(assignment.WorkerId)
+            self.worker = get_worker(assignment.WorkerId)
             self.submit_time = amazon_string_to_datetime(assignment.SubmitTime)
             self.accept_time = amazon_string_to_datetime(assignment.AcceptTime)
             self.auto_approval_time = amazon_string_to_datetime(
@@ -674,11 +836,158 @@ class Assignment(models.Model):
     __str__ = __unicode__
 
 
-class Result(models.Model):
-    '''A result holds a battery id and an experiment template, to keep track of the battery/experiment combinations that a worker has completed'''
-    taskdata = JSONField(
-        null=True, blank=True, load_kwargs={
-            'object_pairs_hook': collections.OrderedDict})
+# ASSIGNMENT SYNC ##########################################################
+
+# The largest page size of the GetAssignmentsForHIT operation
+MTURK_MAX_PAGE_SIZE = 100
+
+
+def get_amazon_time(amazon_string):
+    '''get_amazon_time returns the datetime of an Amazon (UTC) timestamp,
+    timezone aware when the project uses time zones, so that it compares
+    equal to the value read back from the database'''
+    value = amazon_string_to_datetime(amazon_string)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def get_assignment_values(mturk_assignment):
+    '''get_assignment_values returns the Assignment field values of a boto
+    assignment from an Amazon listing
+    :param mturk_assignment: the boto.mturk.connection.Assignment
+    '''
+    values = {"status": Assignment.reverse_status_lookup[
+                  mturk_assignment.AssignmentStatus],
+              "worker_id": mturk_assignment.WorkerId,
+              "accept_time": get_amazon_time(mturk_assignment.AcceptTime),
+              "submit_time": get_amazon_time(mturk_assignment.SubmitTime),
+              "auto_approval_time": get_amazon_time(
+                  mturk_assignment.AutoApprovalTime)}
+    # Different response groups for query
+    if hasattr(mturk_assignment, 'RejectionTime'):
+        values["rejection_time"] = get_amazon_time(
+            mturk_assignment.RejectionTime)
+    if hasattr(mturk_assignment, 'ApprovalTime'):
+        values["approval_time"] = get_amazon_time(mturk_assignment.ApprovalTime)
+    return values
+
+
+def sync_assignments(hit, page_size=None, acquire_request=None):
+    '''sync_assignments updates the Assignments of a HIT from Amazon. All
+    assignments are listed with the largest page size, compared with the
+    rows of the HIT in memory, and the changes are written in one
+    transaction: missing workers and assignments with bulk_create (workers
+    one at a time if another request created some), changed assignments with
+    bulk_update. Returns a report with the number of
+    "api_calls" and "db_writes", and of assignments "created" and "updated".
+    :param hit: the HIT object
+    :param page_size: assignments per listing page, defaults to the maximum
+    :param acquire_request: called before each page after the first, returns
+    False if the request rate is used up, which raises RequestRateExceeded
+    before anything is written [optional]
+    '''
+    page_size = page_size or MTURK_MAX_PAGE_SIZE
+    report = {"api_calls": 0, "db_writes": 0, "created": 0, "updated": 0}
+    hit.generate_connection()
+
+    mturk_assignments = []
+    page_number = 1
+    while True:
+        page = hit.connection.get_assignments(hit.mturk_id,
+                                              page_size=page_size,
+                                              page_number=page_number)
+        report["api_calls"] += 1
+        mturk_assignments.extend(page)
+        if page_number * page_size >= int(page.TotalNumResults):
+            break
+        page_number += 1
+        if acquire_request is not None and not acquire_request():
+            raise RequestRateExceeded(hit.mturk_id)
+
+    with transaction.atomic():
+        existing = collections.defaultdict(list)
+        for assignment in hit.assignments.all():
+            existing[assignment.mturk_id].append(assignment)
+
+        worker_ids = set(a.WorkerId for a in mturk_assignments)
+        known_workers = set(Worker.objects.filter(
+            id__in=worker_ids).values_list("id", flat=True))
+        new_workers = [Worker(id=worker_id)
+                       for worker_id in sorted(worker_ids - known_workers)]
+        if new_workers:
+            try:
+                with transaction.atomic():
+                    Worker.objects.bulk_create(new_workers)
+                report["db_writes"] += 1
+            except IntegrityError:
+                # a worker was created meanwhile, eg by serving a HIT
+                for worker in new_workers:
+                    Worker.objects.get_or_create(id=worker.id)
+                report["db_writes"] += len(new_workers)
+
+        created = []
+        changed = []
+        changed_fields = set()
+        for mturk_assignment in mturk_assignments:
+            values = get_assignment_values(mturk_assignment)
+            # Amazon can reuse Assignment ids, so there is an occasional
+            # duplicate: only rows of the same (or no) worker are updated
+            assignments = [a for a in existing[mturk_assignment.AssignmentId]
+                           if a.worker_id in (None, values["worker_id"])]
+            if not existing[mturk_assignment.AssignmentId]:
+                created.append(Assignment(hit=hit,
+                                          mturk_id=mturk_assignment.AssignmentId,
+                                          **values))
+            for assignment in assignments:
+                for name, value in values.items():
+                    setattr(assignment, name, value)
+                fields = assignment.get_changed_fields()
+                if fields:
+                    changed.append(assignment)
+                    changed_fields.update(fields)
+
+        if created:
+            Assignment.objects.bulk_create(created)
+            report["db_writes"] += 1
+            report["created"] = len(created)
+        if changed:
+            report["db_writes"] += bulk_update(changed, sorted(changed_fields),
+                                               batch_size=page_size)
+            report["updated"] = len(changed)
+    return report
+
+
+class ResultQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, batch_size=None):
+        '''bulk_create also writes the ResultData of the results that were
+        given taskdata, which needs the ids of the new results: a database
+        that doesn't return them (eg sqlite) can't bulk create results with
+        taskdata, and raises ValueError rather than lose it'''
+        objs = list(objs)
+        with_data = [obj for obj in objs
+                     if obj.__dict__.get("_taskdata_changed")]
+        features = connections[self.db].features
+        if with_data and not features.can_return_ids_from_bulk_insert:
+            raise ValueError("Results with taskdata can't be bulk created on "
+                             "%s, save them one at a time" % self.db)
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super(ResultQuerySet, self).bulk_create(
+                objs, batch_size=batch_size)
+            ResultData.objects.using(self.db).bulk_create([
+                ResultData(result_id=obj.id, taskdata=obj._taskdata)
+                for obj in with_data], batch_size=batch_size)
+        for obj in with_data:
+            del obj._taskdata_changed
+        return objs
+
+
+class Result(ChangedFieldsMixin, models.Model):
+    '''A result holds a battery id and an experiment template, to keep track of the battery/experiment combinations that a worker has completed.
+    The taskdata is kept in ResultData, and loaded when it is first read.
+    Results saved with save() or bulk_create() write their ResultData, an
+    update() of the queryset does not.'''
     version = models.CharField(
         max_length=128,
         null=True,
@@ -742,11 +1051,32 @@ class Result(models.Model):
              'Granted')),
         default=False,
         verbose_name="the function assign_experiment_credit has been run to allocate credit for this result")
+    processed = models.BooleanField(
+        choices=(
+            (False,
+             'Not processed'),
+            (True,
+             'Processed')),
+        default=False,
+        verbose_name="the completed result has been checked for blacklist, bonus and battery completion by process_completed_result")
+
+    objects = ResultQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Result"
         verbose_name_plural = "Results"
         unique_together = ("worker", "assignment", "battery", "experiment")
+        # the lookups of serving, syncing, credit and exports
+        indexes = [
+            models.Index(fields=["worker", "battery", "completed"],
+                         name="result_worker_battery_idx"),
+            models.Index(fields=["worker", "completed"],
+                         name="result_worker_completed_idx"),
+            models.Index(fields=["battery", "completed", "experiment"],
+                         name="result_battery_completed_idx"),
+            models.Index(fields=["battery", "experiment"],
+                         name="result_battery_exp_idx"),
+        ]
 
     def __repr__(self):
         return u"Result: id[%s],worker[%s],battery[%s],experiment[%s]" % (
@@ -756,12 +1086,682 @@ class Result(models.Model):
         return u"Result: id[%s],worker[%s],battery[%s],experiment[%s]" % (
             self.id, self.worker, self.battery, self.experiment)
 
+    @property
+    def taskdata(self):
+        '''taskdata is read from the ResultData of the result on first access
+        (or from select_related("data")), and None if it has none'''
+        if "_taskdata" not in self.__dict__:
+            try:
+                self._taskdata = self.data.taskdata
+            except ResultData.DoesNotExist:
+                self._taskdata = None
+        return self._taskdata
+
+    @taskdata.setter
+    def taskdata(self, taskdata):
+        self._taskdata = taskdata
+        self._taskdata_changed = True
+
+    def save(self, *args, **kwargs):
+        '''save writes the ResultData too, when taskdata was assigned'''
+        adding = self._state.adding
+        super(Result, self).save(*args, **kwargs)
+        if not self.__dict__.pop("_taskdata_changed", False):
+            return
+        if adding:
+            self.data = ResultData.objects.create(result=self,
+                                                  taskdata=self._taskdata)
+        else:
+            self.data, _ = ResultData.objects.update_or_create(
+                result=self, defaults={"taskdata": self._taskdata})
+
     def get_taskdata(self):
-        return to_dict(self.taskdata)
+        return to_dict(self.get_trials())
+
+    def get_trials(self):
+        '''get_trials returns the taskdata of the result, with the trials that
+        sync has appended as chunks since it was last assembled. A chunk
+        replaces the trials at its own indices, so a resent or overlapping
+        chunk does not duplicate trials, nor drop those after it.
+        '''
+        taskdata = self.taskdata
+        chunks = self.trial_chunks.order_by("start")
+        if self.id is None or not chunks.exists():
+            return taskdata
+        if not isinstance(taskdata, list):
+            taskdata = []
+        taskdata = list(taskdata)
+        for chunk in chunks:
+            taskdata[chunk.start:chunk.start + len(chunk.trials)] = chunk.trials
+        return taskdata
+
+    def append_trials(self, trials, start, current_trial=None):
+        '''append_trials stores the trials recorded since the last sync as a
+        new chunk, without rewriting the taskdata of the result. Requests can
+        arrive out of order: a chunk resent with the same start only replaces
+        a shorter one, and the current trial only moves forward.
+        :param trials: list of trials, the first has index start
+        :param start: index of the first trial in the full taskdata
+        :param current_trial: the current trial reported by the client
+        '''
+        with transaction.atomic():
+            chunk, created = ResultTrial.objects.select_for_update(
+            ).get_or_create(result=self, start=start,
+                            defaults={"trials": trials})
+            if not created and len(trials) > len(chunk.trials):
+                chunk.trials = trials
+                chunk.save()
+        if current_trial is not None:
+            Result.objects.filter(
+                Q(current_trial__isnull=True) |
+                Q(current_trial__lt=current_trial),
+                id=self.id).update(current_trial=current_trial)
+            if self.current_trial is None or \
+                    current_trial > self.current_trial:
+                self.current_trial = current_trial
+
+    def assemble_trials(self):
+        '''assemble_trials moves the appended trial chunks into taskdata and
+        removes them, done once when the result is finished. It should be
+        called in the transaction that saves the result.
+        '''
+        chunks = self.trial_chunks.all()
+        if chunks.exists():
+            self.taskdata = self.get_trials()
+            chunks.delete()
+
+
+class TaskDataField(JSONField):
+    '''TaskDataField is the JSON field of taskdata. It is stored as jsonb on
+    postgres, so that trial variables can be read in the database (see
+    get_trial_values), and as JSON text elsewhere. The field is the same for
+    every database, only its column type differs, so migrations don't
+    depend on the database they are made with.'''
+
+    def db_type(self, connection):
+        if connection.vendor == "postgresql":
+            return "jsonb"
+        return super(TaskDataField, self).db_type(connection)
+
+
+class ResultData(models.Model):
+    '''The taskdata of a result, the trials recorded by the experiment. It is
+    kept apart from Result so that the lookups of serving, syncing and credit
+    don't read it, and is only loaded by Result.taskdata.'''
+    result = models.OneToOneField(
+        Result,
+        primary_key=True,
+        related_name="data",
+        on_delete=models.CASCADE)
+    taskdata = TaskDataField(
+        null=True, blank=True, load_kwargs={
+            'object_pairs_hook': collections.OrderedDict})
+
+    class Meta:
+        verbose_name = "Result data"
+        verbose_name_plural = "Result data"
+
+    def __unicode__(self):
+        return u"ResultData: result[%s]" % self.result_id
+
+
+class ResultTrial(models.Model):
+    '''A chunk of trials sent by sync for a result that is in progress. Clients
+    only send the trials after the last sync, so the result taskdata is not
+    rewritten on every request. Chunks are assembled into Result.taskdata
+    when the result is finished.'''
+    result = models.ForeignKey(
+        Result,
+        related_name="trial_chunks",
+        on_delete=models.CASCADE)
+    start = models.PositiveIntegerField(
+        help_text="Index of the first trial of the chunk in the result taskdata")
+    trials = JSONField(
+        load_kwargs={'object_pairs_hook': collections.OrderedDict})
+
+    class Meta:
+        verbose_name = "Result trials"
+        verbose_name_plural = "Result trials"
+        unique_together = ("result", "start")
+
+    def __unicode__(self):
+        return u"ResultTrial: result[%s],start[%s]" % (self.result_id,
+                                                       self.start)
+
+
+# TRIAL VARIABLES ######################################################
+
+# summaries of the numeric (and boolean, as 0 or 1) values of a trial
+# variable, and their aggregate on postgres
+TRIAL_SUMMARIES = collections.OrderedDict([
+    ("mean", "avg(%s)"),
+    ("median", "percentile_cont(0.5) WITHIN GROUP (ORDER BY %s)"),
+    ("sum", "sum(%s)"),
+    ("max", "max(%s)"),
+    ("min", "min(%s)"),
+])
+
+# the trials of the taskdata of the results, with the value of the variable
+# in each trial that has it. A trialdata value wins over a trial level one,
+# as in the exports, and taskdata that isn't a list of trials has none. An
+# element of the taskdata whose trialdata is a list of trials (the older
+# layout) is expanded into them, as in turk.utils.iter_trials.
+TRIAL_VALUES_SQL = """
+SELECT data.result_id,
+       CASE WHEN trials.trial -> 'trialdata' ? %%s
+            THEN trials.trial -> 'trialdata' -> %%s
+            ELSE trials.trial -> %%s END AS value,
+       elements.number AS element_number,
+       trials.number AS trial_number
+FROM turk_resultdata data,
+     jsonb_array_elements(CASE WHEN jsonb_typeof(data.taskdata) = 'array'
+                          THEN data.taskdata ELSE '[]'::jsonb END)
+         WITH ORDINALITY AS elements (element, number),
+     jsonb_array_elements(
+         CASE WHEN jsonb_typeof(elements.element -> 'trialdata') = 'array'
+              THEN elements.element -> 'trialdata'
+              ELSE jsonb_build_array(elements.element) END)
+         WITH ORDINALITY AS trials (trial, number)
+WHERE data.result_id IN (%s)
+  AND jsonb_typeof(trials.trial) = 'object'
+  AND (trials.trial -> 'trialdata' ? %%s OR trials.trial ? %%s)
+"""
+
+
+def get_trial_values_sql(results, variable_name):
+    '''get_trial_values_sql returns TRIAL_VALUES_SQL for results, a queryset
+    of Result or a list of ids, with its parameters'''
+    if hasattr(results, "query"):
+        ids_sql, ids_params = results.values("id").query.sql_with_params()
+    else:
+        ids_params = [int(result_id) for result_id in results] or [None]
+        ids_sql = ", ".join(["%s"] * len(ids_params))
+    params = [variable_name] * 3 + list(ids_params) + [variable_name] * 2
+    return TRIAL_VALUES_SQL % ids_sql, params
+
+
+def get_trial_values(results, variable_name):
+    '''get_trial_values returns the values of a trial variable in the taskdata
+    of results, as a dictionary of result id to values in trial order. Results
+    without the variable are left out. On postgres the values are extracted in
+    the database with jsonb_array_elements, elsewhere the taskdata is read in
+    python, one result at a time.
+    :param results: a queryset of turk.models.Result, or a list of result ids
+    :param variable_name: the name of the variable, eg "rt"
+    '''
+    values = collections.OrderedDict()
+    if connection.vendor == "postgresql":
+        sql, params = get_trial_values_sql(results, variable_name)
+        with connection.cursor() as cursor:
+            cursor.execute(sql + "ORDER BY 1, 3, 4", params)
+            for result_id, value, _, _ in cursor.fetchall():
+                values.setdefault(result_id, []).append(value)
+        return values
+
+    datas = ResultData.objects.filter(result_id__in=results)
+    for data in datas.order_by("result_id").iterator():
+        for trial in iter_trials(data.taskdata):
+            found, value = get_trial_value(trial, variable_name)
+            if found:
+                values.setdefault(data.result_id, []).append(value)
+    return values
+
+
+def summarize_trial_values(results, variable_name, summary):
+    '''summarize_trial_values returns a summary of the numeric and boolean
+    values of a trial variable for each result, as a dictionary of result id to summary.
+    On postgres the summary is aggregated in the database.
+    :param results: a queryset of turk.models.Result, or a list of result ids
+    :param variable_name: the name of the variable, eg "rt"
+    :param summary: one of TRIAL_SUMMARIES, eg "mean"
+    '''
+    summaries = collections.OrderedDict()
+    if connection.vendor == "postgresql":
+        sql, params = get_trial_values_sql(results, variable_name)
+        aggregate = TRIAL_SUMMARIES[summary] % (
+            "CASE jsonb_typeof(value) WHEN 'boolean' "
+            "THEN (value #>> '{}')::boolean::int::numeric "
+            "ELSE (value #>> '{}')::numeric END")
+        sql = "SELECT result_id, %s FROM (%s) trial_values " \
+              "WHERE jsonb_typeof(value) IN ('number', 'boolean') " \
+              "GROUP BY result_id ORDER BY result_id" % (aggregate, sql)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for result_id, value in cursor.fetchall():
+                summaries[result_id] = float(value)
+        return summaries
+
+    for result_id, values in get_trial_values(results, variable_name).items():
+        values = get_summary_values(values)
+        if values:
+            summaries[result_id] = float(getattr(numpy, summary)(values))
+    return summaries
+
+
+# Partial indexes aren't supported by Meta.indexes in this Django version,
+# they are created after migrate on postgres. Completed results are a small
+# part of the table while batteries are running, and what exports and
+# credit read.
+PARTIAL_INDEXES = [
+    ("result_completed_idx", "turk_result",
+     ["battery_id", "experiment_id", "worker_id"], "completed"),
+]
+
+
+def create_partial_indexes(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    '''create_partial_indexes is connected to post_migrate, and creates the
+    PARTIAL_INDEXES that don't exist yet on postgres'''
+    if sender.label != "turk":
+        return
+    db = connections[using]
+    if db.vendor != "postgresql":
+        return
+    with db.cursor() as cursor:
+        for name, table, columns, condition in PARTIAL_INDEXES:
+            cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s) WHERE %s" % (
+                name, table, ", ".join(columns), condition))
+
+
+post_migrate.connect(create_partial_indexes)
+
+
+# Result.taskdata used to be a column of turk_result. The migration made
+# on deploy creates turk_resultdata and drops the column in one step, so the
+# column is copied to a holding table before migrate, and from there into
+# turk_resultdata after it, by the move_result_taskdata command that
+# run_uwsgi.sh calls around migrate. Both steps do nothing once the column
+# is gone.
+TASKDATA_HOLDING_TABLE = "turk_result_taskdata_copy"
+
+
+def get_table_columns(db, table):
+    with db.cursor() as cursor:
+        return [column.name for column in
+                db.introspection.get_table_description(cursor, table)]
+
+
+def hold_result_taskdata(using=DEFAULT_DB_ALIAS):
+    '''hold_result_taskdata copies the taskdata column of turk_result, while
+    it exists, to the holding table. Returns the number of results held, or
+    None if there is no column to copy.
+    :param using: the database alias
+    '''
+    db = connections[using]
+    if "turk_result" not in db.introspection.table_names() or \
+            "taskdata" not in get_table_columns(db, "turk_result"):
+        return None
+    with transaction.atomic(using=using), db.cursor() as cursor:
+        if TASKDATA_HOLDING_TABLE in db.introspection.table_names():
+            cursor.execute("DROP TABLE %s" % TASKDATA_HOLDING_TABLE)
+        cursor.execute(
+            "CREATE TABLE %s AS SELECT id AS result_id, taskdata FROM "
+            "turk_result WHERE taskdata IS NOT NULL" % TASKDATA_HOLDING_TABLE)
+        cursor.execute("SELECT COUNT(*) FROM %s" % TASKDATA_HOLDING_TABLE)
+        return cursor.fetchone()[0]
+
+
+def restore_result_taskdata(using=DEFAULT_DB_ALIAS):
+    '''restore_result_taskdata copies the held taskdata of the results that
+    have no ResultData yet into turk_resultdata, then drops the holding
+    table. Returns the number of results restored, or None if nothing was
+    held.
+    :param using: the database alias
+    '''
+    db = connections[using]
+    tables = db.introspection.table_names()
+    if TASKDATA_HOLDING_TABLE not in tables or "turk_resultdata" not in tables:
+        return None
+    taskdata = "held.taskdata"
+    if db.vendor == "postgresql":
+        taskdata = "held.taskdata::jsonb"
+    with transaction.atomic(using=using), db.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO turk_resultdata (result_id, taskdata) "
+            "SELECT held.result_id, %s FROM %s held "
+            "JOIN turk_result result ON result.id = held.result_id "
+            "WHERE NOT EXISTS (SELECT 1 FROM turk_resultdata data "
+            "WHERE data.result_id = held.result_id)" % (
+                taskdata, TASKDATA_HOLDING_TABLE))
+        restored = cursor.rowcount
+        cursor.execute("DROP TABLE %s" % TASKDATA_HOLDING_TABLE)
+    return restored
+
+
+class BatteryVariableIndex(models.Model):
+    '''An index of the trial variables in the completed results of an experiment
+    in a battery. It is updated as results are completed, so export headers
+    and the list of experiments with results don't need a scan of taskdata'''
+    battery = models.ForeignKey(
+        Battery,
+        related_name="variable_indices",
+        null=False,
+        blank=False)
+    experiment = models.ForeignKey(
+        ExperimentTemplate,
+        help_text="An experiment with completed results in the battery",
+        null=False,
+        blank=False)
+    variables = JSONField(
+        null=True,
+        blank=True,
+        help_text="sorted list of trial variable names in completed results")
+
+    class Meta:
+        verbose_name = "Battery Variable Index"
+        verbose_name_plural = "Battery Variable Indices"
+        unique_together = ("battery", "experiment")
+
+    def __unicode__(self):
+        return "<%s_%s>" % (self.battery, self.experiment_id)
+
+
+def update_variable_index(result):
+    '''update_variable_index adds the trial variables of a completed result to
+    the index for its battery and experiment. The index row is locked while
+    it is updated, so results finishing at the same time don't lose variables.
+    :param result: a completed turk.models.Result
+    '''
+    variables = get_trial_variables(result.taskdata)
+    with transaction.atomic():
+        index, _ = BatteryVariableIndex.objects.select_for_update().get_or_create(
+            battery_id=result.battery_id, experiment_id=result.experiment_id)
+        current = set(index.variables or [])
+        if index.variables is None or not variables.issubset(current):
+            index.variables = sorted(current | variables)
+            index.save()
+    return index
+
+
+def rebuild_variable_index(battery, experiment_id):
+    '''rebuild_variable_index recomputes the index for an experiment in a
+    battery from all of its completed results, reading one taskdata at a time.
+    The index is removed if the experiment has no completed results.
+    :param battery: the experiments.models.Battery
+    :param experiment_id: the exp_id of the ExperimentTemplate
+    '''
+    results = Result.objects.filter(battery=battery,
+                                    experiment_id=experiment_id,
+                                    completed=True)
+    variables = set()
+    found = False
+    for taskdata in results.values_list("data__taskdata",
+                                        flat=True).iterator():
+        variables.update(get_trial_variables(load_json(taskdata)))
+        found = True
+
+    if not found:
+        BatteryVariableIndex.objects.filter(
+            battery=battery, experiment_id=experiment_id).delete()
+        return None
+    index, _ = BatteryVariableIndex.objects.update_or_create(
+        battery=battery, experiment_id=experiment_id,
+        defaults={"variables": sorted(variables)})
+    return index
+
+
+def get_battery_variables(battery, experiment_tags=None):
+    '''get_battery_variables returns the sorted union of trial variables in the
+    completed results of a battery, from the variable index
+    :param experiment_tags: only include these experiment exp_ids [optional]
+    '''
+    indices = BatteryVariableIndex.objects.filter(battery=battery)
+    if experiment_tags is not None:
+        indices = indices.filter(experiment_id__in=experiment_tags)
+    variables = set()
+    for names in indices.values_list("variables", flat=True):
+        variables.update(load_json(names) or [])
+    return sorted(variables)
+
+
+def get_battery_experiments(battery):
+    '''get_battery_experiments returns the sorted exp_ids of experiments with
+    completed results in a battery. Experiments with results that are not
+    indexed yet (eg, before the index_battery_variables command is run) are
+    indexed first, and indices of experiments left without results removed.
+    '''
+    completed = set(Result.objects.filter(
+        battery=battery, completed=True).order_by().values_list(
+        "experiment_id", flat=True).distinct())
+    indexed = set(BatteryVariableIndex.objects.filter(
+        battery=battery).values_list("experiment_id", flat=True))
+    for exp_id in completed ^ indexed:
+        rebuild_variable_index(battery, exp_id)
+    return sorted(completed)
+
+
+def remove_hit(hit):
+    '''remove_hit deletes a HIT with its assignments and their results, and
+    updates the variable index of the experiments that lost results, and the
+    progress of workers in the battery
+    :param hit: the turk.models.HIT
+    '''
+    experiment_ids = set(Result.objects.filter(
+        assignment__hit=hit).order_by().values_list(
+        "experiment_id", flat=True).distinct())
+    hit.delete()
+    for exp_id in experiment_ids:
+        rebuild_variable_index(hit.battery, exp_id)
+    if experiment_ids:
+        rebuild_battery_progress(hit.battery)
+
+
+class CompletedBattery(models.Model):
+    '''A battery a worker has completed, with a completed result for every
+    experiment in it. It is recorded as results are completed, so battery
+    dependencies are checked without reading the worker's results'''
+    worker = models.ForeignKey(
+        Worker,
+        related_name="completed_batteries",
+        null=False,
+        blank=False)
+    battery = models.ForeignKey(
+        Battery,
+        related_name="completed_by",
+        null=False,
+        blank=False)
+    completion_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Completed Battery"
+        verbose_name_plural = "Completed Batteries"
+        unique_together = ("worker", "battery")
+
+    def __unicode__(self):
+        return "<%s_%s>" % (self.worker_id, self.battery_id)
+
+
+class WorkerBatteryProgress(ChangedFieldsMixin, models.Model):
+    '''The progress of a worker in a battery: the experiments completed, the
+    number remaining and the last experiment served. It is updated as
+    results are completed, so serving and syncing don't read the worker's
+    results'''
+    worker = models.ForeignKey(
+        Worker,
+        related_name="battery_progress",
+        null=False,
+        blank=False)
+    battery = models.ForeignKey(
+        Battery,
+        related_name="worker_progress",
+        null=False,
+        blank=False)
+    completed_experiments = JSONField(
+        default=list,
+        help_text="sorted exp_ids of the battery experiments completed")
+    remaining = models.PositiveIntegerField(
+        default=0,
+        help_text="number of battery experiments not completed")
+    last_experiment = models.ForeignKey(
+        ExperimentTemplate,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        help_text="the experiment last served to the worker")
+
+    class Meta:
+        verbose_name = "Worker Battery Progress"
+        verbose_name_plural = "Worker Battery Progress"
+        unique_together = ("worker", "battery")
+
+    def __unicode__(self):
+        return "<%s_%s>" % (self.worker_id, self.battery_id)
+
+    @property
+    def finished(self):
+        return self.remaining == 0
+
+
+def get_battery_templates(battery_id):
+    '''get_battery_templates returns the set of exp_ids in a battery'''
+    return set(Battery.experiments.through.objects.filter(
+        battery_id=battery_id).values_list("experiment__template_id",
+                                           flat=True))
+
+
+def set_progress(progress, completed, battery_templates):
+    '''set_progress sets the completed experiments of a progress row, keeping
+    those in the battery, and the number remaining
+    '''
+    completed = set(completed) & battery_templates
+    if progress.completed_experiments != sorted(completed):
+        progress.completed_experiments = sorted(completed)
+    progress.remaining = len(battery_templates - completed)
+    return progress
+
+
+def rebuild_worker_progress(worker_id, battery_id, battery_templates=None):
+    '''rebuild_worker_progress computes the progress of a worker in a battery
+    from their completed results, and records a completed battery
+    '''
+    if battery_templates is None:
+        battery_templates = get_battery_templates(battery_id)
+    completed = Result.objects.filter(
+        worker_id=worker_id, battery_id=battery_id,
+        completed=True).values_list("experiment_id", flat=True)
+    with transaction.atomic():
+        progress, _ = WorkerBatteryProgress.objects.select_for_update(
+        ).get_or_create(worker_id=worker_id, battery_id=battery_id)
+        set_progress(progress, completed, battery_templates)
+        progress.save()
+        if progress.finished and battery_templates:
+            CompletedBattery.objects.get_or_create(worker_id=worker_id,
+                                                   battery_id=battery_id)
+    return progress
+
+
+def get_worker_progress(worker, battery):
+    '''get_worker_progress returns the progress of a worker in a battery, it
+    is computed from their results the first time
+    :param worker: the Worker object
+    :param battery: the Battery object
+    '''
+    try:
+        return WorkerBatteryProgress.objects.get(worker=worker,
+                                                 battery=battery)
+    except WorkerBatteryProgress.DoesNotExist:
+        return rebuild_worker_progress(worker.id, battery.id)
+
+
+def update_worker_progress(result):
+    '''update_worker_progress adds the experiment of a completed result to
+    the progress of its worker in the battery. The progress row is locked
+    while it is updated, and the battery is recorded as completed by the
+    worker when no experiments remain.
+    :param result: a completed turk.models.Result, already saved
+    '''
+    if result.worker_id is None or result.battery_id is None:
+        return None
+    battery_templates = get_battery_templates(result.battery_id)
+    with transaction.atomic():
+        try:
+            progress = WorkerBatteryProgress.objects.select_for_update().get(
+                worker_id=result.worker_id, battery_id=result.battery_id)
+        except WorkerBatteryProgress.DoesNotExist:
+            return rebuild_worker_progress(result.worker_id,
+                                           result.battery_id,
+                                           battery_templates)
+        set_progress(progress,
+                     set(progress.completed_experiments) |
+                     set([result.experiment_id]),
+                     battery_templates)
+        progress.save()
+        if progress.finished and battery_templates:
+            CompletedBattery.objects.get_or_create(
+                worker_id=result.worker_id, battery_id=result.battery_id)
+    return progress
+
+
+def set_last_experiment(progress, template):
+    '''set_last_experiment records the experiment served to a worker, it is
+    only written when it changes
+    '''
+    if progress.last_experiment_id != template.pk:
+        progress.last_experiment = template
+        progress.save()
+
+
+def rebuild_battery_progress(battery):
+    '''rebuild_battery_progress recomputes the progress of every worker in a
+    battery from their results, and the workers that completed it, eg after
+    its experiments were changed. Returns the number of workers that
+    completed the battery.
+    :param battery: the experiments.models.Battery
+    '''
+    battery_templates = get_battery_templates(battery.id)
+    worker_templates = collections.defaultdict(set)
+    for worker_id, template_id in Result.objects.filter(
+            battery=battery, completed=True).values_list(
+            "worker_id", "experiment_id").iterator():
+        if worker_id is not None:
+            worker_templates[worker_id].add(template_id)
+
+    with transaction.atomic():
+        changed = []
+        for progress in WorkerBatteryProgress.objects.select_for_update(
+        ).filter(battery=battery):
+            set_progress(progress, worker_templates.pop(progress.worker_id,
+                                                        set()),
+                         battery_templates)
+            if progress.get_changed_fields():
+                changed.append(progress)
+        bulk_update(changed, ["completed_experiments", "remaining"])
+        WorkerBatteryProgress.objects.bulk_create([
+            set_progress(WorkerBatteryProgress(worker_id=worker_id,
+                                               battery=battery),
+                         templates, battery_templates)
+            for worker_id, templates in worker_templates.items()])
+
+        completed = []
+        if battery_templates:
+            completed = list(WorkerBatteryProgress.objects.filter(
+                battery=battery, remaining=0).values_list("worker_id",
+                                                          flat=True))
+        CompletedBattery.objects.filter(battery=battery).exclude(
+            worker_id__in=completed).delete()
+        existing = set(CompletedBattery.objects.filter(
+            battery=battery).values_list("worker_id", flat=True))
+        CompletedBattery.objects.bulk_create([
+            CompletedBattery(worker_id=worker_id, battery=battery)
+            for worker_id in completed if worker_id not in existing])
+    return len(completed)
 
 
 class Bonus(models.Model):
-    '''A bonus object keeps track of a users bonuses for a battery'''
+    '''A bonus object keeps track of a users bonuses for a battery, and of
+    its payout: queued (pending), claimed by pay_bonuses (sending), and paid,
+    failed, or unknown when a payout was interrupted and may have been made'''
+    PENDING = "P"
+    SENDING = "S"
+    PAID = "G"
+    FAILED = "F"
+    UNKNOWN = "U"
+    PAYOUT_STATUS_CHOICES = (
+        (PENDING, "Pending payout"),
+        (SENDING, "Sending payout"),
+        (PAID, "Paid"),
+        (FAILED, "Payout failed"),
+        (UNKNOWN, "Payout interrupted, check with Amazon"),
+    )
     worker = models.ForeignKey(
         Worker,
         null=False,
@@ -789,10 +1789,35 @@ class Bonus(models.Model):
         default=False,
         help_text="Participant bonus status",
         verbose_name="bonus status")
+    assignment = models.ForeignKey(
+        Assignment,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        help_text="The assignment the bonus is paid for")
+    payout_status = models.CharField(
+        max_length=1,
+        choices=PAYOUT_STATUS_CHOICES,
+        null=True,
+        blank=True,
+        help_text="Status of the payout of the bonus")
+    payout_attempts = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of payouts of the bonus sent to Amazon")
+    payout_time = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="The date and time the payout was last queued or claimed")
 
     def __unicode__(self):
         return "<%s_%s>" % (self.battery, self.worker)
 
+    @property
+    def payout_key(self):
+        '''payout_key is the idempotency key of the payout of the bonus, a
+        bonus is paid at most once'''
+        return "bonus-%s" % self.id
+
     def calculate_bonus(self):
         if self.amounts is not None:
             amounts = dict(self.amounts)
@@ -807,6 +1832,41 @@ class Bonus(models.Model):
         verbose_name = "Bonus"
         verbose_name_plural = "Bonuses"
         unique_together = ("worker", "battery")
+        indexes = [
+            models.Index(fields=["payout_status", "payout_time"],
+                         name="bonus_payout_idx"),
+        ]
+
+
+class BonusPayment(models.Model):
+    '''A ledger entry for an attempt to pay a bonus: the idempotency key of the
+    payout, the amount, and whether Amazon paid it, refused it (with the
+    error), or the outcome is unknown'''
+    PAID = "G"
+    ERROR = "E"
+    UNKNOWN = "U"
+    STATUS_CHOICES = ((PAID, "Paid"),
+                      (ERROR, "Error"),
+                      (UNKNOWN, "Unknown"))
+    bonus = models.ForeignKey(
+        Bonus,
+        related_name="payments",
+        on_delete=models.CASCADE)
+    key = models.CharField(
+        max_length=64,
+        db_index=True,
+        help_text="Idempotency key of the payout, see Bonus.payout_key")
+    amount = models.FloatField(help_text="The amount, in dollars")
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES)
+    error = models.TextField(null=True, blank=True)
+    time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Bonus payment"
+        verbose_name_plural = "Bonus payments"
+
+    def __unicode__(self):
+        return u"BonusPayment: key[%s],status[%s]" % (self.key, self.status)
 
 
 class Blacklist(models.Model):
@@ -848,3 +1908,133 @@ class Blacklist(models.Model):
         verbose_name = "Blacklist"
         verbose_name_plural = "Blacklists"
         unique_together = ("worker", "battery")
+
+
+# ASSIGNMENT REVIEW ####################################################
+
+# filters of the assignments of a review, with their choices. The first
+# choice is the default.
+REVIEW_FILTERS = collections.OrderedDict([
+    ("status", [Assignment.SUBMITTED, Assignment.APPROVED,
+                Assignment.REJECTED]),
+    ("blacklist", ["any", "blacklisted", "not_blacklisted"]),
+    ("bonus", ["any", "none", "unpaid", "paid"]),
+])
+
+
+def get_review_filters(data):
+    '''get_review_filters returns the assignment filters of a review from
+    request data, with the defaults of REVIEW_FILTERS. Raises ValidationError
+    for an unknown choice.
+    :param data: a dictionary like request.POST
+    '''
+    filters = dict()
+    for name, choices in REVIEW_FILTERS.items():
+        value = data.get(name) or choices[0]
+        if value not in choices:
+            raise ValidationError("Unknown %s filter %s" % (name, value))
+        filters[name] = value
+    return filters
+
+
+def get_review_assignments(battery, hit=None, filters=None):
+    '''get_review_assignments returns the assignments of the HITs of a battery,
+    or of one HIT, that pass the review filters: their status, whether the
+    worker is blacklisted from the battery, and the state of the bonus of the
+    worker in the battery (none, not yet paid, or paid)
+    :param battery: the battery of the HITs
+    :param hit: only review the assignments of this HIT [optional]
+    :param filters: see get_review_filters, defaults to submitted assignments
+    '''
+    filters = filters or get_review_filters({})
+    assignments = Assignment.objects.filter(hit__battery=battery,
+                                            status=filters["status"])
+    if hit is not None:
+        assignments = assignments.filter(hit=hit)
+
+    if filters["blacklist"] != "any":
+        blacklisted = Blacklist.objects.filter(
+            worker_id=OuterRef("worker_id"), battery=battery, active=True)
+        assignments = assignments.annotate(
+            blacklisted=Exists(blacklisted)).filter(
+                blacklisted=filters["blacklist"] == "blacklisted")
+
+    if filters["bonus"] != "any":
+        bonuses = Bonus.objects.filter(worker_id=OuterRef("worker_id"),
+                                       battery=battery)
+        if filters["bonus"] == "none":
+            assignments = assignments.annotate(
+                bonused=Exists(bonuses)).filter(bonused=False)
+        else:
+            assignments = assignments.annotate(bonused=Exists(
+                bonuses.filter(granted=filters["bonus"] == "paid"))).filter(
+                    bonused=True)
+    return assignments
+
+
+class ReviewJob(models.Model):
+    '''A review job approves or rejects a set of assignments of a battery (or
+    one of its HITs) in the background, see review_assignments. The
+    assignments are selected with filters when the job is made.
+    '''
+    (APPROVE, REJECT) = ("approve", "reject")
+    ACTION_CHOICES = (
+        (APPROVE, "Approve"),
+        (REJECT, "Reject"),
+    )
+    (PENDING, RUNNING, FINISHED, FAILED) = (
+        "PENDING", "RUNNING", "FINISHED", "FAILED")
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (FINISHED, "Finished"),
+        (FAILED, "Failed"),
+    )
+
+    battery = models.ForeignKey(Battery, related_name="review_jobs")
+    hit = models.ForeignKey(HIT, null=True, blank=True,
+                            related_name="review_jobs")
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    feedback = models.TextField(
+        null=True, blank=True, help_text="message to the workers")
+    filters = JSONField(
+        null=True, blank=True, help_text="filters of the assignments")
+    assignments = JSONField(
+        null=True, blank=True, help_text="ids of the assignments to review")
+    owner = models.ForeignKey(User, null=True, blank=True)
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=PENDING)
+    assignment_count = models.PositiveIntegerField(
+        default=0, help_text="The number of assignments to review")
+    assignments_reviewed = models.PositiveIntegerField(
+        default=0, help_text="The number of assignments reviewed so far")
+    assignments_failed = models.PositiveIntegerField(
+        default=0, help_text="The number of assignments Amazon didn't review")
+    failures = JSONField(
+        null=True, blank=True,
+        help_text="dictionary of assignment ids with their error")
+    error = models.TextField(null=True, blank=True)
+    add_date = models.DateTimeField('date requested', auto_now_add=True)
+    modify_date = models.DateTimeField('date modified', auto_now=True)
+
+    def __unicode__(self):
+        return "<%s_%s_%s>" % (self.battery, self.action, self.id)
+
+    def get_absolute_url(self):
+        return reverse('review_job_status', args=[str(self.id)])
+
+    def is_stale(self):
+        '''a pending or running job that hasn't changed for
+        MTURK_REVIEW_LEASE seconds was lost, eg its worker was killed'''
+        lease = datetime.timedelta(seconds=settings.MTURK_REVIEW_LEASE)
+        return self.status in [self.PENDING, self.RUNNING] and \
+            self.modify_date < timezone.now() - lease
+
+    def get_progress(self):
+        if self.status == self.FINISHED or self.assignment_count == 0:
+            return 100
+        return min(100, int(100.0 * (self.assignments_reviewed +
+                                     self.assignments_failed) /
+                            self.assignment_count))
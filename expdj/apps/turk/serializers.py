@@ -5,7 +5,6 @@ from expdj.apps.experiments.models import (Battery, CognitiveAtlasTask,
 from expdj.apps.experiments.serializers import (BatteryDescriptionSerializer,
                                                 ExperimentTemplateSerializer)
 from expdj.apps.turk.models import Result, Worker
-from expdj.apps.turk.utils import to_dict
 
 
 class BatterySerializer(serializers.HyperlinkedModelSerializer):
@@ -47,7 +46,7 @@ class ResultSerializer(serializers.HyperlinkedModelSerializer):
     data = serializers.SerializerMethodField('get_taskdata')
 
     def get_taskdata(self, result):
-        return to_dict(result.taskdata)
+        return result.get_taskdata()
 
     class Meta:
         model = Result
@@ -1,20 +1,40 @@
 from __future__ import absolute_import
 
+import logging
 import os
+import random
+import socket
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
-import numpy
+from boto.exception import BotoClientError, BotoServerError
 from boto.mturk.price import Price
 from celery import Celery, shared_task
+from celery.exceptions import MaxRetriesExceededError
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
 #  trying to import Result object directly from models was giving an import
 #  error here, even though the import matched views.py exactly.
 from expdj.apps import turk
-from expdj.apps.experiments.models import Battery, ExperimentTemplate
-from expdj.apps.experiments.utils import get_experiment_type
-from expdj.apps.turk.models import (HIT, Assignment, Blacklist, Bonus, Result,
-                                    get_worker)
+from expdj.apps.experiments.models import (Battery, ExperimentTemplate,
+                                           ExportJob)
+from expdj.apps.experiments.utils import (get_experiment_type,
+                                          write_results_export)
+from expdj.apps.turk.credit import (evaluate_result, evaluate_variables,
+                                    get_result_experiment)
+from expdj.apps.turk.models import (HIT, Assignment, Blacklist, Bonus,
+                                    BonusPayment, CompletedBattery,
+                                    RequestRateExceeded, Result,
+                                    ReviewJob, WorkerBatteryProgress,
+                                    get_trial_values, get_worker,
+                                    rebuild_worker_progress)
+from expdj.apps.turk.utils import (discard_connection, get_connection,
+                                   get_credentials)
 from expdj.settings import TURK
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'expdj.settings')
@@ -22,17 +42,219 @@ app = Celery('expdj')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def update_assignments(hit_id):
-    '''update_assignments updates all assignment (status, etc) from Amazon given a hit_id
+
+# REFRESH SCHEDULING
+# Refreshes of a HIT from Amazon are coalesced: one is queued only when none
+# is queued or running for the HIT (a lease, released when the task ends or
+# runs out of retries), and the last one ended more than its minimum
+# interval ago. Tasks share a global MTurk request rate, one slot per
+# request, and back off when it is used up.
+
+def get_refresh_keys(kind, hit_id):
+    return ("hit-refresh-lease:%s:%s" % (kind, hit_id),
+            "hit-refreshed:%s:%s" % (kind, hit_id))
+
+
+def schedule_refresh(task, kind, hit_id):
+    '''schedule_refresh queues task for a HIT, unless a refresh of the same
+    kind is in flight or ended less than its interval ago. Returns True if
+    the task was queued.
+    :param task: the refresh task, called with the HIT id
+    :param kind: "status" or "assignments"
+    :param hit_id: HIT id from turk.models
+    '''
+    lease, refreshed = get_refresh_keys(kind, hit_id)
+    cache = caches["mturk"]
+    if cache.get(refreshed) is not None:
+        return False
+    if not cache.add(lease, True, settings.HIT_REFRESH_LEASE):
+        return False
+    task.apply_async([hit_id])
+    return True
+
+
+def finish_refresh(kind, hit_id):
+    '''finish_refresh releases the lease of a refresh, and starts its
+    minimum interval'''
+    lease, refreshed = get_refresh_keys(kind, hit_id)
+    cache = caches["mturk"]
+    cache.set(refreshed, True, settings.HIT_REFRESH_INTERVALS[kind])
+    cache.delete(lease)
+
+
+def retry_refresh(task, kind, hit_id):
+    '''retry_refresh retries a refresh task with backoff, keeping its lease.
+    The lease is released if the task has no retries left, so the next
+    refresh can be queued.
+    :param task: the bound refresh task
+    '''
+    try:
+        raise task.retry(countdown=get_backoff(task.request.retries))
+    except MaxRetriesExceededError:
+        caches["mturk"].delete(get_refresh_keys(kind, hit_id)[0])
+        raise
+
+
+def schedule_hit_refresh(hit):
+    '''schedule_hit_refresh queues a refresh of the HIT status
+    :param hit: the HIT object
+    '''
+    return schedule_refresh(refresh_hit, "status", hit.id)
+
+
+def schedule_assignments_refresh(hit):
+    '''schedule_assignments_refresh queues a sync of the HIT assignments
+    :param hit: the HIT object
+    '''
+    return schedule_refresh(update_assignments, "assignments", hit.id)
+
+
+def acquire_mturk_request(now=None):
+    '''acquire_mturk_request counts a request to Amazon in the current one
+    second window, shared by all processes through the mturk cache, and
+    returns False if MTURK_REQUESTS_PER_SECOND were already made
+    '''
+    if now is None:
+        now = time.time()
+    key = "mturk-requests:%s" % int(now)
+    cache = caches["mturk"]
+    cache.add(key, 0, 2)
+    try:
+        count = cache.incr(key)
+    except ValueError:  # the window expired in between
+        cache.add(key, 1, 2)
+        count = 1
+    return count <= settings.MTURK_REQUESTS_PER_SECOND
+
+
+def wait_mturk_request(timeout):
+    '''wait_mturk_request waits up to timeout seconds for a request to Amazon
+    within the request rate (see acquire_mturk_request), for the calls made
+    from a thread pool. Returns False if the rate stayed used up.
+    '''
+    deadline = time.time() + timeout
+    while not acquire_mturk_request():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def get_backoff(retries):
+    '''get_backoff returns the countdown (seconds) of a task retried when the
+    request rate is used up: exponential, capped, with jitter'''
+    return min(2 ** retries, settings.MTURK_BACKOFF_MAX) + random.random()
+
+
+@shared_task(bind=True, max_retries=settings.MTURK_MAX_RETRIES)
+def refresh_hit(self, hit_id):
+    '''refresh_hit updates a HIT from Amazon, which caches its status for
+    the worker facing views
     :param hit_id: HIT id from turk.models
     '''
+    if not acquire_mturk_request():
+        retry_refresh(self, "status", hit_id)
+    hit = None
     try:
         hit = HIT.objects.get(id=hit_id)
-        hit.update_assignments()
+        hit.update()
+    except HIT.DoesNotExist:
+        return
     except BaseException:
+        # don't hand a connection that failed to the next task
+        discard_connection(getattr(hit, "connection", None))
+        raise
+    finally:
+        finish_refresh("status", hit_id)
+
+
+@shared_task
+def refresh_active_hits():
+    '''refresh_active_hits is run by celery beat to refresh the status and
+    assignments of every HIT that has not been disposed
+    '''
+    for hit in HIT.objects.exclude(status=HIT.DISPOSED).only("id"):
+        schedule_hit_refresh(hit)
+        schedule_assignments_refresh(hit)
+
+
+@shared_task(bind=True, max_retries=settings.MTURK_MAX_RETRIES)
+def update_assignments(self, hit_id):
+    '''update_assignments updates all assignment (status, etc) from Amazon given a hit_id.
+    Each page of the listing takes a request slot, and the sync is retried if
+    the rate stays used up
+    :param hit_id: HIT id from turk.models
+    '''
+    if not acquire_mturk_request():
+        retry_refresh(self, "assignments", hit_id)
+
+    def acquire_page_request():
+        return wait_mturk_request(settings.MTURK_PAGE_RATE_WAIT)
+
+    report = None
+    hit = None
+    try:
+        hit = HIT.objects.get(id=hit_id)
+        report = hit.update_assignments(acquire_request=acquire_page_request)
+    except RequestRateExceeded:
+        retry_refresh(self, "assignments", hit_id)
+    except HIT.DoesNotExist:
         pass
+    except (BotoClientError, BotoServerError, socket.error) as e:
+        # the next refresh syncs the HIT again, over a new connection
+        logger.warning("The assignments of HIT %s were not synced: %r",
+                       hit_id, e)
+        discard_connection(getattr(hit, "connection", None))
+    except Exception:
+        finish_refresh("assignments", hit_id)
+        raise
+    finish_refresh("assignments", hit_id)
+    return report
+
+
+def claim_export_job(job_id):
+    '''claim_export_job marks a pending, or stale running, ExportJob as
+    running. Returns False if another run has it.'''
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.EXPORT_JOB_LEASE)
+    return ExportJob.objects.filter(
+        Q(status=ExportJob.PENDING) |
+        Q(status=ExportJob.RUNNING, modify_date__lt=stale),
+        id=job_id).update(status=ExportJob.RUNNING, results_written=0,
+                          error=None, modify_date=now) > 0
+
+
+@shared_task
+def export_results(job_id):
+    '''export_results writes the results file for an ExportJob, updating the job
+    progress as results are written. A job that already has its file is not
+    written again, and a failed or stale job can be enqueued again. A job is
+    run by one task at a time.
+    :param job_id: the id of the experiments.models.ExportJob
+    '''
+    job = ExportJob.objects.get(id=job_id)
+    if job.is_ready() or not claim_export_job(job_id):
+        return
+
+    def update_progress(count):
+        if count % 100 == 0:
+            ExportJob.objects.filter(id=job.id).update(
+                results_written=count, modify_date=timezone.now())
+
+    try:
+        write_results_export(job.battery, job.output_file,
+                             experiment_tags=job.experiment_tags,
+                             export_format=job.export_format,
+                             callback=update_progress)
+    except BaseException as e:
+        ExportJob.objects.filter(id=job.id).update(
+            status=ExportJob.FAILED, error=str(e))
+        return
+
+    ExportJob.objects.filter(id=job.id).update(
+        status=ExportJob.FINISHED, results_written=job.result_count)
 
 
 @shared_task
@@ -60,69 +282,71 @@ def assign_experiment_credit(worker_id):
                 grant_bonus(result.id)
 
 
+@shared_task
+def process_completed_result(result_id):
+    '''process_completed_result runs the checks of a completed result once: the
+    rejection and bonus credit conditions of its experiment (evaluated
+    together, see turk.credit) and, if the worker has finished the battery,
+    assign_experiment_credit. The result is marked processed in the
+    transaction of the checks, so running the task again for the same result
+    (eg for a repeated sync, or a retry) does nothing.
+    :param result_id: the id of the completed turk.models.Result
+    '''
+    with transaction.atomic():
+        claimed = Result.objects.filter(id=result_id, completed=True,
+                                        processed=False).update(processed=True)
+        if not claimed:
+            return False
+        result = Result.objects.select_related(
+            "worker", "battery", "experiment").get(id=result_id)
+        experiment = get_result_experiment(result)
+        if experiment is not None:
+            outcome = evaluate_result(result, experiment)
+            if outcome.rejection is not None:
+                record_rejection(result, experiment, outcome.rejection)
+            if outcome.bonuses:
+                record_bonuses(result, experiment, outcome.bonuses)
+        finished_battery = WorkerBatteryProgress.objects.filter(
+            worker_id=result.worker_id, battery_id=result.battery_id,
+            remaining=0).exists()
+
+    if finished_battery:
+        assign_experiment_credit.apply_async([result.worker_id], countdown=60)
+    return True
+
+
 @shared_task
 def check_blacklist(result_id):
     '''check_blacklist compares a result (associated with an experiment) against
     the rejection criteria, and adds a flag to the user/battery blacklist object
     in the case of a violation. When the user/battery blacklist flag count
     exceeds the battery.blacklist_threshold, the user is blacklisted.
+    Completed results are checked by process_completed_result.
     :param result: a turk.models.Result object
     '''
-
-    result = Result.objects.get(id=result_id)
-    worker = result.worker
-    battery = result.battery
-    experiment_template = result.experiment
-    experiment = [b for b in battery.experiments.all() if b.template ==
-                  experiment_template]
-
-    if len(experiment) > 0:
-        experiment = experiment[0]
-
-        # rejection criteria
-        do_catch = True if experiment_template.rejection_variable is not None and experiment.include_catch else False
-        do_blacklist = battery.blacklist_active
-        found_violation = False
-
-        if result.completed and do_catch and do_blacklist:
-
-            # A credit condition can be for reward or rejection
-            for credit_condition in experiment.credit_conditions.all():
-                variable_name = credit_condition.variable.name
-                variables = get_variables(result, variable_name)
-                func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0]
-                        == credit_condition.operator][0]
-                func_description = [
-                    x[0] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-
-                # Look through variables and determine if in violation of
-                # condition
-                for variable in variables:
-                    comparator = credit_condition.value
-                    if isinstance(variable, bool):
-                        comparator = bool(comparator)
-                    elif isinstance(variable, float) or isinstance(variable, int):
-                        variable = float(variable)
-                    if not isinstance(
-                        comparator,
-                        bool) and (
-                        isinstance(
-                            comparator,
-                            float) or isinstance(
-                            comparator,
-                            int)):
-                        comparator = float(comparator)
-
-                    # If the variable passes criteria and it's a rejection
-                    # variable
-                    if func(variable, comparator):
-                        if credit_condition.variable == experiment_template.rejection_variable and found_violation == False:
-                            found_violation = True
-                            description = "%s %s %s %s" % (
-                                variable_name, variable, func_description, comparator)
-                            blacklist, _ = Blacklist.objects.get_or_create(
-                                worker=worker, battery=battery)
-                            add_blacklist(blacklist, experiment, description)
+    result = Result.objects.select_related(
+        "worker", "battery", "experiment").get(id=result_id)
+    experiment = get_result_experiment(result)
+    if experiment is None:
+        return
+
+    outcome = evaluate_result(result, experiment, bonus=False)
+    if outcome.rejection is not None:
+        record_rejection(result, experiment, outcome.rejection)
+
+
+def record_rejection(result, experiment, description):
+    '''record_rejection adds a flag for a result to the blacklist of its worker
+    in the battery. The blacklist row is locked while it is updated, so the
+    flags of results finishing at the same time are not lost.
+    :param result: a turk.models.Result
+    :param experiment: experiments.models.Experiment
+    :param description: the description of the violated condition
+    '''
+    with transaction.atomic():
+        blacklist, _ = Blacklist.objects.select_for_update().get_or_create(
+            worker=result.worker, battery=result.battery)
+        add_blacklist(blacklist, experiment, description)
 
 
 def add_blacklist(blacklist, experiment, description):
@@ -163,81 +387,58 @@ def get_bonus_reason(bonus):
 
 
 def grant_bonus(result_id):
-    '''grant_bonus will calculate and grant a total bonus for a worker
+    '''grant_bonus queues the total bonus of a worker in the battery of a
+    result for payout, for the assignment of the result (see pay_bonuses)
     :param result_id: the id the result to grant the bonus for
     '''
-    result = Result.objects.get(id=result_id)
-    worker = result.worker
-    battery = result.battery
-    result.assignment.hit.generate_connection()
+    result = Result.objects.select_related("assignment").get(id=result_id)
     try:
-        bonus = Bonus.objects.get(worker=worker, battery=battery)
-        amount = bonus.calculate_bonus()
-        price = Price(amount)
-        reason = get_bonus_reason(bonus)
-        result.assignment.hit.connection.grant_bonus(
-            worker.id, result.assignment.mturk_id, price, reason)
-        bonus.granted = True
-        bonus.save()
+        bonus = Bonus.objects.get(worker_id=result.worker_id,
+                                  battery_id=result.battery_id)
     except Bonus.DoesNotExist:
-        pass
+        return False
+    if queue_bonus_payout(bonus, result.assignment):
+        schedule_bonus_payouts()
+        return True
+    return False
 
 
 @shared_task
 def experiment_reward(result_id):
     '''experiment_reward will record bonus based on satisfying some criteria
     The final bonus will be allocated at the end of the battery, after
-    a result is submit, with grant_bonus. This function currently has code
-    similar to check_blacklist, and the two are separate as this is expected
-    to change
+    a result is submit, with grant_bonus. The conditions are evaluated with
+    the same engine as check_blacklist (see turk.credit). Completed results
+    are rewarded by process_completed_result.
     :result_id: the id of the result object, turk.models.Result
     '''
-
-    # Look up all result objects for worker
-    result = Result.objects.get(id=result_id)
-    battery = result.battery
-    worker = result.worker
-    experiment_template = result.experiment
-    experiment = [b for b in battery.experiments.all() if b.template ==
-                  experiment_template]
-
-    if len(experiment) > 0:
-        experiment = experiment[0]
-
-        do_bonus = True if experiment_template.performance_variable is not None and experiment.include_bonus else False
-        bonus_active = battery.bonus_active
-
-        if result.completed and do_bonus and bonus_active:
-            for credit_condition in experiment.credit_conditions.all():
-                variable_name = credit_condition.variable.name
-                variables = get_variables(result, variable_name)
-                func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0]
-                        == credit_condition.operator][0]
-                func_description = [
-                    x[0] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-
-                # Look through variables and determine if passes condition
-                for variable in variables:
-                    comparator = credit_condition.value
-                    if isinstance(variable, bool):
-                        comparator = bool(comparator)
-                    elif isinstance(variable, float) or isinstance(variable, int):
-                        variable = float(variable)
-                        comparator = float(comparator)
-
-                    # If the variable passes criteria and it's a performance
-                    # variable
-                    if func(variable, comparator):
-                        if credit_condition.variable == experiment_template.performance_variable:
-                            description = "%s %s %s %s" % (
-                                variable_name, variable, func_description, comparator)
-                            bonus, _ = Bonus.objects.get_or_create(
-                                worker=worker, battery=battery)
-                            if credit_condition.amount is not None:
-                                add_bonus(
-                                    bonus, experiment, description, credit_condition.amount)
-                                result.credit_granted = True
-                                result.save()
+    result = Result.objects.select_related(
+        "worker", "battery", "experiment").get(id=result_id)
+    experiment = get_result_experiment(result)
+    if experiment is None:
+        return
+
+    outcome = evaluate_result(result, experiment, rejection=False)
+    if outcome.bonuses:
+        record_bonuses(result, experiment, outcome.bonuses)
+
+
+def record_bonuses(result, experiment, bonuses):
+    '''record_bonuses adds the bonuses of a result to the bonus of its worker
+    in the battery, and marks the result credit granted. The bonus row is
+    locked while it is updated, so the amounts of results finishing at the
+    same time are not lost.
+    :param result: a turk.models.Result
+    :param experiment: experiments.models.Experiment
+    :param bonuses: a list of (amount, description) of the conditions met
+    '''
+    with transaction.atomic():
+        bonus, _ = Bonus.objects.select_for_update().get_or_create(
+            worker=result.worker, battery=result.battery)
+        for amount, description in bonuses:
+            add_bonus(bonus, experiment, description, amount)
+        result.credit_granted = True
+        result.save()
 
 
 def add_bonus(bonus, experiment, description, amount):
@@ -261,121 +462,365 @@ def add_bonus(bonus, experiment, description, amount):
     bonus.save()
 
 
+# BONUS PAYOUTS
+# Bonuses are paid from a queue: grant_bonus marks the bonus of a worker
+# pending, and pay_bonuses claims batches of pending bonuses and pays them
+# from a thread pool, each thread over its own pooled connection of the HIT,
+# within the shared MTurk request rate. Every payout sent is recorded in the
+# BonusPayment ledger. A bonus is paid at most once: one that was claimed but
+# whose outcome was never recorded (eg the worker was killed) is marked
+# unknown, to be checked with Amazon, and not sent again.
+
+BONUS_PAYOUTS_QUEUED = "bonus-payouts-queued"
+BONUS_PAYOUTS_RUNNING = "bonus-payouts-running"
+
+
+def queue_bonus_payout(bonus, assignment):
+    '''queue_bonus_payout marks a bonus pending payout for an assignment,
+    unless its payout was already queued. Returns True if it was queued.
+    :param bonus: turk.models.Bonus
+    :param assignment: the turk.models.Assignment paid for
+    '''
+    if assignment is None:
+        return False
+    return Bonus.objects.filter(
+        id=bonus.id, payout_status__isnull=True, granted=False).update(
+            payout_status=Bonus.PENDING, assignment=assignment,
+            payout_time=timezone.now()) > 0
+
+
+def schedule_bonus_payouts(countdown=None):
+    '''schedule_bonus_payouts queues pay_bonuses, unless a run is already
+    queued. Returns True if it was queued.
+    '''
+    if not caches["mturk"].add(BONUS_PAYOUTS_QUEUED, True,
+                               settings.MTURK_PAYOUT_LEASE):
+        return False
+    pay_bonuses.apply_async(countdown=countdown)
+    return True
+
+
+def expire_bonus_payouts(now=None):
+    '''expire_bonus_payouts marks the payouts claimed more than
+    MTURK_PAYOUT_LEASE seconds ago, and never recorded, as unknown'''
+    if now is None:
+        now = timezone.now()
+    expired = Bonus.objects.filter(
+        payout_status=Bonus.SENDING,
+        payout_time__lt=now - timedelta(seconds=settings.MTURK_PAYOUT_LEASE))
+    for bonus in expired:
+        BonusPayment.objects.create(
+            bonus=bonus, key=bonus.payout_key, amount=bonus.calculate_bonus(),
+            status=BonusPayment.UNKNOWN,
+            error="the payout was interrupted, it may have been paid")
+        Bonus.objects.filter(id=bonus.id, payout_status=Bonus.SENDING).update(
+            payout_status=Bonus.UNKNOWN)
+
+
+def claim_bonus_payouts(limit):
+    '''claim_bonus_payouts marks up to limit pending bonuses as sending, and
+    returns them with their worker, assignment and HIT. Bonuses claimed by
+    another run are skipped.
+    '''
+    with transaction.atomic():
+        ids = list(Bonus.objects.select_for_update(skip_locked=True).filter(
+            payout_status=Bonus.PENDING).order_by(
+                "payout_time", "id").values_list("id", flat=True)[:limit])
+        Bonus.objects.filter(id__in=ids).update(
+            payout_status=Bonus.SENDING, payout_time=timezone.now())
+    return list(Bonus.objects.filter(id__in=ids).select_related(
+        "assignment__hit__battery", "worker").order_by("id"))
+
+
+def get_thread_connection(hit):
+    '''get_thread_connection returns the pooled connection of a HIT for the
+    current thread, for the calls made from a thread pool: boto connections
+    are not shared between threads, and hit.connection is left alone. The
+    battery of the HIT should already be loaded.
+    '''
+    aws_access_key_id, aws_secret_access_key = get_credentials(
+        battery=hit.battery)
+    return get_connection(aws_access_key_id, aws_secret_access_key, hit=hit)
+
+
+def send_bonus_payout(payout):
+    '''send_bonus_payout runs in the payout thread pool, and sends a payout
+    to Amazon within the shared request rate, over the connection of the
+    thread. Returns the status for the ledger, with the error, or None if
+    the payout wasn't sent.
+    :param payout: a (bonus, amount, reason) tuple
+    '''
+    bonus, amount, reason = payout
+    try:
+        connection = get_thread_connection(bonus.assignment.hit)
+    except Exception as e:
+        # nothing was sent
+        return BonusPayment.ERROR, repr(e)
+    if not wait_mturk_request(settings.MTURK_PAYOUT_RATE_WAIT):
+        return None, "the MTurk request rate was used up"
+    try:
+        connection.grant_bonus(bonus.worker_id, bonus.assignment.mturk_id,
+                               Price(amount), reason)
+    except BotoServerError as e:
+        # Amazon answered, the bonus was not paid
+        return BonusPayment.ERROR, "%s %s %s" % (e.status, e.reason, e.body)
+    except Exception as e:
+        return BonusPayment.UNKNOWN, repr(e)
+    return BonusPayment.PAID, None
+
+
+def record_bonus_payout(bonus, amount, status, error):
+    '''record_bonus_payout writes the outcome of a payout to the ledger and
+    the bonus. A payout that Amazon refused is pending again, until it has
+    been sent MTURK_PAYOUT_MAX_ATTEMPTS times.
+    '''
+    values = {}
+    if status is not None:
+        BonusPayment.objects.create(bonus=bonus, key=bonus.payout_key,
+                                    amount=amount, status=status, error=error)
+        values["payout_attempts"] = F("payout_attempts") + 1
+    if status == BonusPayment.PAID:
+        values.update(payout_status=Bonus.PAID, granted=True)
+    elif status == BonusPayment.UNKNOWN:
+        values["payout_status"] = Bonus.UNKNOWN
+    elif status is None or \
+            bonus.payout_attempts + 1 < settings.MTURK_PAYOUT_MAX_ATTEMPTS:
+        values["payout_status"] = Bonus.PENDING
+    else:
+        values["payout_status"] = Bonus.FAILED
+    Bonus.objects.filter(id=bonus.id).update(**values)
+    return values["payout_status"]
+
+
+@shared_task
+def pay_bonuses():
+    '''pay_bonuses pays a batch of pending bonuses (MTURK_PAYOUT_BATCH_SIZE),
+    MTURK_PAYOUT_CONCURRENCY at a time, and queues itself again while bonuses
+    are pending. One run pays at a time. Returns the number of bonuses paid.
+    '''
+    cache = caches["mturk"]
+    cache.delete(BONUS_PAYOUTS_QUEUED)
+    if not cache.add(BONUS_PAYOUTS_RUNNING, True, settings.MTURK_PAYOUT_LEASE):
+        return 0
+
+    retry = False
+    paid = 0
+    try:
+        expire_bonus_payouts()
+        bonuses = claim_bonus_payouts(settings.MTURK_PAYOUT_BATCH_SIZE)
+        # a key that is in the ledger as paid (or maybe paid) is not sent
+        sent = dict(BonusPayment.objects.filter(
+            key__in=[b.payout_key for b in bonuses],
+            status__in=[BonusPayment.PAID, BonusPayment.UNKNOWN]).values_list(
+                "key", "status"))
+        payouts = []
+        for bonus in bonuses:
+            amount = bonus.calculate_bonus()
+            if bonus.payout_key in sent:
+                Bonus.objects.filter(id=bonus.id).update(
+                    payout_status=Bonus.PAID
+                    if sent[bonus.payout_key] == BonusPayment.PAID
+                    else Bonus.UNKNOWN)
+            elif bonus.assignment is None or amount <= 0:
+                Bonus.objects.filter(id=bonus.id).update(payout_status=None)
+            else:
+                payouts.append((bonus, amount, get_bonus_reason(bonus)))
+
+        outcomes = []
+        if payouts:
+            pool = ThreadPool(min(settings.MTURK_PAYOUT_CONCURRENCY,
+                                  len(payouts)))
+            try:
+                outcomes = pool.map(send_bonus_payout, payouts)
+            finally:
+                pool.close()
+                pool.join()
+
+        for (bonus, amount, _), (status, error) in zip(payouts, outcomes):
+            payout_status = record_bonus_payout(bonus, amount, status, error)
+            paid += payout_status == Bonus.PAID
+            retry = retry or payout_status == Bonus.PENDING
+    finally:
+        cache.delete(BONUS_PAYOUTS_RUNNING)
+
+    if Bonus.objects.filter(payout_status=Bonus.PENDING).exists():
+        schedule_bonus_payouts(countdown=get_backoff(1) if retry else None)
+    return paid
+
+
+# ASSIGNMENT REVIEW
+# A review job approves or rejects the assignments selected for it in
+# batches, from a thread pool, each thread over its own pooled connection of
+# the HIT, within the shared MTurk request rate. The assignments reviewed
+# are updated locally after each batch, with the progress of the job, and
+# each HIT is synced once at the end, to reconcile them with Amazon. A job
+# that stopped changing for MTURK_REVIEW_LEASE seconds (eg its worker was
+# killed) is stale, and enqueued again when its status is requested.
+
+def send_review(review):
+    '''send_review runs in the review thread pool, and approves or rejects an
+    assignment on Amazon over the connection of the thread. Returns None, or
+    the error.
+    :param review: a (assignment, action, feedback) tuple
+    '''
+    assignment, action, feedback = review
+    try:
+        connection = get_thread_connection(assignment.hit)
+    except Exception as e:
+        return repr(e)
+    if not wait_mturk_request(settings.MTURK_REVIEW_RATE_WAIT):
+        return "the MTurk request rate was used up"
+    try:
+        if action == ReviewJob.APPROVE:
+            connection.approve_assignment(assignment.mturk_id,
+                                          feedback=feedback)
+        else:
+            connection.reject_assignment(assignment.mturk_id,
+                                         feedback=feedback)
+    except BotoServerError as e:
+        return "%s %s %s" % (e.status, e.reason, e.body)
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+def claim_review_job(job_id):
+    '''claim_review_job marks a pending, or stale running, ReviewJob as
+    running. Returns False if another run has it.'''
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.MTURK_REVIEW_LEASE)
+    return ReviewJob.objects.filter(
+        Q(status=ReviewJob.PENDING) |
+        Q(status=ReviewJob.RUNNING, modify_date__lt=stale),
+        id=job_id).update(status=ReviewJob.RUNNING, modify_date=now) > 0
+
+
+@shared_task
+def review_assignments(job_id):
+    '''review_assignments approves or rejects the assignments of a ReviewJob,
+    MTURK_REVIEW_BATCH_SIZE at a time, updating the job progress after each
+    batch. Assignments no longer in the status they were selected with are
+    skipped, so a stale job resumes where it stopped. A job is run by one
+    task at a time.
+    :param job_id: the id of the turk.models.ReviewJob
+    '''
+    if not claim_review_job(job_id):
+        return
+    job = ReviewJob.objects.get(id=job_id)
+    status = Assignment.APPROVED
+    if job.action == ReviewJob.REJECT:
+        status = Assignment.REJECTED
+
+    reviewed = job.assignments_reviewed
+    failures = dict()
+    hits = dict()
+    try:
+        assignments = list(Assignment.objects.filter(
+            id__in=job.assignments or [],
+            status=(job.filters or {}).get("status", Assignment.SUBMITTED)
+        ).select_related("hit__battery").order_by("id"))
+        ReviewJob.objects.filter(id=job.id).update(
+            assignment_count=reviewed + len(assignments),
+            assignments_failed=0, failures=None, modify_date=timezone.now())
+        for assignment in assignments:
+            hits[assignment.hit_id] = assignment.hit
+
+        pool = ThreadPool(settings.MTURK_REVIEW_CONCURRENCY)
+        try:
+            batch_size = settings.MTURK_REVIEW_BATCH_SIZE
+            for start in range(0, len(assignments), batch_size):
+                batch = assignments[start:start + batch_size]
+                errors = pool.map(send_review, [
+                    (assignment, job.action, job.feedback)
+                    for assignment in batch])
+                done = []
+                for assignment, error in zip(batch, errors):
+                    if error is None:
+                        done.append(assignment.id)
+                    else:
+                        failures[assignment.mturk_id] = error
+                Assignment.objects.filter(id__in=done).update(status=status)
+                reviewed += len(done)
+                ReviewJob.objects.filter(id=job.id).update(
+                    assignments_reviewed=reviewed,
+                    assignments_failed=len(failures), failures=failures,
+                    modify_date=timezone.now())
+        finally:
+            pool.close()
+            pool.join()
+    except BaseException as e:
+        ReviewJob.objects.filter(id=job.id).update(
+            status=ReviewJob.FAILED, error=str(e), modify_date=timezone.now())
+        return
+
+    error = None
+    for hit in hits.values():
+        try:
+            hit.update_assignments()
+        except BaseException as e:
+            error = "The assignments of HIT %s were not synced: %s" % (
+                hit.mturk_id, e)
+    ReviewJob.objects.filter(id=job.id).update(
+        status=ReviewJob.FINISHED, error=error, modify_date=timezone.now())
+
+
 # EXPERIMENT RESULT PARSING helper functions
-def get_unique_experiments(results):
-    experiments = []
-    for result in results:
-        if result.completed:
-            experiments.append(result.experiment.exp_id)
-    return numpy.unique(experiments).tolist()
+
+def is_experiment(result):
+    # Surveys and games not yet implemented
+    return get_experiment_type(result.experiment) == "experiments"
 
 
 def get_variables(result, variable_name):
-    # First try looking for variable as it is
-    variables = find_variable(result, variable_name)
-    summary_funcs = {"avg": numpy.mean,
-                     "mean": numpy.mean,
-                     "average": numpy.mean,
-                     "med": numpy.median,
-                     "median": numpy.median,
-                     "sum": numpy.sum,
-                     "total": numpy.sum,
-                     "max": numpy.max,
-                     "min": numpy.min}
-
-    # Did the user specify a summary statistic?
-    if len(variables) == 0:
-        summary_func = variable_name.split("_")[0].lower()
-        if summary_func in summary_funcs.keys():
-            name = ["_".join(variable_name.split("_")[1:])][0]
-            summary_func = summary_funcs[summary_func]
-            variables = find_variable(result, name)
-            variables = [summary_func(variables)]
-    return variables
+    '''get_variables returns the values of a variable expression in a result:
+    a trial variable (rt), or a summary of it (mean_rt, p95_rt, count_rt),
+    optionally over the trials that pass filters (mean_rt[correct==true]).
+    The expression is compiled once, see turk.credit.compile_variable.
+    :param result: a turk.models.Result
+    :param variable_name: the variable expression, eg "rt" or "mean_rt"
+    '''
+    if not is_experiment(result):
+        return []
+    column = evaluate_variables(result.taskdata, [variable_name])[variable_name]
+    return column.values
 
 
 def find_variable(result, variable_name):
-
-    # Surveys and games not yet implemented
-    experiment_type = get_experiment_type(result.experiment)
-    variables = []
-
-    # For experiments
-    if experiment_type == "experiments":
-        taskdata = result.taskdata
-        for trial in taskdata[0]["trialdata"]:
-            if variable_name in trial.keys():
-                variables.append(trial[variable_name])
-    return variables
-
-
-def get_unique_variables(results):
-    variables = []
-    for result in results:
-        if result.completed:
-            for trial in result.taskdata:
-                new_variables = [
-                    x for x in trial.keys() if x not in variables and x != "trialdata"]
-                variables = variables + new_variables
-                if "trialdata" in trial.keys():
-                    new_variables = [
-                        x for x in trial["trialdata"].keys() if x not in variables]
-                    variables = variables + new_variables
-    return numpy.unique(variables).tolist()
+    '''find_variable returns the values of a trial variable in a result, in
+    trial order
+    '''
+    if not is_experiment(result):
+        return []
+    return get_trial_values([result.id], variable_name).get(result.id, [])
 
 
 def check_battery_dependencies(current_battery, worker_id):
     '''
-    check_battery_dependencies looks up all of a workers completed
-    experiments in a result object and places them in a dictionary
-
-    organized by battery_id. Each of these buckets of results is
-    iterated through to check that every experiment in that battery has
-    been completed. In this way a list of batteries that a worker has
-    completed is built. This list is then compared to the lists of
-    required and restricted batteries to determine if the worker is
-    eligible to attempt the current battery.
-    '''
-    worker_results = turk.models.Result.objects.filter(
-        worker_id=worker_id,
-        completed=True
-    )
-
-    worker_result_batteries = {}
-    for result in worker_results:
-        if worker_result_batteries.get(result.battery.id):
-            worker_result_batteries[result.battery.id].append(result)
-        else:
-            worker_result_batteries[result.battery.id] = []
-            worker_result_batteries[result.battery.id].append(result)
-
-    worker_completed_batteries = []
-    for battery_id in worker_result_batteries:
-        result = worker_result_batteries[battery_id]
-        all_experiments_complete = True
-        result_experiment_list = [x.experiment_id for x in result]
-        try:
-            battery_experiments = Battery.objects.get(
-                id=battery_id).experiments.all()
-        except ObjectDoesNotExist:
-            #  battery may have been removed.
-            continue
-        for experiment in battery_experiments:
-            if experiment.template_id not in result_experiment_list:
-                all_experiments_complete = False
-                break
-        if all_experiments_complete:
-            worker_completed_batteries.append(battery_id)
-            continue
-
-    missing_batteries = []
-    for required_battery in current_battery.required_batteries.all():
-        if required_battery.id not in worker_completed_batteries:
-            missing_batteries.append(required_battery)
-
-    blocking_batteries = []
-    for restricted_battery in current_battery.restricted_batteries.all():
-        if restricted_battery.id in worker_completed_batteries:
-            blocking_batteries.append(restricted_battery)
+    check_battery_dependencies looks up the batteries that are required
+    for, or restricted from, the current battery, against the batteries the
+    worker has completed (turk.models.CompletedBattery). A list of missing
+    required batteries and a list of completed restricted (blocking)
+    batteries are returned, with one query each. The progress of the worker
+    in a dependency is first computed from their results if it was never
+    recorded, eg for results from before batteries were recorded.
+    '''
+    dependencies = Battery.objects.filter(
+        Q(id__in=current_battery.required_batteries.values("id")) |
+        Q(id__in=current_battery.restricted_batteries.values("id")))
+    unrecorded = Result.objects.filter(
+        worker_id=worker_id, completed=True,
+        battery_id__in=dependencies.values("id")).exclude(
+        battery_id__in=WorkerBatteryProgress.objects.filter(
+            worker_id=worker_id).values("battery_id")).values_list(
+        "battery_id", flat=True).distinct()
+    for battery_id in unrecorded:
+        rebuild_worker_progress(worker_id, battery_id)
+
+    completed = CompletedBattery.objects.filter(
+        worker_id=worker_id).values("battery_id")
+    missing_batteries = list(current_battery.required_batteries.exclude(
+        id__in=completed))
+    blocking_batteries = list(current_battery.restricted_batteries.filter(
+        id__in=completed))
 
     return missing_batteries, blocking_batteries
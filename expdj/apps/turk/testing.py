@@ -0,0 +1,206 @@
+'''A local stand-in for the boto MTurk connection, for tests.
+
+Point get_connection at it with
+
+    @override_settings(MTURK_CONNECTION_CLASS=
+                       "expdj.apps.turk.testing.LocalMTurkConnection")
+
+HITs and assignments are kept in memory on the class (every model instance
+makes its own connection), and each call that would have gone to Amazon
+is counted in LocalMTurkConnection.calls. Bonuses paid are kept in
+LocalMTurkConnection.bonuses, and a call can be made to fail with
+LocalMTurkConnection.fail.
+
+UnavailableCache stands in for a redis cache that can't be reached.
+'''
+
+import collections
+import datetime
+
+from boto.mturk.connection import HIT as MTurkHIT
+from boto.mturk.connection import Assignment as MTurkAssignment
+from boto.mturk.connection import ResultSet
+from django.core.cache.backends.base import BaseCache
+from redis.exceptions import ConnectionError
+
+AMAZON_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def amazon_time(when=None):
+    if when is None:
+        when = datetime.datetime.utcnow()
+    return when.strftime(AMAZON_TIME_FORMAT)
+
+
+class LocalMTurkConnection(object):
+    '''LocalMTurkConnection answers the MTurkConnection calls used by the
+    turk models from memory, and counts them'''
+
+    calls = collections.Counter()
+    hits = collections.OrderedDict()
+    assignments = collections.defaultdict(collections.OrderedDict)
+    bonuses = []
+    errors = dict()
+
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+                 host=None, debug=None, **kwargs):
+        self.aws_access_key_id = aws_access_key_id
+        self.host = host
+
+    @classmethod
+    def reset(cls):
+        cls.calls.clear()
+        cls.hits.clear()
+        cls.assignments.clear()
+        del cls.bonuses[:]
+        cls.errors.clear()
+
+    @classmethod
+    def fail(cls, name, error):
+        '''fail makes the calls of a name raise error, until reset'''
+        cls.errors[name] = error
+
+    @classmethod
+    def count(cls, name=None):
+        '''count returns the number of remote calls made (of one name)'''
+        if name is None:
+            return sum(cls.calls.values())
+        return cls.calls[name]
+
+    # In memory HITs and assignments ######################################
+
+    @classmethod
+    def add_hit(cls, hit_id, status="Assignable", **fields):
+        hit = MTurkHIT(None)
+        values = {"HITId": hit_id,
+                  "HITStatus": status,
+                  "HITTypeId": "HITTYPE",
+                  "Amount": "0.50",
+                  "AssignmentDurationInSeconds": "3600",
+                  "AutoApprovalDelayInSeconds": "2592000",
+                  "MaxAssignments": "1",
+                  "CreationTime": amazon_time(),
+                  "Description": "",
+                  "Title": "",
+                  "Keywords": ""}
+        values.update(fields)
+        for name, value in values.items():
+            setattr(hit, name, value)
+        cls.hits[hit_id] = hit
+        return hit
+
+    @classmethod
+    def add_assignment(cls, hit_id, assignment_id, worker_id,
+                       status="Submitted", **fields):
+        assignment = MTurkAssignment(None)
+        now = amazon_time()
+        values = {"AssignmentId": assignment_id,
+                  "HITId": hit_id,
+                  "WorkerId": worker_id,
+                  "AssignmentStatus": status,
+                  "AcceptTime": now,
+                  "SubmitTime": now,
+                  "AutoApprovalTime": now}
+        values.update(fields)
+        for name, value in values.items():
+            setattr(assignment, name, value)
+        cls.assignments[hit_id][assignment_id] = assignment
+        return assignment
+
+    def _find_assignment(self, assignment_id):
+        for assignments in self.assignments.values():
+            if assignment_id in assignments:
+                return assignments[assignment_id]
+        raise KeyError(assignment_id)
+
+    # MTurkConnection ######################################################
+
+    def get_hit(self, hit_id, response_groups=None):
+        self.calls["get_hit"] += 1
+        return [self.hits[hit_id]]
+
+    def create_hit(self, **kwargs):
+        self.calls["create_hit"] += 1
+        hit = self.add_hit("HIT%s" % (len(self.hits) + 1),
+                           Title=kwargs.get("title", ""),
+                           Description=kwargs.get("description", ""),
+                           Keywords=kwargs.get("keywords") or "",
+                           MaxAssignments=str(kwargs.get("max_assignments", 1)))
+        return [hit]
+
+    def get_assignments(self, hit_id, status=None, sort_by='SubmitTime',
+                        sort_direction='Ascending', page_size=10,
+                        page_number=1, response_groups=None):
+        self.calls["get_assignments"] += 1
+        self._raise("get_assignments")
+        assignments = list(self.assignments[hit_id].values())
+        if status is not None:
+            assignments = [a for a in assignments
+                           if a.AssignmentStatus == status]
+        start = (page_number - 1) * page_size
+        page = ResultSet()
+        page.extend(assignments[start:start + page_size])
+        page.PageNumber = str(page_number)
+        page.NumResults = str(len(page))
+        page.TotalNumResults = str(len(assignments))
+        return page
+
+    def _raise(self, name):
+        if name in self.errors:
+            raise self.errors[name]
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        self.calls["approve_assignment"] += 1
+        self._raise("approve_assignment")
+        self._find_assignment(assignment_id).AssignmentStatus = "Approved"
+        return True
+
+    def reject_assignment(self, assignment_id, feedback=None):
+        self.calls["reject_assignment"] += 1
+        self._raise("reject_assignment")
+        self._find_assignment(assignment_id).AssignmentStatus = "Rejected"
+        return True
+
+    def grant_bonus(self, worker_id, assignment_id, bonus_price, reason,
+                    unique_request_token=None):
+        self.calls["grant_bonus"] += 1
+        self._raise("grant_bonus")
+        self.bonuses.append((worker_id, assignment_id, bonus_price.amount))
+        return True
+
+    def expire_hit(self, hit_id):
+        self.calls["expire_hit"] += 1
+        return True
+
+    def extend_hit(self, hit_id, assignments_increment=None,
+                   expiration_increment=None):
+        self.calls["extend_hit"] += 1
+        return True
+
+    def set_reviewing(self, hit_id, revert=None):
+        self.calls["set_reviewing"] += 1
+        self.hits[hit_id].HITStatus = "Assignable" if revert else "Reviewing"
+        return True
+
+    def dispose_hit(self, hit_id):
+        self.calls["dispose_hit"] += 1
+        self.hits[hit_id].HITStatus = "Disposed"
+        return True
+
+    def notify_workers(self, worker_ids, subject, message_text):
+        self.calls["notify_workers"] += 1
+        return True
+
+
+class UnavailableCache(BaseCache):
+    '''UnavailableCache is a cache backend that fails every call, as a redis
+    cache does when the server can't be reached'''
+
+    def __init__(self, location, params):
+        super(UnavailableCache, self).__init__(params)
+
+    def unavailable(self, *args, **kwargs):
+        raise ConnectionError("Error connecting to redis")
+
+    add = get = set = delete = incr = get_many = delete_many = unavailable
+    clear = unavailable
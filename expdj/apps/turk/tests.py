@@ -1,21 +1,73 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import contextlib
 import datetime
+import json
+import logging
 import os
+import shutil
 import tempfile
+import time
+from logging.handlers import BufferingHandler
+from multiprocessing.pool import ThreadPool
 
 import boto
 import django
+from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.test import TestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
 
-from cogpheno.apps.turk.utils import (PRODUCTION_HOST, PRODUCTION_WORKER_URL,
-                                      SANDBOX_HOST, SANDBOX_WORKER_URL,
-                                      InvalidDjurkSettings,
-                                      amazon_string_to_datetime,
-                                      get_connection, get_host, get_worker_url,
-                                      is_sandbox)
+from expdj.apps.experiments.models import (Battery, CreditCondition,
+                                           Experiment, ExperimentTemplate,
+                                           ExperimentVariable, ExportJob)
+from expdj.apps.experiments.utils import (get_assignment_counts,
+                                          get_battery_assignments,
+                                          get_experiment_payload_key,
+                                          get_export_results,
+                                          select_ordered)
+from expdj.apps.turk import utils as turk_utils
+from expdj.apps.turk.credit import (compile_variable,
+                                    evaluate_credit_conditions,
+                                    evaluate_variables, get_variable_plan)
+from expdj.apps.turk.models import (HIT, TASKDATA_HOLDING_TABLE, Assignment,
+                                    BatteryVariableIndex, Blacklist, Bonus,
+                                    BonusPayment, CompletedBattery,
+                                    RequestRateExceeded, Result, ResultData,
+                                    ReviewJob, Worker, WorkerBatteryProgress,
+                                    get_battery_experiments,
+                                    get_battery_variables, get_hit_status,
+                                    get_review_assignments, get_review_filters,
+                                    get_trial_values, get_worker,
+                                    rebuild_battery_progress, remove_hit,
+                                    restore_result_taskdata,
+                                    summarize_trial_values,
+                                    update_worker_progress)
+from expdj.apps.turk.tasks import (acquire_mturk_request,
+                                   check_battery_dependencies, check_blacklist,
+                                   experiment_reward, export_results,
+                                   find_variable, get_refresh_keys,
+                                   get_variables, grant_bonus, pay_bonuses,
+                                   process_completed_result,
+                                   queue_bonus_payout, refresh_hit,
+                                   review_assignments,
+                                   schedule_assignments_refresh,
+                                   update_assignments)
+from expdj.apps.turk.testing import LocalMTurkConnection
+from expdj.apps.turk.utils import (PRODUCTION_HOST, PRODUCTION_WORKER_URL,
+                                   SANDBOX_HOST, SANDBOX_WORKER_URL,
+                                   amazon_string_to_datetime, get_host,
+                                   get_trial_variables, get_worker_url,
+                                   is_sandbox)
 
 """Basic unit tests for Turk App"""
 
@@ -24,136 +76,1391 @@ django_version = (django.VERSION[0] * 10.0 + django.VERSION[1] * 1.0) / 10
 
 
 class CommonTests(TestCase):
-    def setUp(self):
-        self.djurk_config_filename = tempfile.mkstemp()[1]
 
-    def tearDown(self):
-        os.remove(self.djurk_config_filename)
+    @contextlib.contextmanager
+    def mturk_allowed(self, allow):
+        saved = turk_utils.MTURK_ALLOW
+        turk_utils.MTURK_ALLOW = allow
+        try:
+            yield
+        finally:
+            turk_utils.MTURK_ALLOW = saved
 
     def test_amazon_string_to_datetime(self):
         sample_date = '2012-04-04T22:31:03Z'
         self.assertEqual(
             amazon_string_to_datetime(sample_date),
             datetime.datetime(2012, 4, 4, 22, 31, 3))
-    # def amazon_string_to_datetime(amazon_string):
-    #    amazon_iso_format = '%Y-%m-%dT%H:%M:%SZ'
-    #    return datetime.datetime.strptime(
-    #            amazon_string,
-    #            amazon_iso_format)
 
     def test_get_hosts(self):
-        with self.settings(DJURK={}, DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), PRODUCTION_HOST)
-
-        with self.settings(DJURK={'host': SANDBOX_HOST},
-                           DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), SANDBOX_HOST)
-
-        with self.settings(DJURK={'host': PRODUCTION_HOST},
-                           DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), PRODUCTION_HOST)
-
-        with self.settings(DJURK={
-                'host': 'http://mechanicalturk.sandbox.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), SANDBOX_HOST)
-
-        with self.settings(DJURK={
-                'host': 'https://mechanicalturk.sandbox.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), SANDBOX_HOST)
-
-        with self.settings(DJURK={
-                'host': 'http://mechanicalturk.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), PRODUCTION_HOST)
-
-        with self.settings(DJURK={
-                'host': 'https://mechanicalturk.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_host(), PRODUCTION_HOST)
-
-        with self.settings(DJURK={},
-                           DJURK_CONFIG_FILE=self.djurk_config_filename):
-            # Config file is empty
-            self.assertEqual(get_host(), PRODUCTION_HOST)
-
-        with self.settings(DJURK=None,
-                           DJURK_CONFIG_FILE=self.djurk_config_filename):
-            f = open(self.djurk_config_filename, 'w')
-            f.write("[Connection]\nhost: %s\n" % SANDBOX_HOST)
-            f.close()
-            self.assertEqual(get_host(), SANDBOX_HOST)
-
-        with self.settings(DJURK=None,
-                           DJURK_CONFIG_FILE=self.djurk_config_filename):
-            f = open(self.djurk_config_filename, 'w')
-            f.write("[Connection]\nhost: %s\n" % PRODUCTION_HOST)
-            f.close()
-            self.assertEqual(get_host(), PRODUCTION_HOST)
+        sandbox_hit = HIT(sandbox=True)
+        production_hit = HIT(sandbox=False)
+        with self.mturk_allowed(False):
+            self.assertEqual(get_host(sandbox_hit), SANDBOX_HOST)
+            self.assertEqual(get_host(production_hit), SANDBOX_HOST)
+            self.assertEqual(get_host(None), SANDBOX_HOST)
+
+        with self.mturk_allowed(True):
+            self.assertEqual(get_host(sandbox_hit), SANDBOX_HOST)
+            self.assertEqual(get_host(production_hit), PRODUCTION_HOST)
+            self.assertEqual(get_host(None), PRODUCTION_HOST)
 
     def test_is_sandbox(self):
         "Verify the is_sandbox setting parameter works"
-
-        with self.settings(DJURK={'host': SANDBOX_HOST}):
+        with self.mturk_allowed(False):
             self.assertTrue(is_sandbox())
 
-        with self.settings(DJURK={'host': PRODUCTION_HOST}):
+        with self.mturk_allowed(True):
             self.assertFalse(is_sandbox())
 
-        with self.settings(DJURK={
-                'host': 'http://mechanicalturk.sandbox.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertTrue(is_sandbox())
+    def test_get_worker_url(self):
+        with self.settings(MTURK_ALLOW=True):
+            self.assertEqual(get_worker_url(), PRODUCTION_WORKER_URL)
 
-        with self.settings(DJURK={
-                'host': 'https://mechanicalturk.sandbox.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertTrue(is_sandbox())
+        with self.settings(MTURK_ALLOW=False):
+            self.assertEqual(get_worker_url(), SANDBOX_WORKER_URL)
+            self.assertNotEqual(get_worker_url(), PRODUCTION_WORKER_URL)
 
-        with self.settings(DJURK={
-                'host': 'http://mechanicalturk.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertFalse(is_sandbox())
 
-        with self.settings(DJURK={
-                'host': 'https://mechanicalturk.amazonaws.com'},
-                DJURK_CONFIG_FILE=None):
-            self.assertFalse(is_sandbox())
+class BatteryRunWritesTests(TestCase):
+    '''count the UPDATE statements written while a worker runs a battery'''
 
-    def test_get_connection(self):
-        # As a full test would require a working AWS secret key,
-        # only rudimentary tests are performed on this function
-        with self.settings(DJURK=None, DJURK_CONFIG_FILE=None):
-            self.assertRaises(InvalidDjurkSettings, get_connection)
-
-        with self.settings(DJURK={'aws_access_key_id': '123'}):
-            self.assertRaises(KeyError, get_connection)
-
-        with self.settings(DJURK={'aws_secret_access_key': '123'}):
-            self.assertRaises(KeyError, get_connection)
-
-        with self.settings(DJURK={'aws_access_key_id': '123',
-                                  'aws_secret_access_key': '456'}):
-            mtc = get_connection()
-            self.assertTrue(isinstance(get_connection(),
-                                       boto.mturk.connection.MTurkConnection))
-
-        with self.settings(DJURK=None,
-                           DJURK_CONFIG_FILE=self.djurk_config_filename):
-            f = open(self.djurk_config_filename, 'w')
-            f.write("[Connection]\naws_access_key_id: 123\n"
-                    "aws_secret_access_key: 456\n")
-            f.close()
-            self.assertTrue(isinstance(get_connection(),
-                                       boto.mturk.connection.MTurkConnection))
+    n_experiments = 3
+    n_syncs = 5
+    trials_per_sync = 20
 
-    def test_get_worker_url(self):
-        with self.settings(DJURK={'host': PRODUCTION_HOST},
-                           DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_worker_url(), PRODUCTION_WORKER_URL)
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",
+                                              owner=owner,
+                                              credentials="dummy.cred",
+                                              maximum_time=120,
+                                              number_of_experiments=self.n_experiments)
+        self.templates = []
+        for e in range(self.n_experiments):
+            template = ExperimentTemplate.objects.create(
+                exp_id="task_%s" % e, name="Task %s" % e, time=5,
+                reference="", template="jspsych", version="abc")
+            self.battery.experiments.add(
+                Experiment.objects.create(template=template))
+            self.templates.append(template)
 
-        with self.settings(DJURK={'host': SANDBOX_HOST},
-                           DJURK_CONFIG_FILE=None):
-            self.assertEqual(get_worker_url(), SANDBOX_WORKER_URL)
-            self.assertNotEqual(get_worker_url(), PRODUCTION_WORKER_URL)
+    def run_battery(self, worker_id):
+        for template in self.templates:
+            # serving the experiment page
+            worker = get_worker(worker_id)
+            result, _ = Result.objects.update_or_create(
+                worker=worker, experiment=template, assignment=None,
+                battery=self.battery,
+                defaults={"browser": "Chrome,54", "platform": "Linux,"})
+            result.save()
+
+            # syncs from the experiment, only new trials are sent
+            start = 0
+            for sync in range(self.n_syncs):
+                trials = [{"current_trial": start + t,
+                           "trialdata": {"rt": 500, "correct": True}}
+                          for t in range(self.trials_per_sync)]
+                result.append_trials(trials, start=start,
+                                     current_trial=start + len(trials))
+                start += len(trials)
+
+            # the last sync finishes the experiment
+            result.completed = True
+            result.finishtime = timezone.now()
+            result.version = template.version
+            with transaction.atomic():
+                result.assemble_trials()
+                result.save()
+
+    def test_battery_run_updates(self):
+        # the worker has visited before, every page view is one UPDATE
+        Worker.objects.create(id="WORKER", session_count=1, visit_count=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.run_battery("WORKER")
+
+        updates = [q["sql"] for q in queries.captured_queries
+                   if q["sql"].startswith("UPDATE")]
+        worker_updates = [u for u in updates if "turk_worker" in u]
+        result_updates = [u for u in updates if '"turk_result"' in u]
+        finish_updates = [u for u in result_updates if '"completed"' in u]
+        # the assembled taskdata is written once, to its own table
+        data_writes = [q["sql"] for q in queries.captured_queries
+                       if '"turk_resultdata"' in q["sql"] and
+                       not q["sql"].startswith("SELECT")]
+
+        self.assertEqual(len(worker_updates), self.n_experiments)
+        self.assertEqual(len(result_updates),
+                         self.n_experiments * (self.n_syncs + 1))
+        self.assertEqual(len(finish_updates), self.n_experiments)
+        self.assertEqual(len(data_writes), self.n_experiments)
+        self.assertEqual(len(updates),
+                         len(worker_updates) + len(result_updates))
+
+        # syncs write only the current trial, the finishing save only the
+        # completion columns
+        for update in result_updates:
+            self.assertNotIn('"browser"', update)
+            self.assertNotIn('"worker_id"', update)
+            self.assertNotIn('"taskdata"', update)
+            if update not in finish_updates:
+                self.assertIn('"current_trial"', update)
+
+        worker = Worker.objects.get(id="WORKER")
+        self.assertEqual(worker.visit_count, 1 + self.n_experiments)
+        for result in Result.objects.filter(worker=worker):
+            self.assertTrue(result.completed)
+            self.assertEqual(len(result.taskdata),
+                             self.n_syncs * self.trials_per_sync)
+            self.assertFalse(result.trial_chunks.exists())
+
+    def test_resent_and_overlapping_chunks(self):
+        result = Result.objects.create(worker=get_worker("WORKER"),
+                                       experiment=self.templates[0],
+                                       battery=self.battery)
+        trials = [{"current_trial": t} for t in range(30)]
+
+        # two saves sent before either returned, arriving out of order
+        result.append_trials(trials[:30], start=0, current_trial=30)
+        result.append_trials(trials[:20], start=0, current_trial=20)
+        self.assertEqual(result.get_trials(), trials)
+        self.assertEqual(Result.objects.get(id=result.id).current_trial, 30)
+
+        # a chunk overlapping the end of another
+        trials.extend({"current_trial": t} for t in range(30, 40))
+        result.append_trials(trials[25:40], start=25, current_trial=40)
+        # a late chunk inside the trials already saved
+        result.append_trials(trials[10:15], start=10, current_trial=15)
+        self.assertEqual(result.get_trials(), trials)
+        self.assertEqual(Result.objects.get(id=result.id).current_trial, 40)
+
+        # a resent chunk is not stored twice
+        result.append_trials(trials[25:40], start=25, current_trial=40)
+        self.assertEqual(result.trial_chunks.count(), 3)
+        with transaction.atomic():
+            result.assemble_trials()
+            result.save()
+        self.assertEqual(Result.objects.get(id=result.id).taskdata, trials)
+
+    def test_sync_validates_chunks(self):
+        result = Result.objects.create(worker=get_worker("WORKER"),
+                                       experiment=self.templates[0],
+                                       battery=self.battery)
+        url = reverse("sync_data", args=[result.id])
+
+        def post(data):
+            return self.client.post(url, data,
+                                    content_type="application/json")
+
+        for data in ['{"trials": [', '[]', '{"trials": []}',
+                     '{"djstatus": "UPDATE"}',
+                     '{"djstatus": "UPDATE", "trials": {}, "start": 0}',
+                     '{"djstatus": "UPDATE", "trials": []}',
+                     '{"djstatus": "UPDATE", "trials": [], "start": -1}',
+                     '{"djstatus": "UPDATE", "trials": [], "start": "0"}',
+                     '{"djstatus": "UPDATE", "trials": [], "start": 0, '
+                     '"currenttrial": "1"}',
+                     '{"djstatus": "UPDATE", "taskdata": []}']:
+            self.assertEqual(post(data).status_code, 400, data)
+        self.assertFalse(result.trial_chunks.exists())
+
+        trials = [{"current_trial": t} for t in range(10)]
+        response = post(json.dumps({"djstatus": "UPDATE", "trials": trials,
+                                    "start": 0, "currenttrial": 10}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(result.get_trials(), trials)
+
+        # chunks arriving after the result is finished would not be saved
+        with transaction.atomic():
+            result.completed = True
+            result.assemble_trials()
+            result.save()
+        response = post(json.dumps({"djstatus": "UPDATE",
+                                    "trials": [{"current_trial": 10}],
+                                    "start": 10, "currenttrial": 11}))
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(result.trial_chunks.exists())
+        self.assertEqual(Result.objects.get(id=result.id).taskdata, trials)
+
+    def test_taskdata_is_loaded_lazily(self):
+        self.run_battery("WORKER")
+
+        # metadata lookups don't read the taskdata
+        with CaptureQueriesContext(connection) as queries:
+            results = list(Result.objects.filter(worker_id="WORKER"))
+        self.assertNotIn('"taskdata"', queries.captured_queries[0]["sql"])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(results[0].taskdata),
+                             self.n_syncs * self.trials_per_sync)
+        with self.assertNumQueries(0):
+            results[0].taskdata
+
+        # exports read it with the results
+        with self.assertNumQueries(1):
+            for result in Result.objects.select_related("data"):
+                self.assertEqual(len(result.taskdata),
+                                 self.n_syncs * self.trials_per_sync)
+
+        result = Result.objects.create(worker_id="WORKER",
+                                       battery=self.battery,
+                                       experiment=self.templates[0],
+                                       taskdata=[{"rt": 500}])
+        result = Result.objects.get(id=result.id)
+        self.assertEqual(result.taskdata, [{"rt": 500}])
+        result.taskdata = []
+        result.save()
+        self.assertEqual(Result.objects.get(id=result.id).taskdata, [])
+
+        # without the ids of new rows, taskdata can't be bulk created
+        results = [Result(worker_id="WORKER", battery=self.battery,
+                          experiment=template, taskdata=[{"rt": 500}])
+                   for template in self.templates]
+        if connection.features.can_return_ids_from_bulk_insert:
+            Result.objects.filter(worker_id="WORKER").delete()
+            Result.objects.bulk_create(results)
+            self.assertEqual([r.taskdata for r in Result.objects.filter(
+                worker_id="WORKER")], [[{"rt": 500}]] * self.n_experiments)
+        else:
+            self.assertRaises(ValueError, Result.objects.bulk_create, results)
+
+    def test_taskdata_column_is_moved_around_migrate(self):
+        self.run_battery("WORKER")
+        kept = Result.objects.filter(worker_id="WORKER").first()
+        moved = Result.objects.create(worker_id="OTHER", battery=self.battery,
+                                      experiment=self.templates[0])
+        # the turk_result column of the release before ResultData
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE turk_result ADD COLUMN taskdata text")
+            cursor.execute("UPDATE turk_result SET taskdata = %s",
+                           ['[{"rt": 700}]'])
+
+        # run_uwsgi.sh holds the column before migrate drops it
+        out = StringIO()
+        call_command("move_result_taskdata", "hold", stdout=out)
+        self.assertIn("of %s results was held" % (
+            self.n_experiments + 1), out.getvalue())
+        self.assertIn(TASKDATA_HOLDING_TABLE,
+                      connection.introspection.table_names())
+        call_command("move_result_taskdata", "restore", stdout=out)
+        self.assertIn("of 1 results was restored", out.getvalue())
+        self.assertNotIn(TASKDATA_HOLDING_TABLE,
+                         connection.introspection.table_names())
+        self.assertIsNone(restore_result_taskdata())
+        self.assertEqual(Result.objects.get(id=moved.id).taskdata,
+                         [{"rt": 700}])
+        # a result that has its ResultData already keeps it
+        self.assertEqual(len(Result.objects.get(id=kept.id).taskdata),
+                         self.n_syncs * self.trials_per_sync)
+
+    def test_taskdata_field_is_the_same_for_every_database(self):
+        field = ResultData._meta.get_field("taskdata")
+        self.assertEqual(field.deconstruct()[1],
+                         "expdj.apps.turk.models.TaskDataField")
+        postgres = type("Connection", (), {"vendor": "postgresql"})()
+        self.assertEqual(field.db_type(postgres), "jsonb")
+        self.assertEqual(field.db_type(connection), "text")
+
+    def test_trial_variables(self):
+        result = Result.objects.create(
+            worker_id="WORKER", battery=self.battery,
+            experiment=self.templates[0],
+            taskdata=[{"rt": 1, "trialdata": {"rt": 400, "correct": True}},
+                      {"trialdata": {"rt": 600, "correct": False}},
+                      {"trialdata": {"key_press": 32}, "rt": 800}])
+        self.assertEqual(find_variable(result, "rt"), [400, 600, 800])
+        self.assertEqual(find_variable(result, "correct"), [True, False])
+        self.assertEqual(find_variable(result, "missing"), [])
+        self.assertEqual(get_variables(result, "mean_rt"), [600.0])
+        self.assertEqual(get_variables(result, "max_rt"), [800.0])
+        self.assertEqual(get_variables(result, "mean_missing"), [])
+
+        # values are read for many results at once
+        other = Result.objects.create(worker_id="WORKER",
+                                      battery=self.battery,
+                                      experiment=self.templates[1],
+                                      taskdata={"survey": "answers"})
+        results = Result.objects.filter(battery=self.battery)
+        self.assertEqual(list(get_trial_values(results, "rt").items()),
+                         [(result.id, [400, 600, 800])])
+        self.assertEqual(summarize_trial_values([result.id, other.id], "rt",
+                                                "median"),
+                         {result.id: 600.0})
+
+    def test_trial_variables_of_trial_lists(self):
+        # the older layout: the trials are a list in the trialdata
+        result = Result.objects.create(
+            worker_id="WORKER", battery=self.battery,
+            experiment=self.templates[0],
+            taskdata=[{"trialdata": [{"rt": 400, "correct": True},
+                                     {"rt": 600, "correct": False},
+                                     {"key_press": 32}]},
+                      {"trialdata": {"rt": 800}}])
+        self.assertEqual(find_variable(result, "rt"), [400, 600, 800])
+        self.assertEqual(find_variable(result, "correct"), [True, False])
+        self.assertEqual(summarize_trial_values([result.id], "correct",
+                                                "mean"),
+                         {result.id: 0.5})
+        self.assertEqual(get_trial_variables(result.taskdata),
+                         set(["rt", "correct", "key_press"]))
+
+    def test_battery_experiments(self):
+        owner = User.objects.get(username="owner")
+        HIT.objects.bulk_create([HIT(battery=self.battery, owner=owner,
+                                     mturk_id="HITID", title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1)])
+        hit = HIT.objects.get(mturk_id="HITID")
+        assignment = Assignment.objects.create(mturk_id="ASSIGNMENT",
+                                               hit=hit)
+        # results completed before the index existed
+        for template, assigned in zip(self.templates, [assignment, None]):
+            Result.objects.create(worker_id="WORKER", battery=self.battery,
+                                  experiment=template, assignment=assigned,
+                                  completed=True,
+                                  taskdata=[{"trialdata": {"rt": 400}}])
+        self.assertEqual(get_battery_experiments(self.battery),
+                         ["task_0", "task_1"])
+        self.assertEqual(get_battery_variables(self.battery), ["rt"])
+
+        # the results of a deleted HIT are deleted with it
+        remove_hit(hit)
+        self.assertEqual(list(BatteryVariableIndex.objects.values_list(
+            "experiment_id", flat=True)), ["task_1"])
+        self.assertEqual(get_battery_experiments(self.battery), ["task_1"])
+
+    def test_unchanged_save_is_skipped(self):
+        worker = Worker.objects.create(id="WORKER")
+        assignment = Assignment.objects.create(mturk_id="ASSIGNMENT",
+                                               worker=worker)
+        worker = Worker.objects.get(id="WORKER")
+        assignment = Assignment.objects.get(mturk_id="ASSIGNMENT")
+        with self.assertNumQueries(0):
+            worker.save()
+            assignment.save()
+
+        assignment.status = Assignment.SUBMITTED
+        with CaptureQueriesContext(connection) as queries:
+            assignment.save()
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertIn('"status"', queries.captured_queries[0]["sql"])
+        self.assertNotIn('"mturk_id"', queries.captured_queries[0]["sql"])
+
+
+CHROME_USER_AGENT = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                     "(KHTML, like Gecko) Chrome/54.0.2840.71 Safari/537.36")
+
+
+class ExportJobTests(TestCase):
+    '''an export job is run by one task at a time, and a lost one again'''
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery", owner=owner,
+                                              credentials="dummy.cred",
+                                              maximum_time=120,
+                                              number_of_experiments=0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.job = ExportJob.objects.create(
+            key="KEY", battery=self.battery, status=ExportJob.RUNNING,
+            output_file=os.path.join(self.tmpdir, "KEY.tsv"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stale_export_job_is_run_again(self):
+        # another task is running the job
+        export_results(self.job.id)
+        self.assertFalse(os.path.exists(self.job.output_file))
+        self.assertFalse(ExportJob.objects.get(id=self.job.id).is_stale())
+
+        stale = timezone.now() - datetime.timedelta(hours=1)
+        ExportJob.objects.filter(id=self.job.id).update(modify_date=stale)
+        self.assertTrue(ExportJob.objects.get(id=self.job.id).is_stale())
+        export_results(self.job.id)
+        job = ExportJob.objects.get(id=self.job.id)
+        self.assertEqual(job.status, ExportJob.FINISHED)
+        self.assertTrue(job.is_ready())
+        self.assertEqual(os.listdir(self.tmpdir), ["KEY.tsv"])
+
+    def test_export_results_of_one_experiment(self):
+        template = ExperimentTemplate.objects.create(
+            exp_id="task", name="Task", time=5, reference="",
+            template="jspsych")
+        other = ExperimentTemplate.objects.create(
+            exp_id="other_task", name="Other Task", time=5, reference="",
+            template="jspsych")
+        for experiment in [template, other]:
+            Result.objects.create(worker=get_worker("WORKER"),
+                                  experiment=experiment,
+                                  battery=self.battery, completed=True)
+        # a tag from a url or json is unicode
+        for tags in ["task", u"task", ["task"]]:
+            self.assertEqual([r.experiment_id for r in get_export_results(
+                self.battery, tags)], ["task"])
+
+
+@override_settings(
+    MTURK_CONNECTION_CLASS="expdj.apps.turk.testing.LocalMTurkConnection")
+class ServeHitQueriesTests(TestCase):
+    '''serve_hit should run in a fixed number of queries, whatever the
+    history of the worker, and without calling Amazon'''
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.battery = self.make_battery("battery", n_experiments=3)
+        HIT.objects.bulk_create([HIT(battery=self.battery,
+                                     owner=self.owner,
+                                     mturk_id="HITID",
+                                     title="HIT",
+                                     description="HIT",
+                                     reward=0.5,
+                                     assignment_duration_in_hours=1,
+                                     status=HIT.ASSIGNABLE)])
+        self.hit = HIT.objects.get(mturk_id="HITID")
+        self.worker = Worker.objects.create(id="WORKER")
+        Assignment.objects.create(mturk_id="ASSIGNMENT", worker=self.worker,
+                                  hit=self.hit)
+
+        # rendered experiments are cached, they aren't read from disk here
+        for experiment in self.battery.experiments.all():
+            caches["experiments"].set(
+                get_experiment_payload_key(experiment.template,
+                                           "docker-mturk"),
+                {"load": "", "run": "<p>{{result.id}}</p>",
+                 "validation": None})
+
+        # the periodic refresh caches the status of the HIT
+        LocalMTurkConnection.reset()
+        LocalMTurkConnection.add_hit("HITID")
+        refresh_hit(self.hit.id)
+
+    def tearDown(self):
+        caches["experiments"].clear()
+        caches["mturk"].clear()
+
+    def make_battery(self, name, n_experiments):
+        battery = Battery.objects.create(name=name,
+                                         owner=self.owner,
+                                         credentials="dummy.cred",
+                                         maximum_time=120,
+                                         number_of_experiments=n_experiments,
+                                         presentation_order="specified")
+        for e in range(n_experiments):
+            template = ExperimentTemplate.objects.create(
+                exp_id="%s_task_%s" % (name, e), name="%s task %s" % (name, e),
+                time=5, reference="", template="jspsych", version="abc")
+            battery.experiments.add(
+                Experiment.objects.create(template=template, order=e))
+        return battery
+
+    def add_history(self, n_batteries):
+        for b in range(n_batteries):
+            battery = self.make_battery("history_%s_%s" % (
+                Battery.objects.count(), b), n_experiments=2)
+            for experiment in battery.experiments.all():
+                Result.objects.create(worker=self.worker,
+                                      experiment=experiment.template,
+                                      battery=battery,
+                                      completed=True)
+
+    def serve_hit(self):
+        return self.client.get(
+            "/accept/%s" % self.hit.id,
+            {"workerId": "WORKER", "assignmentId": "ASSIGNMENT",
+             "hitId": "HITID"},
+            HTTP_USER_AGENT=CHROME_USER_AGENT)
+
+    def test_serve_hit_queries(self):
+        remote_calls = LocalMTurkConnection.count()
+
+        # the first request creates the result for the first experiment
+        self.assertEqual(self.serve_hit().status_code, 200)
+        self.add_history(1)
+        with self.assertNumQueries(13):
+            response = self.serve_hit()
+        self.assertEqual(response.status_code, 200)
+
+        # finish the first experiment, the second is served next
+        Result.objects.filter(worker=self.worker).update(completed=True)
+        for result in Result.objects.filter(worker=self.worker,
+                                            battery=self.battery):
+            update_worker_progress(result)
+        self.assertEqual(self.serve_hit().status_code, 200)
+        self.add_history(10)
+        with self.assertNumQueries(13):
+            response = self.serve_hit()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Result.objects.filter(battery=self.battery).count(),
+                         2)
+        self.assertEqual(LocalMTurkConnection.count(), remote_calls)
+
+    def test_select_ordered(self):
+        experiments = list(self.battery.experiments.all())
+        self.assertEqual(select_ordered(experiments, selection_number=2),
+                         [experiments[0]])
+        self.assertEqual(select_ordered(experiments[1:]), [experiments[1]])
+        # a worker who completed every experiment has none left
+        self.assertEqual(select_ordered([]), [])
+        self.assertEqual(select_ordered(Experiment.objects.none()), [])
+
+    def test_hit_is_served_without_the_mturk_cache(self):
+        unavailable = {"BACKEND": "expdj.apps.turk.testing.UnavailableCache"}
+        with override_settings(CACHES=dict(settings.CACHES,
+                                           mturk=unavailable)):
+            self.assertEqual(get_hit_status(self.hit),
+                             (HIT.ASSIGNABLE, True))
+            self.assertEqual(self.serve_hit().status_code, 200)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_expired_status_is_refreshed_once(self):
+        caches["mturk"].clear()
+        LocalMTurkConnection.reset()
+        LocalMTurkConnection.add_hit("HITID", status="Disposed")
+
+        # the stored status is used, and one refresh is queued
+        self.assertEqual(self.serve_hit().status_code, 200)
+        self.assertEqual(LocalMTurkConnection.count("get_hit"), 1)
+        self.assertEqual(HIT.objects.get(id=self.hit.id).status,
+                         HIT.DISPOSED)
+
+        response = self.serve_hit()
+        self.assertTemplateUsed(response, "turk/hit_expired.html")
+        self.assertEqual(LocalMTurkConnection.count("get_hit"), 1)
+
+
+@override_settings(
+    MTURK_CONNECTION_CLASS="expdj.apps.turk.testing.LocalMTurkConnection")
+class ConnectionPoolTests(TestCase):
+    '''get_connection should hand out one connection per credentials, host
+    and thread, until it is idle, discarded or the secret changes'''
+
+    def setUp(self):
+        turk_utils.clear_connection_pool()
+
+    def tearDown(self):
+        turk_utils.clear_connection_pool()
+
+    def test_connection_is_reused(self):
+        connection = turk_utils.get_connection("KEY", "SECRET")
+        self.assertIs(turk_utils.get_connection("KEY", "SECRET"), connection)
+        self.assertIsNot(turk_utils.get_connection("OTHERKEY", "SECRET"),
+                         connection)
+        self.assertIsNot(turk_utils.get_connection("KEY", "ROTATED"),
+                         connection)
+
+    def test_connection_is_not_shared_between_threads(self):
+        connection = turk_utils.get_connection("KEY", "SECRET")
+        pool = ThreadPool(2)
+        try:
+            connections = pool.map(
+                lambda _: turk_utils.get_connection("KEY", "SECRET"), [0])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertIsNot(connections[0], connection)
+        self.assertIs(turk_utils.get_connection("KEY", "SECRET"), connection)
+
+    def test_idle_connection_is_evicted(self):
+        connection = turk_utils.get_connection("KEY", "SECRET")
+        turk_utils.evict_idle_connections(time.time() + 1)
+        self.assertIs(turk_utils.get_connection("KEY", "SECRET"), connection)
+        with self.settings(MTURK_CONNECTION_IDLE_TIMEOUT=0):
+            turk_utils.evict_idle_connections(time.time() + 1)
+        self.assertIsNot(turk_utils.get_connection("KEY", "SECRET"),
+                         connection)
+
+    def test_discarded_connection_is_replaced(self):
+        connection = turk_utils.get_connection("KEY", "SECRET")
+        turk_utils.discard_connection(connection)
+        self.assertIsNot(turk_utils.get_connection("KEY", "SECRET"),
+                         connection)
+
+
+class CredentialsTests(TestCase):
+    '''credentials files should be parsed once, and again when changed'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.cred")
+        self.write_credentials("KEY", "SECRET")
+
+    def tearDown(self):
+        os.remove(self.path)
+        os.rmdir(self.tmpdir)
+
+    def write_credentials(self, key, secret, mtime=None):
+        with open(self.path, "w") as filey:
+            filey.write("AWS_ACCESS_KEY_ID=%s\n" % key)
+            filey.write("AWS_SECRET_ACCESS_KEY_ID=%s\n" % secret)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_parse_credentials(self):
+        credentials = turk_utils.parse_credentials(
+            "AWS_ACCESS_KEY_ID=KEY\n\nAWS_SECRET_ACCESS_KEY_ID=ab=c/d+\n")
+        self.assertEqual(credentials, {"AWS_ACCESS_KEY_ID": "KEY",
+                                       "AWS_SECRET_ACCESS_KEY_ID": "ab=c/d+"})
+
+    def test_credentials_are_cached_until_modified(self):
+        credentials = turk_utils.load_credentials(self.path)
+        self.assertEqual(credentials["AWS_ACCESS_KEY_ID"], "KEY")
+        self.assertIs(turk_utils.load_credentials(self.path), credentials)
+
+        self.write_credentials("NEWKEY", "NEWSECRET",
+                               mtime=os.path.getmtime(self.path) + 10)
+        credentials = turk_utils.load_credentials(self.path)
+        self.assertEqual(credentials["AWS_ACCESS_KEY_ID"], "NEWKEY")
+        self.assertEqual(credentials["AWS_SECRET_ACCESS_KEY_ID"], "NEWSECRET")
+
+
+@override_settings(
+    MTURK_CONNECTION_CLASS="expdj.apps.turk.testing.LocalMTurkConnection")
+class AssignmentSyncTests(TestCase):
+    '''update_assignments should list a HIT with the largest page size and
+    write the changes in bulk'''
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        battery = Battery.objects.create(name="battery", owner=owner,
+                                         credentials="dummy.cred",
+                                         maximum_time=120,
+                                         number_of_experiments=1)
+        HIT.objects.bulk_create([HIT(battery=battery, owner=owner,
+                                     mturk_id="HITID", title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1,
+                                     status=HIT.ASSIGNABLE)])
+        self.hit = HIT.objects.get(mturk_id="HITID")
+        LocalMTurkConnection.reset()
+        LocalMTurkConnection.add_hit("HITID")
+        for a in range(150):
+            LocalMTurkConnection.add_assignment(
+                "HITID", "ASSIGNMENT%s" % a, "WORKER%s" % a)
+        # the worker who is served the HIT already has a row
+        Assignment.objects.create(mturk_id="ASSIGNMENT0", hit=self.hit,
+                                  worker=Worker.objects.create(id="WORKER0"))
+        caches["mturk"].clear()
+
+    def tearDown(self):
+        caches["mturk"].clear()
+
+    def test_update_assignments(self):
+        report = self.hit.update_assignments()
+        self.assertEqual(report, {"api_calls": 2, "db_writes": 3,
+                                  "created": 149, "updated": 1})
+        self.assertEqual(LocalMTurkConnection.count("get_assignments"), 2)
+        self.assertEqual(Assignment.objects.filter(
+            hit=self.hit, status=Assignment.SUBMITTED).count(), 150)
+        self.assertEqual(Worker.objects.count(), 150)
+
+        # nothing changed on Amazon, nothing is written: the two reads
+        # run inside a savepoint
+        with self.assertNumQueries(4):
+            report = self.hit.update_assignments()
+        self.assertEqual(report["db_writes"], 0)
+
+        for a in range(5):
+            LocalMTurkConnection.assignments["HITID"][
+                "ASSIGNMENT%s" % a].AssignmentStatus = "Approved"
+        report = self.hit.update_assignments()
+        self.assertEqual(report, {"api_calls": 2, "db_writes": 1,
+                                  "created": 0, "updated": 5})
+        self.assertEqual(Assignment.objects.filter(
+            hit=self.hit, status=Assignment.APPROVED).count(), 5)
+
+    def test_workers_created_meanwhile_are_kept(self):
+        bulk_create = Worker.objects.bulk_create
+
+        def racing_bulk_create(workers, *args, **kwargs):
+            # the worker is served the HIT while the assignments are synced
+            Worker.objects.create(id="WORKER1")
+            return bulk_create(workers, *args, **kwargs)
+
+        Worker.objects.bulk_create = racing_bulk_create
+        try:
+            report = self.hit.update_assignments()
+        finally:
+            del Worker.objects.bulk_create
+        self.assertEqual(report["created"], 149)
+        self.assertEqual(Worker.objects.count(), 150)
+        self.assertEqual(Assignment.objects.filter(
+            hit=self.hit, worker_id="WORKER1").count(), 1)
+
+    def test_assignment_update_lists_the_hit_once(self):
+        assignment = Assignment.objects.get(mturk_id="ASSIGNMENT0")
+        assignment.update()
+        self.assertEqual(assignment.status, Assignment.SUBMITTED)
+        self.assertEqual(LocalMTurkConnection.count(), 2)
+        self.assertEqual(Assignment.objects.filter(hit=self.hit).count(), 150)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_assignments_refresh_is_coalesced(self):
+        self.assertTrue(schedule_assignments_refresh(self.hit))
+        self.assertFalse(schedule_assignments_refresh(self.hit))
+        self.assertEqual(LocalMTurkConnection.count("get_assignments"), 2)
+        self.assertEqual(Assignment.objects.filter(hit=self.hit).count(), 150)
+
+        # a refresh in flight isn't queued twice
+        caches["mturk"].clear()
+        lease = get_refresh_keys("assignments", self.hit.id)[0]
+        caches["mturk"].add(lease, True)
+        self.assertFalse(schedule_assignments_refresh(self.hit))
+        self.assertEqual(LocalMTurkConnection.count("get_assignments"), 2)
+
+    def test_listing_pages_acquire_the_request_rate(self):
+        acquired = []
+        self.hit.update_assignments(
+            acquire_request=lambda: acquired.append(True) or True)
+        # the first page is acquired by the caller
+        self.assertEqual(len(acquired), 1)
+
+        Assignment.objects.exclude(mturk_id="ASSIGNMENT0").delete()
+        with self.assertRaises(RequestRateExceeded):
+            self.hit.update_assignments(acquire_request=lambda: False)
+        self.assertEqual(Assignment.objects.filter(hit=self.hit).count(), 1)
+
+    @override_settings(MTURK_REQUESTS_PER_SECOND=0)
+    def test_refresh_lease_is_released_without_retries(self):
+        lease, refreshed = get_refresh_keys("assignments", self.hit.id)
+        caches["mturk"].add(lease, True)
+        result = update_assignments.apply(
+            [self.hit.id], retries=settings.MTURK_MAX_RETRIES)
+        self.assertIsInstance(result.result, MaxRetriesExceededError)
+        self.assertIsNone(caches["mturk"].get(lease))
+        self.assertIsNone(caches["mturk"].get(refreshed))
+
+    def test_failed_assignments_refresh_is_logged(self):
+        lease, refreshed = get_refresh_keys("assignments", self.hit.id)
+        LocalMTurkConnection.fail(
+            "get_assignments",
+            boto.exception.BotoServerError(503, "Service Unavailable"))
+        logger = logging.getLogger("expdj.apps.turk.tasks")
+        handler = BufferingHandler(10)
+        logger.addHandler(handler)
+        try:
+            self.assertIsNone(update_assignments(self.hit.id))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual([r.levelname for r in handler.buffer], ["WARNING"])
+        self.assertIsNotNone(caches["mturk"].get(refreshed))
+
+        # other errors aren't swallowed, the lease is released
+        caches["mturk"].clear()
+        caches["mturk"].add(lease, True)
+        LocalMTurkConnection.fail("get_assignments", RuntimeError("bug"))
+        with self.assertRaises(RuntimeError):
+            update_assignments(self.hit.id)
+        self.assertIsNone(caches["mturk"].get(lease))
+
+        # a deleted HIT has nothing to sync
+        self.assertIsNone(update_assignments(self.hit.id + 1))
+
+    @override_settings(MTURK_REQUESTS_PER_SECOND=2)
+    def test_mturk_request_rate(self):
+        self.assertTrue(acquire_mturk_request(now=1000.0))
+        self.assertTrue(acquire_mturk_request(now=1000.5))
+        self.assertFalse(acquire_mturk_request(now=1000.9))
+        self.assertTrue(acquire_mturk_request(now=1001.0))
+
+
+class BatteryDashboardTests(TestCase):
+    '''the battery page should count assignments with one grouped query,
+    and list one page of them with one more'''
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery", owner=owner,
+                                              credentials="dummy.cred",
+                                              maximum_time=120,
+                                              number_of_experiments=1)
+        HIT.objects.bulk_create([HIT(battery=self.battery, owner=owner,
+                                     mturk_id="HITID", title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1,
+                                     status=HIT.ASSIGNABLE)])
+        hit = HIT.objects.get(mturk_id="HITID")
+        statuses = [Assignment.APPROVED] * 30 + [Assignment.SUBMITTED] * 20 + \
+            [Assignment.REJECTED] * 5 + [None] * 5
+        Worker.objects.bulk_create([Worker(id="WORKER%s" % a)
+                                    for a in range(len(statuses))])
+        Assignment.objects.bulk_create([
+            Assignment(mturk_id="ASSIGNMENT%s" % a, hit=hit, status=status,
+                       worker_id="WORKER%s" % a)
+            for a, status in enumerate(statuses)])
+
+    def test_assignment_counts(self):
+        with self.assertNumQueries(1):
+            counts = get_assignment_counts(self.battery)
+        self.assertEqual(counts, {"accepted": 30, "submit": 20,
+                                  "rejected": 5, "none": 5, "total": 60})
+
+    def test_battery_assignments_are_paginated(self):
+        counts = get_assignment_counts(self.battery)
+        with self.assertNumQueries(1):
+            assignments, page = get_battery_assignments(
+                self.battery, page="2", per_page=50, counts=counts)
+            self.assertEqual(page.paginator.num_pages, 2)
+            self.assertEqual([a.hit.mturk_id for a in assignments["accepted"]],
+                             ["HITID"] * 10)
+        self.assertEqual(assignments["submit"], [])
+
+        assignments, page = get_battery_assignments(self.battery, page="x")
+        self.assertEqual(page.number, 1)
+        self.assertEqual(sum(len(a) for a in assignments.values()), 50)
+
+
+class BatteryDependenciesTests(TestCase):
+    '''battery dependencies should be checked against the completed
+    batteries of a worker, recorded as results are completed'''
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        self.worker = Worker.objects.create(id="WORKER")
+        self.first = self.make_battery("first", n_experiments=2)
+        self.second = self.make_battery("second", n_experiments=1)
+        self.battery = self.make_battery("battery", n_experiments=1)
+        self.battery.required_batteries.add(self.first)
+        self.battery.restricted_batteries.add(self.second)
+
+    def make_battery(self, name, n_experiments):
+        battery = Battery.objects.create(name=name, owner=self.owner,
+                                         credentials="dummy.cred",
+                                         maximum_time=120,
+                                         number_of_experiments=n_experiments)
+        for e in range(n_experiments):
+            template = ExperimentTemplate.objects.create(
+                exp_id="%s_task_%s" % (name, e), name="%s task %s" % (name, e),
+                time=5, reference="", template="jspsych")
+            battery.experiments.add(Experiment.objects.create(template=template))
+        return battery
+
+    def complete(self, battery):
+        for experiment in battery.experiments.all():
+            result = Result.objects.create(worker=self.worker,
+                                           experiment=experiment.template,
+                                           battery=battery, completed=True)
+            update_worker_progress(result)
+
+    def check(self):
+        with self.assertNumQueries(3):
+            return check_battery_dependencies(self.battery, self.worker.id)
+
+    def test_battery_dependencies(self):
+        self.assertEqual(self.check(), ([self.first], []))
+
+        # one of two experiments doesn't complete the battery
+        experiment = self.first.experiments.all()[0]
+        update_worker_progress(Result.objects.create(
+            worker=self.worker, experiment=experiment.template,
+            battery=self.first, completed=True))
+        self.assertEqual(self.check(), ([self.first], []))
+
+        self.complete(self.first)
+        self.assertEqual(self.check(), ([], []))
+        self.complete(self.second)
+        self.assertEqual(self.check(), ([], [self.second]))
+
+    def test_unrecorded_progress_is_computed(self):
+        # results completed before batteries were recorded
+        for battery in (self.first, self.second):
+            for experiment in battery.experiments.all():
+                Result.objects.create(worker=self.worker,
+                                      experiment=experiment.template,
+                                      battery=battery, completed=True)
+        self.assertFalse(WorkerBatteryProgress.objects.exists())
+        self.assertEqual(
+            check_battery_dependencies(self.battery, self.worker.id),
+            ([], [self.second]))
+        self.assertEqual(CompletedBattery.objects.count(), 2)
+        self.assertEqual(self.check(), ([], [self.second]))
+
+    def test_deleted_experiment_rebuilds_progress(self):
+        experiments = list(self.first.experiments.all())
+        update_worker_progress(Result.objects.create(
+            worker=self.worker, experiment=experiments[0].template,
+            battery=self.first, completed=True))
+        self.assertEqual(self.check(), ([self.first], []))
+
+        admin = User.objects.create(username="admin", is_superuser=True)
+        self.client.force_login(admin)
+        response = self.client.get(reverse(
+            "delete_experiment", args=[experiments[1].template_id]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.check(), ([], []))
+
+    def test_deleted_hit_rebuilds_progress(self):
+        HIT.objects.bulk_create([HIT(battery=self.first, owner=self.owner,
+                                     mturk_id="HITID", title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1)])
+        hit = HIT.objects.get(mturk_id="HITID")
+        assignment = Assignment.objects.create(mturk_id="ASSIGNMENT",
+                                               worker=self.worker, hit=hit)
+        for experiment in self.first.experiments.all():
+            update_worker_progress(Result.objects.create(
+                worker=self.worker, experiment=experiment.template,
+                battery=self.first, assignment=assignment, completed=True))
+        self.assertEqual(self.check(), ([], []))
+
+        remove_hit(hit)
+        self.assertFalse(Result.objects.exists())
+        self.assertEqual(self.check(), ([self.first], []))
+
+    def test_rebuild_battery_progress(self):
+        self.complete(self.first)
+        template = ExperimentTemplate.objects.create(
+            exp_id="new_task", name="new task", time=5, reference="",
+            template="jspsych")
+        self.first.experiments.add(Experiment.objects.create(template=template))
+        self.assertEqual(rebuild_battery_progress(self.first), 0)
+        self.assertFalse(CompletedBattery.objects.exists())
+        self.assertEqual(self.check(), ([self.first], []))
+        progress = WorkerBatteryProgress.objects.get(worker=self.worker,
+                                                     battery=self.first)
+        self.assertEqual(progress.remaining, 1)
+        self.assertEqual(len(progress.completed_experiments), 2)
+
+    def test_worker_progress(self):
+        experiments = list(self.first.experiments.all())
+        result = Result.objects.create(worker=self.worker,
+                                       experiment=experiments[0].template,
+                                       battery=self.first, completed=True)
+        progress = update_worker_progress(result)
+        self.assertEqual(progress.completed_experiments,
+                         [experiments[0].template_id])
+        self.assertEqual(progress.remaining, 1)
+        self.assertFalse(progress.finished)
+
+        # completing the same experiment again changes nothing
+        self.assertEqual(update_worker_progress(result).remaining, 1)
+
+        progress = update_worker_progress(Result.objects.create(
+            worker=self.worker, experiment=experiments[1].template,
+            battery=self.first, completed=True))
+        self.assertTrue(progress.finished)
+        self.assertTrue(CompletedBattery.objects.filter(
+            worker=self.worker, battery=self.first).exists())
+
+
+class CreditConditionsTests(TestCase):
+    '''check_blacklist and experiment_reward evaluate the credit conditions of
+    the experiment of a result'''
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",
+                                              owner=owner,
+                                              credentials="dummy.cred",
+                                              maximum_time=120,
+                                              number_of_experiments=1,
+                                              blacklist_active=True,
+                                              blacklist_threshold=0,
+                                              bonus_active=True)
+        self.correct = ExperimentVariable.objects.create(
+            name="mean_correct", description="accuracy")
+        self.rt = ExperimentVariable.objects.create(
+            name="rt", description="response time")
+        self.template = ExperimentTemplate.objects.create(
+            exp_id="task", name="Task", time=5, reference="",
+            template="jspsych", rejection_variable=self.correct,
+            performance_variable=self.rt)
+        self.experiment = Experiment.objects.create(
+            template=self.template, include_catch=True, include_bonus=True)
+        self.experiment.credit_conditions.add(
+            CreditCondition.objects.create(variable=self.correct, value="0.5",
+                                           operator="LESSTHAN"),
+            CreditCondition.objects.create(variable=self.rt, value="300",
+                                           operator="LESSTHAN", amount=0.25))
+        self.battery.experiments.add(self.experiment)
+        self.worker = Worker.objects.create(id="WORKER")
+
+    def make_result(self, trials):
+        return Result.objects.create(
+            worker=self.worker, battery=self.battery,
+            experiment=self.template, completed=True,
+            taskdata=[{"trialdata": trial} for trial in trials])
+
+    def test_credit_conditions(self):
+        result = self.make_result([{"rt": 400, "correct": True},
+                                   {"rt": 250, "correct": False},
+                                   {"rt": 200, "correct": False}])
+        check_blacklist(result.id)
+        experiment_reward(result.id)
+        blacklist = Blacklist.objects.get(worker=self.worker)
+        self.assertTrue(blacklist.active)
+        self.assertEqual(blacklist.flags["task"]["description"],
+                         "mean_correct 0.333333333333 LESSTHAN 0.5")
+        bonus = Bonus.objects.get(worker=self.worker)
+        self.assertEqual(bonus.amounts["task"]["amount"], 0.25)
+        self.assertEqual(bonus.amounts["task"]["description"],
+                         "rt 200 LESSTHAN 300")
+        self.assertTrue(Result.objects.get(id=result.id).credit_granted)
+
+    def test_credit_conditions_of_trial_lists(self):
+        # the older layout: the trials are a list in the trialdata
+        result = Result.objects.create(
+            worker=self.worker, battery=self.battery,
+            experiment=self.template, completed=True,
+            taskdata=[{"trialdata": [{"rt": 400, "correct": True},
+                                     {"rt": 250, "correct": False},
+                                     {"rt": 200, "correct": False}]}])
+        self.assertEqual(get_variables(result, "mean_rt"), [850 / 3.0])
+        check_blacklist(result.id)
+        experiment_reward(result.id)
+        blacklist = Blacklist.objects.get(worker=self.worker)
+        self.assertTrue(blacklist.active)
+        self.assertEqual(blacklist.flags["task"]["description"],
+                         "mean_correct 0.333333333333 LESSTHAN 0.5")
+        bonus = Bonus.objects.get(worker=self.worker)
+        self.assertEqual(bonus.amounts["task"]["amount"], 0.25)
+        self.assertEqual(bonus.amounts["task"]["description"],
+                         "rt 200 LESSTHAN 300")
+
+    def test_process_completed_result(self):
+        result = self.make_result([{"rt": 250, "correct": False}])
+        self.assertTrue(process_completed_result(result.id))
+        self.assertTrue(Blacklist.objects.get(worker=self.worker).active)
+        bonus = Bonus.objects.get(worker=self.worker)
+        result = Result.objects.get(id=result.id)
+        self.assertTrue(result.processed)
+        self.assertTrue(result.credit_granted)
+
+        # a result is only processed once
+        Bonus.objects.filter(id=bonus.id).update(amounts={})
+        self.assertFalse(process_completed_result(result.id))
+        self.assertEqual(Bonus.objects.get(id=bonus.id).amounts, {})
+
+    def test_conditions_not_met(self):
+        result = self.make_result([{"rt": 400, "correct": True}])
+        check_blacklist(result.id)
+        experiment_reward(result.id)
+        self.assertFalse(Blacklist.objects.exists())
+        self.assertFalse(Bonus.objects.exists())
+
+    def test_comparisons(self):
+        flag = ExperimentVariable(id=1, name="flag")
+        conditions = [CreditCondition(variable=flag, value="false",
+                                      operator="EQUALS", amount=1)]
+        taskdata = [{"trialdata": {"flag": True}},
+                    {"trialdata": {"flag": "false"}},
+                    {"flag": False, "trialdata": {}}]
+        outcome = evaluate_credit_conditions(taskdata, conditions,
+                                             rejection_variable_id=1,
+                                             performance_variable_id=1)
+        self.assertEqual(outcome.rejection, "flag false EQUALS false")
+        self.assertEqual(outcome.bonuses, [(1, "flag False EQUALS false")])
+
+        # conditions on other variables, and other taskdata, aren't evaluated
+        self.assertIsNone(evaluate_credit_conditions(
+            taskdata, conditions, rejection_variable_id=2).rejection)
+        self.assertIsNone(evaluate_credit_conditions(
+            {"survey": "answers"}, conditions, 1).rejection)
+
+    def test_variable_expressions(self):
+        taskdata = [{"trialdata": {"rt": 400, "correct": True}},
+                    {"trialdata": {"rt": 600, "correct": False}},
+                    {"trialdata": {"rt": 800, "correct": True}},
+                    {"trialdata": {"correct": True}, "total_points": 7}]
+
+        def evaluate(expression):
+            return evaluate_variables(taskdata, [expression])[expression].values
+
+        self.assertEqual(evaluate("rt"), [400, 600, 800])
+        self.assertEqual(evaluate("mean_rt"), [600.0])
+        self.assertEqual(evaluate("median_correct"), [1.0])
+        self.assertEqual(evaluate("count_rt"), [3])
+        self.assertEqual(evaluate("p50_rt"), [600.0])
+        self.assertAlmostEqual(evaluate("std_rt")[0], 163.299, places=3)
+        self.assertEqual(evaluate("mean_rt[correct==true]"), [600.0])
+        self.assertEqual(evaluate("rt[correct==false]"), [600])
+        self.assertEqual(evaluate("count_rt[correct==true, rt > 500]"), [1])
+        self.assertEqual(evaluate("mean_rt[correct==maybe]"), [])
+        # a variable with the name of a summary is read as it is
+        self.assertEqual(evaluate("total_points"), [7])
+        self.assertEqual(evaluate("rt[correct]"), [])
+
+        # list values of the same length are compared as they are
+        taskdata = [{"trialdata": {"rt": 400, "responses": ["a", "b"]}},
+                    {"trialdata": {"rt": 600, "responses": ["c", "d"]}}]
+        self.assertEqual(evaluate("rt[responses==x]"), [])
+        self.assertEqual(evaluate("count_responses"), [2])
+
+        plan = compile_variable("p95_rt[key_press!='q']")
+        self.assertEqual((plan.summary, plan.variable, plan.filters),
+                         ("p95", "rt", [("key_press", "NOTEQUALTO", "q")]))
+        self.assertIs(get_variable_plan("mean_rt"),
+                      get_variable_plan("mean_rt"))
+
+
+@override_settings(
+    MTURK_CONNECTION_CLASS="expdj.apps.turk.testing.LocalMTurkConnection",
+    MTURK_PAYOUT_CONCURRENCY=2)
+class BonusPayoutTests(TestCase):
+    '''pay_bonuses should pay the queued bonuses in batches, once each, and
+    record every payout in the ledger'''
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery", owner=owner,
+                                              credentials="dummy.cred",
+                                              maximum_time=120,
+                                              number_of_experiments=1)
+        template = ExperimentTemplate.objects.create(
+            exp_id="test_task", name="Test Task", time=5, reference="",
+            template="jspsych")
+        HIT.objects.bulk_create([HIT(battery=self.battery, owner=owner,
+                                     mturk_id="HITID", title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1,
+                                     status=HIT.ASSIGNABLE)])
+        hit = HIT.objects.get(mturk_id="HITID")
+        LocalMTurkConnection.reset()
+        self.results = []
+        for w in range(5):
+            worker = Worker.objects.create(id="WORKER%s" % w)
+            assignment = Assignment.objects.create(
+                mturk_id="ASSIGNMENT%s" % w, hit=hit, worker=worker)
+            self.results.append(Result.objects.create(
+                worker=worker, battery=self.battery, experiment=template,
+                assignment=assignment, completed=True))
+            Bonus.objects.create(worker=worker, battery=self.battery,
+                                 amounts={"test_task": {
+                                     "experiment_id": 1,
+                                     "description": "rt LESSTHAN 500",
+                                     "amount": 0.25}})
+        caches["mturk"].clear()
+
+    def tearDown(self):
+        caches["mturk"].clear()
+
+    def queue(self):
+        for result in self.results:
+            bonus = Bonus.objects.get(worker=result.worker)
+            self.assertTrue(queue_bonus_payout(bonus, result.assignment))
+            self.assertFalse(queue_bonus_payout(bonus, result.assignment))
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, MTURK_PAYOUT_BATCH_SIZE=3)
+    def test_pay_bonuses(self):
+        self.queue()
+        self.assertEqual(Bonus.objects.filter(
+            payout_status=Bonus.PENDING).count(), 5)
+
+        # a batch is paid, and the run queues itself for the rest
+        self.assertEqual(pay_bonuses(), 3)
+        self.assertEqual(pay_bonuses(), 0)
+        self.assertEqual(LocalMTurkConnection.count("grant_bonus"), 5)
+        self.assertEqual(sorted(LocalMTurkConnection.bonuses),
+                         [("WORKER%s" % w, "ASSIGNMENT%s" % w, 0.25)
+                          for w in range(5)])
+        self.assertEqual(Bonus.objects.filter(payout_status=Bonus.PAID,
+                                              granted=True).count(), 5)
+        self.assertEqual(BonusPayment.objects.filter(
+            status=BonusPayment.PAID).count(), 5)
+
+        # a bonus queued again is not paid twice
+        Bonus.objects.update(payout_status=Bonus.PENDING)
+        self.assertEqual(pay_bonuses(), 0)
+        self.assertEqual(LocalMTurkConnection.count("grant_bonus"), 5)
+        self.assertEqual(Bonus.objects.filter(
+            payout_status=Bonus.PAID).count(), 5)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_grant_bonus_queues_the_payout(self):
+        self.assertTrue(grant_bonus(self.results[0].id))
+        self.assertFalse(grant_bonus(self.results[0].id))
+        self.assertEqual(LocalMTurkConnection.bonuses,
+                         [("WORKER0", "ASSIGNMENT0", 0.25)])
+        self.assertTrue(Bonus.objects.get(worker_id="WORKER0").granted)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, MTURK_PAYOUT_MAX_ATTEMPTS=2)
+    def test_refused_payouts_are_retried(self):
+        self.queue()
+        LocalMTurkConnection.fail("grant_bonus", boto.exception.BotoServerError(
+            400, "Bad Request",
+            "<Error><Code>InsufficientFunds</Code></Error>"))
+        # the run queues itself again while bonuses are pending
+        self.assertEqual(pay_bonuses(), 0)
+        self.assertEqual(LocalMTurkConnection.count("grant_bonus"), 10)
+        self.assertEqual(Bonus.objects.filter(payout_status=Bonus.FAILED,
+                                              payout_attempts=2).count(), 5)
+        errors = BonusPayment.objects.filter(status=BonusPayment.ERROR)
+        self.assertEqual(errors.count(), 10)
+        self.assertIn("InsufficientFunds", errors[0].error)
+
+    def test_interrupted_payouts_are_not_sent_again(self):
+        self.queue()
+        stale = timezone.now() - datetime.timedelta(hours=1)
+        Bonus.objects.filter(worker_id="WORKER0").update(
+            payout_status=Bonus.SENDING, payout_time=stale)
+        LocalMTurkConnection.fail("grant_bonus", RuntimeError("timed out"))
+        Bonus.objects.filter(worker_id="WORKER1").update(
+            payout_status=None, assignment=None)
+        Bonus.objects.filter(worker_id__in=["WORKER2", "WORKER3"]).update(
+            payout_status=None)
+
+        self.assertEqual(pay_bonuses(), 0)
+        self.assertEqual(LocalMTurkConnection.count("grant_bonus"), 1)
+        self.assertEqual(
+            list(Bonus.objects.filter(payout_status=Bonus.UNKNOWN).order_by(
+                "worker_id").values_list("worker_id", flat=True)),
+            ["WORKER0", "WORKER4"])
+        self.assertEqual(BonusPayment.objects.filter(
+            status=BonusPayment.UNKNOWN).count(), 2)
+
+        # unknown payouts are left to be checked, not retried
+        LocalMTurkConnection.reset()
+        Bonus.objects.filter(worker_id="WORKER4").update(
+            payout_status=Bonus.PENDING)
+        self.assertEqual(pay_bonuses(), 0)
+        self.assertEqual(LocalMTurkConnection.count("grant_bonus"), 0)
+        self.assertEqual(Bonus.objects.get(worker_id="WORKER4").payout_status,
+                         Bonus.UNKNOWN)
+
+
+@override_settings(
+    MTURK_CONNECTION_CLASS="expdj.apps.turk.testing.LocalMTurkConnection",
+    MTURK_REVIEW_BATCH_SIZE=2, MTURK_REVIEW_CONCURRENCY=2)
+class AssignmentReviewTests(TestCase):
+    '''review jobs should approve or reject the assignments selected by the
+    review filters in batches, and sync each HIT once'''
+
+    def setUp(self):
+        self.owner = User.objects.create_superuser(
+            username="owner", email="owner@expfactory.org", password="owner")
+        self.battery = Battery.objects.create(name="battery", owner=self.owner,
+                                              credentials="dummy.cred",
+                                              maximum_time=120,
+                                              number_of_experiments=1)
+        HIT.objects.bulk_create([HIT(battery=self.battery, owner=self.owner,
+                                     mturk_id="HITID", title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1,
+                                     status=HIT.ASSIGNABLE)])
+        self.hit = HIT.objects.get(mturk_id="HITID")
+        LocalMTurkConnection.reset()
+        LocalMTurkConnection.add_hit("HITID")
+        for a in range(6):
+            LocalMTurkConnection.add_assignment(
+                "HITID", "ASSIGNMENT%s" % a, "WORKER%s" % a)
+        self.hit.update_assignments()
+        LocalMTurkConnection.calls.clear()
+        Blacklist.objects.create(worker_id="WORKER0", battery=self.battery,
+                                 active=True)
+        Bonus.objects.create(worker_id="WORKER1", battery=self.battery,
+                             granted=True)
+        Bonus.objects.create(worker_id="WORKER2", battery=self.battery)
+        caches["mturk"].clear()
+
+    def tearDown(self):
+        caches["mturk"].clear()
+
+    def select(self, **filters):
+        return sorted(get_review_assignments(
+            self.battery, hit=self.hit,
+            filters=get_review_filters(filters)).values_list(
+                "worker_id", flat=True))
+
+    def make_job(self, action, **filters):
+        filters = get_review_filters(filters)
+        ids = list(get_review_assignments(
+            self.battery, filters=filters).values_list("id", flat=True))
+        return ReviewJob.objects.create(battery=self.battery, action=action,
+                                        filters=filters, assignments=ids,
+                                        assignment_count=len(ids))
+
+    def test_review_filters(self):
+        self.assertEqual(len(self.select()), 6)
+        self.assertEqual(self.select(blacklist="blacklisted"), ["WORKER0"])
+        self.assertEqual(len(self.select(blacklist="not_blacklisted")), 5)
+        self.assertEqual(self.select(bonus="none"),
+                         ["WORKER0", "WORKER3", "WORKER4", "WORKER5"])
+        self.assertEqual(self.select(bonus="unpaid"), ["WORKER2"])
+        self.assertEqual(self.select(bonus="paid", blacklist="blacklisted"),
+                         [])
+        self.assertEqual(self.select(status=Assignment.APPROVED), [])
+        self.assertRaises(ValidationError, get_review_filters,
+                          {"bonus": "some"})
+
+    def test_review_assignments(self):
+        job = self.make_job(ReviewJob.APPROVE, blacklist="not_blacklisted")
+        review_assignments(job.id)
+        job = ReviewJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.get_progress()),
+                         (ReviewJob.FINISHED, 100))
+        self.assertEqual((job.assignments_reviewed, job.assignments_failed),
+                         (5, 0))
+        self.assertEqual(LocalMTurkConnection.count("approve_assignment"), 5)
+        # one sync of the HIT at the end
+        self.assertEqual(LocalMTurkConnection.count("get_assignments"), 1)
+        self.assertEqual(LocalMTurkConnection.count(), 6)
+        self.assertEqual(self.select(status=Assignment.APPROVED),
+                         ["WORKER%s" % w for w in range(1, 6)])
+        self.assertEqual(self.select(), ["WORKER0"])
+
+        # a job is run once
+        review_assignments(job.id)
+        self.assertEqual(LocalMTurkConnection.count("approve_assignment"), 5)
+
+    def test_stale_review_job_resumes(self):
+        job = self.make_job(ReviewJob.REJECT)
+        # the worker was killed after the first assignment
+        first = Assignment.objects.get(mturk_id="ASSIGNMENT0")
+        Assignment.objects.filter(id=first.id).update(
+            status=Assignment.REJECTED)
+        ReviewJob.objects.filter(id=job.id).update(
+            status=ReviewJob.RUNNING, assignments_reviewed=1)
+        review_assignments(job.id)
+        self.assertEqual(LocalMTurkConnection.count("reject_assignment"), 0)
+
+        stale = timezone.now() - datetime.timedelta(hours=1)
+        ReviewJob.objects.filter(id=job.id).update(modify_date=stale)
+        self.assertTrue(ReviewJob.objects.get(id=job.id).is_stale())
+        review_assignments(job.id)
+        job = ReviewJob.objects.get(id=job.id)
+        self.assertEqual(LocalMTurkConnection.count("reject_assignment"), 5)
+        self.assertEqual((job.status, job.assignment_count,
+                          job.assignments_reviewed, job.get_progress()),
+                         (ReviewJob.FINISHED, 6, 6, 100))
+        self.assertFalse(job.is_stale())
+
+    def test_review_failures(self):
+        LocalMTurkConnection.fail("reject_assignment",
+                                  boto.exception.BotoServerError(
+                                      400, "Bad Request", "<Error/>"))
+        job = self.make_job(ReviewJob.REJECT, bonus="none")
+        review_assignments(job.id)
+        job = ReviewJob.objects.get(id=job.id)
+        self.assertEqual(job.status, ReviewJob.FINISHED)
+        self.assertEqual((job.assignments_reviewed, job.assignments_failed),
+                         (0, 4))
+        self.assertEqual(sorted(job.failures), ["ASSIGNMENT0", "ASSIGNMENT3",
+                                                "ASSIGNMENT4", "ASSIGNMENT5"])
+        self.assertEqual(len(self.select()), 6)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_review_views(self):
+        self.client.force_login(self.owner)
+        url = reverse("review_battery_assignments", args=[self.battery.id])
+        response = self.client.get(url, {"bonus": "none"})
+        self.assertEqual(response.json()["assignment_count"], 4)
+        response = self.client.get(url, {"bonus": "some"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {"action": "maybe"})
+        self.assertEqual(response.status_code, 400)
+        # the assignments changed since they were confirmed
+        response = self.client.post(url, {"action": "reject", "bonus": "none",
+                                          "assignment_count": 3})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["assignment_count"], 4)
+        self.assertFalse(ReviewJob.objects.exists())
+
+        response = self.client.post(
+            reverse("review_hit_assignments", args=[self.hit.id]),
+            {"action": "approve", "blacklist": "blacklisted",
+             "assignment_count": 1})
+        self.assertEqual(response.status_code, 202)
+        response = self.client.get(response.json()["status_url"])
+        self.assertEqual(response.json()["status"], ReviewJob.FINISHED)
+        self.assertEqual(response.json()["assignments_reviewed"], 1)
+        self.assertEqual(self.select(status=Assignment.APPROVED), ["WORKER0"])
@@ -7,7 +7,9 @@ from expdj.apps.turk.views import (clone_hit, contact_worker, delete_hit,
                                    edit_hit, end_assignment, expire_hit,
                                    finished_view, hit_detail, manage_hit,
                                    multiple_new_hit, not_consent_view,
-                                   preview_hit, serve_hit, survey_submit)
+                                   preview_hit, review_battery_assignments,
+                                   review_hit_assignments, review_job_status,
+                                   serve_hit, survey_submit)
 
 urlpatterns = [
     # HITS
@@ -40,6 +42,14 @@ urlpatterns = [
     url(r'^hits/(?P<hid>\d+|[A-Z]{8})/delete$', delete_hit, name='delete_hit'),
     url(r'^hits/(?P<hid>\d+|[A-Z]{8})/expire$', expire_hit, name='expire_hit'),
 
+    # Assignment review
+    url(r'^hits/(?P<hid>\d+|[A-Z]{8})/review$', review_hit_assignments,
+        name='review_hit_assignments'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/review$',
+        review_battery_assignments, name='review_battery_assignments'),
+    url(r'^reviews/(?P<jid>\d+)/$', review_job_status,
+        name='review_job_status'),
+
     # Turk Deployments
     url(r'^accept/(?P<hid>\d+|[A-Z]{8})', serve_hit, name='serve_hit'),
     url(r'^turk/(?P<hid>\d+|[A-Z]{8})', preview_hit, name='preview_hit'),
@@ -2,12 +2,13 @@ import ConfigParser
 import datetime
 import json
 import os
+import threading
+import time
 
-import pandas
-from boto.mturk.connection import MTurkConnection
 from boto.mturk.price import Price
 from boto.mturk.question import ExternalQuestion
 from django.conf import settings
+from django.utils.module_loading import import_string
 
 from expdj.apps.experiments.models import Experiment
 from expdj.settings import BASE_DIR, MTURK_ALLOW
@@ -21,6 +22,80 @@ def to_dict(input_ordered_dict):
     return json.loads(json.dumps(input_ordered_dict))
 
 
+def load_json(value):
+    '''load_json returns the python value of a JSON field read with values or
+    values_list, which return the stored JSON text for a text column
+    :param value: the value read, JSON text or an already decoded value
+    '''
+    if isinstance(value, basestring):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+def iter_trials(taskdata):
+    '''iter_trials yields the trials of an experiment taskdata, in order. An
+    element of the taskdata is a trial, with its variables in a "trialdata"
+    dict and at its top level, or, in the older layout, holds a list of
+    trials as its "trialdata". Anything else in the list is an empty trial,
+    and taskdata that isn't a list (surveys, games) has no trials.
+    :param taskdata: the taskdata of a Result
+    '''
+    if not isinstance(taskdata, list):
+        return
+    for element in taskdata:
+        if not isinstance(element, dict):
+            yield {}
+        elif isinstance(element.get("trialdata"), list):
+            for trial in element["trialdata"]:
+                yield trial if isinstance(trial, dict) else {}
+        else:
+            yield element
+
+
+def get_trial_variables(taskdata):
+    '''get_trial_variables returns the set of variable names in the trials of
+    an experiment taskdata, both trial level keys and keys of the nested
+    "trialdata". Taskdata that isn't a list of trials (surveys, games) has none.
+    :param taskdata: the taskdata of a Result
+    '''
+    variables = set()
+    for trial in iter_trials(taskdata):
+        variables.update(k for k in trial.keys() if k != "trialdata")
+        if isinstance(trial.get("trialdata"), dict):
+            variables.update(trial["trialdata"].keys())
+    return variables
+
+
+def get_trial_value(trial, variable_name):
+    '''get_trial_value returns a (found, value) tuple for a variable of a trial.
+    A trialdata value wins over a trial level one, as in the exports.
+    '''
+    if not isinstance(trial, dict):
+        return False, None
+    trialdata = trial.get("trialdata")
+    if isinstance(trialdata, dict) and variable_name in trialdata:
+        return True, trialdata[variable_name]
+    if variable_name in trial:
+        return True, trial[variable_name]
+    return False, None
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+
+def get_summary_values(values):
+    '''get_summary_values returns the numeric values of a trial variable as
+    floats for a summary statistic, booleans count as 0 or 1
+    '''
+    return [float(value) for value in values
+            if is_number(value) or isinstance(value, bool)]
+
+
 PRODUCTION_HOST = u'mechanicalturk.amazonaws.com'
 SANDBOX_HOST = u'mechanicalturk.sandbox.amazonaws.com'
 
@@ -37,7 +112,7 @@ def amazon_string_to_datetime(amazon_string):
         amazon_iso_format)
 
 
-def get_host(hit):
+def get_host(hit=None):
     """get_host returns correct amazon url depending on if HIT is specified
     for sandbox or not. The variable MTURK_ALLOW is specified in the settings
     as a global control for deployment permissions
@@ -84,27 +159,163 @@ def get_worker_url():
         return PRODUCTION_WORKER_URL
 
 
+# CREDENTIALS
+# Credentials files are parsed once per process, and again only when the
+# file is modified. Entries are keyed by path and hold the mtime they were
+# read at.
+_credentials_cache = {}
+_credentials_cache_lock = threading.Lock()
+
+
+def parse_credentials(text):
+    '''parse_credentials returns a dictionary of the NAME=value lines of a
+    credentials file. Blank lines are skipped, values may contain "="
+    :param text: the content of the credentials file
+    '''
+    credentials = dict()
+    for line in text.splitlines():
+        if "=" not in line:
+            continue
+        name, value = line.split("=", 1)
+        credentials[name.strip()] = value.strip()
+    return credentials
+
+
+def load_credentials(path):
+    '''load_credentials returns the parsed credentials file at path, read
+    from disk only if it was not loaded before or has changed since
+    :param path: full path to the credentials file
+    '''
+    mtime = os.path.getmtime(path)
+    with _credentials_cache_lock:
+        cached = _credentials_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(path, "r") as filey:
+        credentials = parse_credentials(filey.read())
+    with _credentials_cache_lock:
+        _credentials_cache[path] = (mtime, credentials)
+    return credentials
+
+
 def get_credentials(battery):
     """Load credentials from a credentials file"""
-    credentials = "%s/expdj/auth/%s" % (BASE_DIR, battery.credentials)
-    credentials = pandas.read_csv(
-        credentials, sep="=", index_col=0, header=None)
-    AWS_ACCESS_KEY_ID = credentials.loc["AWS_ACCESS_KEY_ID"][1]
-    AWS_SECRET_ACCESS_KEY_ID = credentials.loc["AWS_SECRET_ACCESS_KEY_ID"][1]
+    credentials = load_credentials(
+        "%s/expdj/auth/%s" % (BASE_DIR, battery.credentials))
+    AWS_ACCESS_KEY_ID = credentials["AWS_ACCESS_KEY_ID"]
+    AWS_SECRET_ACCESS_KEY_ID = credentials["AWS_SECRET_ACCESS_KEY_ID"]
     return AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY_ID
 
 
+# CONNECTION POOL
+# MTurk connections are kept per process and thread, and shared by every HIT
+# and Assignment (and celery task) of the thread using the same credentials
+# and host, so that boto can reuse its HTTP connections instead of a TLS
+# handshake per object. A boto connection is not shared between threads (eg
+# uwsgi threads, or the thread pools of pay_bonuses and review_assignments).
+_connection_pool = {}
+_connection_pool_lock = threading.Lock()
+_connection_pool_pid = os.getpid()
+
+
+class PooledConnection(object):
+    '''PooledConnection is an entry of the connection pool'''
+
+    def __init__(self, connection, aws_secret_access_key):
+        self.connection = connection
+        self.aws_secret_access_key = aws_secret_access_key
+        self.created = time.time()
+        self.last_used = self.created
+
+
+def get_connection_key(aws_access_key_id, host):
+    '''get_connection_key returns the pool key for a connection class,
+    access key and host, in the current thread'''
+    return (settings.MTURK_CONNECTION_CLASS, aws_access_key_id, host,
+            threading.current_thread().ident)
+
+
+def is_connection_healthy(pooled, aws_secret_access_key, now=None):
+    '''is_connection_healthy checks that a pooled connection can be reused:
+    the secret key has not been rotated and it has not been idle for longer than
+    MTURK_CONNECTION_IDLE_TIMEOUT seconds
+    :param pooled: the PooledConnection to check
+    :param aws_secret_access_key: the secret key the caller would connect with
+    '''
+    if now is None:
+        now = time.time()
+    if pooled.aws_secret_access_key != aws_secret_access_key:
+        return False
+    return now - pooled.last_used <= settings.MTURK_CONNECTION_IDLE_TIMEOUT
+
+
+def evict_idle_connections(now=None):
+    '''evict_idle_connections closes and removes pooled connections that have
+    not been used for MTURK_CONNECTION_IDLE_TIMEOUT seconds. A forked
+    process (eg, a celery worker) starts with an empty pool.
+    '''
+    global _connection_pool_pid
+    if now is None:
+        now = time.time()
+    with _connection_pool_lock:
+        if _connection_pool_pid != os.getpid():
+            _connection_pool.clear()
+            _connection_pool_pid = os.getpid()
+        for key, pooled in list(_connection_pool.items()):
+            if now - pooled.last_used > settings.MTURK_CONNECTION_IDLE_TIMEOUT:
+                close_connection(_connection_pool.pop(key).connection)
+
+
+def close_connection(connection):
+    if hasattr(connection, "close"):
+        connection.close()
+
+
+def discard_connection(connection):
+    '''discard_connection removes a connection from the pool, eg after a
+    network error, so that the next get_connection makes a new one
+    :param connection: a connection returned by get_connection
+    '''
+    with _connection_pool_lock:
+        for key, pooled in list(_connection_pool.items()):
+            if pooled.connection is connection:
+                close_connection(_connection_pool.pop(key).connection)
+
+
+def clear_connection_pool():
+    with _connection_pool_lock:
+        for pooled in _connection_pool.values():
+            close_connection(pooled.connection)
+        _connection_pool.clear()
+
+
 def get_connection(aws_access_key_id, aws_secret_access_key, hit=None):
-    """Create connection based upon settings/configuration parameters"""
+    """Return a pooled connection based upon settings/configuration parameters,
+    creating it the first time the credentials and host are used in the
+    thread"""
 
     host = get_host(hit)
-    debug = get_debug(hit)
-
-    return MTurkConnection(
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        host=host,
-        debug=debug)
+    key = get_connection_key(aws_access_key_id, host)
+    now = time.time()
+    evict_idle_connections(now)
+
+    with _connection_pool_lock:
+        pooled = _connection_pool.get(key)
+        if pooled is not None:
+            if is_connection_healthy(pooled, aws_secret_access_key, now):
+                pooled.last_used = now
+                return pooled.connection
+            close_connection(_connection_pool.pop(key).connection)
+
+        MTurkConnection = import_string(settings.MTURK_CONNECTION_CLASS)
+        connection = MTurkConnection(
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            host=host,
+            debug=get_debug(hit))
+        _connection_pool[key] = PooledConnection(connection,
+                                                 aws_secret_access_key)
+        return connection
 
 
 def get_app_url():
@@ -119,18 +330,13 @@ def get_worker_experiments(worker, battery, completed=False):
     :param completed: boolean, default False to return uncompleted experiments
     '''
     from expdj.apps.turk.models import Result
-    battery_tags = [x.template.exp_id for x in battery.experiments.all()]
-    worker_experiments = Result.objects.filter(worker=worker, battery=battery)
-    worker_tags = [
-        x.experiment.exp_id for x in worker_experiments if x.completed]
-
+    worker_templates = Result.objects.filter(
+        worker=worker, battery=battery, completed=True).values(
+        "experiment_id")
+    experiments = battery.experiments.select_related("template")
     if not completed:
-        experiment_selection = [
-            e for e in battery_tags if e not in worker_tags]
-    else:
-        experiment_selection = [e for e in worker_tags if e in battery_tags]
-    return Experiment.objects.filter(template__exp_id__in=experiment_selection,
-                                     battery_experiments__id=battery.id)
+        return experiments.exclude(template_id__in=worker_templates)
+    return experiments.filter(template_id__in=worker_templates)
 
 
 def get_time_difference(d1, d2, format='%Y-%m-%d %H:%M:%S'):
@@ -5,10 +5,12 @@ from optparse import make_option
 
 import requests
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand
 from django.core.urlresolvers import reverse
 from django.http.response import (Http404, HttpResponse, HttpResponseForbidden,
-                                  HttpResponseNotAllowed, HttpResponseRedirect)
+                                  HttpResponseNotAllowed, HttpResponseRedirect,
+                                  JsonResponse)
 from django.shortcuts import (get_object_or_404, redirect, render,
                               render_to_response)
 from django.utils import timezone
@@ -16,19 +18,23 @@ from django.views.decorators.csrf import ensure_csrf_cookie
 from expfactory.battery import get_experiment_run, get_load_static
 from numpy.random import choice
 
-from expdj.apps.experiments.models import Battery, ExperimentTemplate
-from expdj.apps.experiments.utils import (get_experiment_type,
+from expdj.apps.experiments.models import Battery
+from expdj.apps.experiments.utils import (BatteryContext,
+                                          get_experiment_type,
                                           select_experiments)
 from expdj.apps.experiments.views import (check_battery_edit_permission,
                                           check_mturk_access, deploy_battery,
-                                          get_battery_intro)
+                                          get_battery, get_battery_intro)
 from expdj.apps.turk.forms import HITForm, WorkerContactForm
-from expdj.apps.turk.models import HIT, Assignment, Result, Worker, get_worker
+from expdj.apps.turk.models import (HIT, Assignment, Result, ReviewJob, Worker,
+                                    get_hit_status, get_review_assignments,
+                                    get_review_filters, get_worker,
+                                    remove_hit)
 from expdj.apps.turk.tasks import (assign_experiment_credit,
                                    check_battery_dependencies,
-                                   get_unique_experiments)
+                                   review_assignments, schedule_hit_refresh)
 from expdj.apps.turk.utils import (get_connection, get_credentials, get_host,
-                                   get_worker_experiments, get_worker_url)
+                                   get_worker_url)
 from expdj.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT
 
 media_dir = os.path.join(BASE_DIR, MEDIA_ROOT)
@@ -40,7 +46,7 @@ media_dir = os.path.join(BASE_DIR, MEDIA_ROOT)
 def get_hit(hid, request, mode=None):
     keyargs = {'pk': hid}
     try:
-        hit = HIT.objects.get(**keyargs)
+        hit = HIT.objects.select_related("battery").get(**keyargs)
     except HIT.DoesNotExist:
         raise Http404
     else:
@@ -130,9 +136,12 @@ def serve_hit(request, hid):
 
         hit = get_hit(hid, request)
 
-        # Update the hit, only allow to continue if HIT is valid
-        hit.update()
-        if hit.status in ["D"]:
+        # Only allow to continue if HIT is valid. The status is refreshed
+        # from Amazon in the background, the worker never waits on it
+        status, fresh = get_hit_status(hit)
+        if not fresh and status != HIT.DISPOSED:
+            schedule_hit_refresh(hit)
+        if status in [HIT.DISPOSED]:
             return render_to_response("turk/hit_expired.html")
 
         battery = hit.battery
@@ -144,7 +153,7 @@ def serve_hit(request, hid):
         # Get Experiment Factory objects for each
         worker = get_worker(aws["worker_id"])
 
-        check_battery_response = check_battery_view(battery, aws["worker_id"])
+        check_battery_response = check_battery_view(battery, worker.id)
         if (check_battery_response):
             return check_battery_response
 
@@ -163,19 +172,20 @@ def serve_hit(request, hid):
 
         # Initialize Assignment object, obtained from Amazon, and Result
         assignment, already_created = Assignment.objects.get_or_create(
-            mturk_id=aws["assignment_id"], worker=worker, hit=hit)
+            mturk_id=aws["assignment_id"], worker=worker, hit=hit,
+            defaults={"accept_time": datetime.now()})
 
         # if the assignment is new, we need to set up a task to run when the
         # worker time runs out to allocate credit
         if already_created:
-            assignment.accept_time = datetime.now()
             if hit.assignment_duration_in_hours is not None:
                 assign_experiment_credit.apply_async(
                     [worker.id], countdown=360 * (hit.assignment_duration_in_hours))
-            assignment.save()
 
         # Does the worker have experiments remaining for the hit?
-        uncompleted_experiments = get_worker_experiments(worker, hit.battery)
+        battery_context = BatteryContext(battery)
+        uncompleted_experiments = battery_context.get_worker_experiments(
+            worker)
         experiments_left = len(uncompleted_experiments)
         if experiments_left == 0:
             # Thank you for your participation - no more experiments!
@@ -188,10 +198,11 @@ def serve_hit(request, hid):
             last_experiment = True
 
         task_list = select_experiments(battery, uncompleted_experiments)
-        experimentTemplate = ExperimentTemplate.objects.filter(
-            exp_id=task_list[0].template.exp_id)[0]
+        experimentTemplate = task_list[0].template
         experiment_type = get_experiment_type(experimentTemplate)
-        task_list = battery.experiments.filter(template=experimentTemplate)
+        task_list = battery_context.get_template_experiments(
+            experimentTemplate)
+        battery_context.set_last_experiment(worker, experimentTemplate)
         template = "%s/mturk_battery.html" % (experiment_type)
 
         # Generate a new results object for the worker, assignment, experiment
@@ -200,7 +211,6 @@ def serve_hit(request, hid):
                                                     assignment=assignment,  # assignment has record of HIT
                                                     battery=hit.battery,
                                                     defaults={"browser": browser, "platform": platform})
-        result.save()
 
         # Add variables to the context
         aws["amazon_host"] = host
@@ -221,7 +231,8 @@ def serve_hit(request, hid):
             next_page=None,
             result=result,
             last_experiment=last_experiment,
-            experiments_left=experiments_left - 1
+            experiments_left=experiments_left - 1,
+            battery_context=battery_context
         )
 
     else:
@@ -436,7 +447,7 @@ def expire_hit(request, hid):
             try:
                 hit.expire()
             except BaseException:
-                hit.delete()
+                remove_hit(hit)
         return redirect(battery.get_absolute_url())
     else:
         return HttpResponseForbidden()
@@ -456,12 +467,97 @@ def delete_hit(request, hid):
                 hit.dispose()
             except BaseException:
                 pass
-            hit.delete()
+            remove_hit(hit)
         return redirect(hit.battery.get_absolute_url())
     else:
         return HttpResponseForbidden()
 
 
+def get_review_job_context(job):
+    context = {"id": job.id,
+               "action": job.action,
+               "status": job.status,
+               "filters": job.filters,
+               "progress": job.get_progress(),
+               "assignment_count": job.assignment_count,
+               "assignments_reviewed": job.assignments_reviewed,
+               "assignments_failed": job.assignments_failed,
+               "status_url": job.get_absolute_url()}
+    if job.failures:
+        context["failures"] = job.failures
+    if job.error is not None:
+        context["error"] = job.error
+    return context
+
+
+def review_job(request, battery, hit=None):
+    '''review_job returns the number of assignments of a battery (or HIT) that
+    pass the review filters (GET), or approves or rejects them in the
+    background (POST), returning the status of the ReviewJob. A POST with
+    the assignment_count that was confirmed is refused if the assignments
+    changed since.
+    :param battery: the battery to review assignments for
+    :param hit: only review the assignments of this HIT [optional]
+    '''
+    if not check_mturk_access(request) or \
+            not check_battery_edit_permission(request, battery):
+        return HttpResponseForbidden()
+
+    data = request.POST if request.method == "POST" else request.GET
+    try:
+        filters = get_review_filters(data)
+    except ValidationError as e:
+        return JsonResponse({"message": e.messages[0]}, status=400)
+    assignments = get_review_assignments(battery, hit=hit, filters=filters)
+    if request.method != "POST":
+        return JsonResponse({"filters": filters,
+                             "assignment_count": assignments.count()})
+
+    action = request.POST.get("action")
+    if action not in dict(ReviewJob.ACTION_CHOICES):
+        return JsonResponse({"message": "Unknown review action %s" % action},
+                            status=400)
+    assignment_ids = list(assignments.values_list("id", flat=True))
+    confirmed = request.POST.get("assignment_count")
+    if confirmed is not None and confirmed != str(len(assignment_ids)):
+        return JsonResponse({"message": "The assignments changed, %s pass "
+                             "the filters" % len(assignment_ids),
+                             "assignment_count": len(assignment_ids)},
+                            status=409)
+    job = ReviewJob.objects.create(battery=battery,
+                                   hit=hit,
+                                   action=action,
+                                   feedback=request.POST.get("feedback") or None,
+                                   filters=filters,
+                                   assignments=assignment_ids,
+                                   owner=request.user,
+                                   assignment_count=len(assignment_ids))
+    review_assignments.apply_async([job.id])
+    return JsonResponse(get_review_job_context(job), status=202)
+
+
+@login_required
+def review_hit_assignments(request, hid):
+    hit = get_hit(hid, request)
+    return review_job(request, hit.battery, hit=hit)
+
+
+@login_required
+def review_battery_assignments(request, bid):
+    battery = get_battery(bid, request)
+    return review_job(request, battery)
+
+
+@login_required
+def review_job_status(request, jid):
+    job = get_object_or_404(ReviewJob, pk=jid)
+    if not check_battery_edit_permission(request, job.battery):
+        return HttpResponseForbidden()
+    if job.is_stale():
+        review_assignments.apply_async([job.id])
+    return JsonResponse(get_review_job_context(job))
+
+
 @login_required
 def hit_detail(request, hid):
     hit = get_object_or_404(HIT, pk=hid)
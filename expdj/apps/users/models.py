@@ -1,6 +1,9 @@
 from django.contrib.auth.models import User as djUser
+from django.core.cache import caches
 from django.db import models
 from django.db.models import DO_NOTHING, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from jsonfield import JSONField
 
 
@@ -25,3 +28,14 @@ class User(models.Model):
         null=True,
         blank=True,
         help_text="Name of user role.")
+
+
+def get_user_role_key(user_id):
+    return "user-role:%s" % user_id
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_role(sender, instance, **kwargs):
+    '''clear the cached role used by the permission checks when it changes'''
+    caches["permissions"].delete(get_user_role_key(instance.user_id))
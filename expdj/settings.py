@@ -146,13 +146,66 @@ STATICFILES_FINDERS = (
 SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
 
 SENDFILE_BACKEND = 'sendfile.backends.development'
+# Used by the nginx sendfile backend to serve result exports
+SENDFILE_ROOT = os.path.join(BASE_DIR, MEDIA_ROOT, 'exports')
+SENDFILE_URL = '/static/exports'
 PRIVATE_MEDIA_REDIRECT_HEADER = 'X-Accel-Redirect'
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
+# Class used to connect to Mechanical Turk, tests use
+# expdj.apps.turk.testing.LocalMTurkConnection
+MTURK_CONNECTION_CLASS = 'boto.mturk.connection.MTurkConnection'
+# Pooled MTurk connections unused for this many seconds are closed
+MTURK_CONNECTION_IDLE_TIMEOUT = 300
+
+# Caches are shared between uwsgi processes and celery workers through redis
+# (a different database on the broker server), with separate aliases for
+# rendered experiment payloads, MTurk API responses and permission lookups.
+# Increase CACHE_VERSION on deploy to invalidate every key at once. Set
+# EXPDJ_CACHE_BACKEND=locmem to use a local memory cache per process instead
+# (eg, running tests, or without redis). Redis errors are only ignored for
+# the aliases that can be recomputed: the mturk alias holds the refresh
+# leases and the request rate, which must not silently fail, and its readers
+# in the worker facing views fall back on the database (get_hit_status).
+CACHE_REDIS_URL = 'redis://redis:6379/1'
+CACHE_VERSION = int(os.environ.get('EXPDJ_CACHE_VERSION', 1))
+CACHE_BACKEND = os.environ.get('EXPDJ_CACHE_BACKEND', 'redis')
+DJANGO_REDIS_LOG_IGNORED_EXCEPTIONS = True
+
+
+def get_cache_config(alias, timeout=300, ignore_exceptions=False):
+    '''get_cache_config returns the CACHES entry for an alias, keys are
+    prefixed with the alias and versioned with CACHE_VERSION'''
+    config = {'KEY_PREFIX': 'expdj:%s' % alias,
+              'VERSION': CACHE_VERSION,
+              'TIMEOUT': timeout}
+    if CACHE_BACKEND == 'redis':
+        config.update({
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                        'SOCKET_CONNECT_TIMEOUT': 1,
+                        'SOCKET_TIMEOUT': 1,
+                        'IGNORE_EXCEPTIONS': ignore_exceptions}
+        })
+    else:
+        config.update({
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': alias
+        })
+    return config
+
+
 CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    'default': get_cache_config('default'),
+    # rendered load blocks and run code, invalidated by install_experiments
+    'experiments': get_cache_config('experiments', timeout=None,
+                                    ignore_exceptions=True),
+    # responses from the MTurk API (HIT status, assignments)
+    'mturk': get_cache_config('mturk', timeout=60),
+    # user roles for the permission checks in the views
+    'permissions': get_cache_config('permissions', timeout=300,
+                                    ignore_exceptions=True),
 }
 
 # Celery config
@@ -167,13 +220,59 @@ CELERY_QUEUES = (
 )
 CELERY_IMPORTS = ('expdj.apps.turk.tasks', )
 
-# here is how to run a task regularly
-# CELERYBEAT_SCHEDULE = {
-#    'task name': {
-#        'task': 'task_name',
-#        'schedule': timedelta(days=1)
-#    },
-# }
+# The status of active HITs is refreshed from Amazon by celery beat every
+# HIT_REFRESH_INTERVAL seconds, and cached for the worker facing views.
+# Their assignments are synced at most every ASSIGNMENTS_REFRESH_INTERVAL
+# seconds, however often the battery page is viewed
+HIT_REFRESH_INTERVAL = 60
+ASSIGNMENTS_REFRESH_INTERVAL = 300
+HIT_REFRESH_INTERVALS = {"status": HIT_REFRESH_INTERVAL,
+                         "assignments": ASSIGNMENTS_REFRESH_INTERVAL}
+# A queued refresh is considered lost after this many seconds
+HIT_REFRESH_LEASE = 600
+
+# Requests to Amazon from refresh tasks, across workers, and the backoff
+# of tasks that find the rate used up. Each page of an assignments listing
+# waits at most MTURK_PAGE_RATE_WAIT seconds for the request rate
+MTURK_REQUESTS_PER_SECOND = 5
+MTURK_BACKOFF_MAX = 300
+MTURK_MAX_RETRIES = 10
+MTURK_PAGE_RATE_WAIT = 10
+
+# Bonuses are paid by pay_bonuses in batches, a few payouts at a time, and
+# a payout is sent at most MTURK_PAYOUT_MAX_ATTEMPTS times. A payout that
+# hasn't finished after MTURK_PAYOUT_LEASE seconds is marked unknown, and a
+# payout waits at most MTURK_PAYOUT_RATE_WAIT seconds for the request rate
+MTURK_PAYOUT_BATCH_SIZE = 100
+MTURK_PAYOUT_CONCURRENCY = 4
+MTURK_PAYOUT_MAX_ATTEMPTS = 5
+MTURK_PAYOUT_LEASE = 600
+MTURK_PAYOUT_RATE_WAIT = 30
+MTURK_PAYOUT_INTERVAL = 300
+
+# Assignments are approved or rejected by review_assignments in batches,
+# a few at a time, each waiting at most MTURK_REVIEW_RATE_WAIT seconds for
+# the request rate. A review job that hasn't changed for MTURK_REVIEW_LEASE
+# seconds is considered lost, and enqueued again
+MTURK_REVIEW_BATCH_SIZE = 50
+MTURK_REVIEW_CONCURRENCY = 4
+MTURK_REVIEW_RATE_WAIT = 30
+MTURK_REVIEW_LEASE = 600
+
+# An export job that hasn't changed for EXPORT_JOB_LEASE seconds is
+# considered lost, eg its worker was killed, and enqueued again
+EXPORT_JOB_LEASE = 600
+
+CELERYBEAT_SCHEDULE = {
+    'refresh-active-hits': {
+        'task': 'expdj.apps.turk.tasks.refresh_active_hits',
+        'schedule': timedelta(seconds=HIT_REFRESH_INTERVAL)
+    },
+    'pay-bonuses': {
+        'task': 'expdj.apps.turk.tasks.pay_bonuses',
+        'schedule': timedelta(seconds=MTURK_PAYOUT_INTERVAL)
+    },
+}
 
 CELERY_TIMEZONE = 'Europe/Berlin'
 
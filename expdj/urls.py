@@ -20,7 +20,6 @@ from expdj.apps.experiments.models import (Battery, CognitiveAtlasTask,
 from expdj.apps.main import urls as main_urls
 from expdj.apps.turk import urls as turk_urls
 from expdj.apps.turk.models import Result, Worker
-from expdj.apps.turk.utils import to_dict
 from expdj.apps.users import urls as users_urls
 
 sitemaps = {"experiments": ExperimentTemplateSitemap,
@@ -73,7 +72,7 @@ class ResultSerializer(serializers.HyperlinkedModelSerializer):
     data = serializers.SerializerMethodField('get_taskdata')
 
     def get_taskdata(self, result):
-        return to_dict(result.taskdata)
+        return result.get_taskdata()
 
     class Meta:
         model = Result
@@ -93,7 +92,8 @@ class ResultSerializer(serializers.HyperlinkedModelSerializer):
 class ResultViewSet(viewsets.ModelViewSet):
     serializer_class = ResultSerializer
     def get_queryset(self):
-        return Result.objects.filter(battery__owner=self.request.user.pk)
+        return Result.objects.filter(
+            battery__owner=self.request.user.pk).select_related("data")
 
 
 # Routers provide an easy way of automatically determining the URL conf.
@@ -2,8 +2,10 @@
 python manage.py makemigrations experiments
 python manage.py makemigrations turk
 python manage.py makemigrations main
+python manage.py move_result_taskdata hold
 python manage.py migrate auth
 python manage.py migrate
+python manage.py move_result_taskdata restore
 python manage.py collectstatic --noinput
 mkdir /var/www/.well-known               
 mkdir /var/www/.well-known/acme-challenge
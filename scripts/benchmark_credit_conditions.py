@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+'''Benchmark for the evaluation of credit conditions by check_blacklist and
+experiment_reward.
+
+Compares the per trial loop the two tasks used to run (each task scanning the
+operators and the trials once per condition, comparing one value at a time)
+with the one pass, vectorized evaluation in expdj.apps.turk.credit, on
+synthetic results. Run from the application root (eg, inside the uwsgi
+container):
+
+    python scripts/benchmark_credit_conditions.py
+
+The size of the synthetic data is set with environment variables:
+
+    BENCHMARK_RESULTS     number of results (default 200)
+    BENCHMARK_TRIALS      trials per result (default 5000)
+    BENCHMARK_CONDITIONS  credit conditions per variable (default 3)
+
+No database objects are created.
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'expdj.settings')
+
+import django
+django.setup()
+
+import numpy
+
+from expdj.apps.experiments.models import CreditCondition, ExperimentVariable
+from expdj.apps.turk.credit import evaluate_credit_conditions
+
+N_RESULTS = int(os.environ.get("BENCHMARK_RESULTS", 200))
+N_TRIALS = int(os.environ.get("BENCHMARK_TRIALS", 5000))
+N_CONDITIONS = int(os.environ.get("BENCHMARK_CONDITIONS", 3))
+
+
+def make_taskdata(n_trials):
+    return [{"current_trial": t,
+             "trial_type": "poldrack-single-stim",
+             "trialdata": {"rt": random.randint(200, 1200),
+                           "correct": random.random() > 0.2,
+                           "key_press": random.choice([37, 39, -1])}}
+            for t in range(n_trials)]
+
+
+def make_conditions():
+    rejection = ExperimentVariable(id=1, name="mean_correct")
+    performance = ExperimentVariable(id=2, name="rt")
+    conditions = []
+    for c in range(N_CONDITIONS):
+        conditions.append(CreditCondition(variable=rejection,
+                                          value=str(0.5 + c * 0.1),
+                                          operator="LESSTHAN"))
+        conditions.append(CreditCondition(variable=performance,
+                                          value=str(250 + c * 50),
+                                          operator="LESSTHAN",
+                                          amount=0.1))
+    return conditions
+
+
+def legacy_get_variables(taskdata, variable_name):
+    '''the variables of a trial, one scan of the trials for each condition'''
+    summary_funcs = {"avg": numpy.mean,
+                     "mean": numpy.mean,
+                     "average": numpy.mean,
+                     "med": numpy.median,
+                     "median": numpy.median,
+                     "sum": numpy.sum,
+                     "total": numpy.sum,
+                     "max": numpy.max,
+                     "min": numpy.min}
+    variables = [trial["trialdata"][variable_name] for trial in taskdata
+                 if variable_name in trial["trialdata"].keys()]
+    if len(variables) == 0:
+        summary_func = variable_name.split("_")[0].lower()
+        if summary_func in summary_funcs.keys():
+            name = "_".join(variable_name.split("_")[1:])
+            variables = [summary_funcs[summary_func](
+                [trial["trialdata"][name] for trial in taskdata
+                 if name in trial["trialdata"].keys()])]
+    return variables
+
+
+def legacy_evaluate(taskdata, conditions, variable_id):
+    '''the loop of check_blacklist (or experiment_reward), for one variable'''
+    found = []
+    for credit_condition in conditions:
+        variables = legacy_get_variables(taskdata,
+                                         credit_condition.variable.name)
+        func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0]
+                == credit_condition.operator][0]
+        for variable in variables:
+            comparator = credit_condition.value
+            if isinstance(variable, bool):
+                comparator = bool(comparator)
+            elif isinstance(variable, float) or isinstance(variable, int):
+                variable = float(variable)
+                comparator = float(comparator)
+            if func(variable, comparator):
+                if credit_condition.variable.id == variable_id:
+                    found.append(variable)
+    return found
+
+
+def timed(func, *args):
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return time.time() - start
+
+
+print("Generating %s results with %s trials each..." % (N_RESULTS, N_TRIALS))
+taskdatas = [make_taskdata(N_TRIALS) for _ in range(N_RESULTS)]
+conditions = make_conditions()
+
+# the two tasks each ran their own loop over the conditions
+legacy_time = timed(lambda taskdata: (legacy_evaluate(taskdata, conditions, 1),
+                                      legacy_evaluate(taskdata, conditions, 2)),
+                    *taskdatas)
+new_time = timed(lambda taskdata: evaluate_credit_conditions(
+    taskdata, conditions, rejection_variable_id=1, performance_variable_id=2),
+    *taskdatas)
+
+print("%s conditions over %s trials per result" % (len(conditions), N_TRIALS))
+print("per trial loops (two tasks): %.2f ms per result" % (
+    legacy_time * 1000 / N_RESULTS))
+print("one pass evaluation: %.2f ms per result" % (
+    new_time * 1000 / N_RESULTS))
+print("speedup: %.1fx" % (legacy_time / max(new_time, 1e-9)))
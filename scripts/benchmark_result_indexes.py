@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''Benchmark for the indexes on turk Result and Assignment.
+
+Seeds a synthetic set of batteries, workers, results and assignments, and
+runs the lookups made by serving, syncing, credit, exports and the battery
+page, with the composite (and, on postgres, partial) indexes, and again
+after dropping them. The query plan and the time of each lookup are printed
+for both. Run from the application root (eg, inside the uwsgi container):
+
+    python scripts/benchmark_result_indexes.py
+
+The size of the synthetic data is set with environment variables:
+
+    BENCHMARK_BATTERIES    number of batteries (default 20)
+    BENCHMARK_EXPERIMENTS  experiments per battery (default 10)
+    BENCHMARK_WORKERS      workers per battery (default 1000)
+    BENCHMARK_REPEAT       times each lookup is run (default 20)
+
+Everything is created in a transaction that is rolled back at the end, the
+dropped indexes included.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'expdj.settings')
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from expdj.apps.experiments.models import (Battery, Experiment,
+                                           ExperimentTemplate)
+from expdj.apps.turk.models import (HIT, PARTIAL_INDEXES, Assignment, Result,
+                                    Worker)
+
+N_BATTERIES = int(os.environ.get("BENCHMARK_BATTERIES", 20))
+N_EXPERIMENTS = int(os.environ.get("BENCHMARK_EXPERIMENTS", 10))
+N_WORKERS = int(os.environ.get("BENCHMARK_WORKERS", 1000))
+N_REPEAT = int(os.environ.get("BENCHMARK_REPEAT", 20))
+
+
+def seed():
+    owner = User.objects.create(username="benchmark_result_indexes",
+                                email="benchmark@expfactory.org")
+    workers = ["bench_worker_%s" % w for w in range(N_WORKERS)]
+    Worker.objects.bulk_create([Worker(id=w) for w in workers])
+
+    batteries = []
+    for b in range(N_BATTERIES):
+        battery = Battery.objects.create(name="benchmark_indexes_%s" % b,
+                                         owner=owner,
+                                         credentials="dummy.cred",
+                                         maximum_time=120,
+                                         number_of_experiments=N_EXPERIMENTS)
+        templates = []
+        for e in range(N_EXPERIMENTS):
+            template = ExperimentTemplate.objects.create(
+                exp_id="benchmark_indexes_%s_%s" % (b, e),
+                name="Benchmark Indexes %s %s" % (b, e),
+                time=5,
+                reference="",
+                template="jspsych")
+            battery.experiments.add(
+                Experiment.objects.create(template=template))
+            templates.append(template)
+        HIT.objects.bulk_create([HIT(battery=battery, owner=owner,
+                                     mturk_id="BENCHHIT%s" % b, title="HIT",
+                                     description="HIT", reward=0.5,
+                                     assignment_duration_in_hours=1,
+                                     status=HIT.ASSIGNABLE)])
+        hit = HIT.objects.get(mturk_id="BENCHHIT%s" % b)
+        Assignment.objects.bulk_create([
+            Assignment(mturk_id="BENCH%s_%s" % (b, w), hit=hit,
+                       worker_id=worker_id,
+                       status=[Assignment.SUBMITTED, Assignment.APPROVED,
+                               None][w % 3])
+            for w, worker_id in enumerate(workers)])
+
+        # workers are spread over the experiments, most have not finished
+        results = []
+        for w, worker_id in enumerate(workers):
+            done = w % (N_EXPERIMENTS + 1)
+            for e, template in enumerate(templates[:done + 1]):
+                results.append(Result(worker_id=worker_id, battery=battery,
+                                      experiment=template,
+                                      completed=e < done))
+        Result.objects.bulk_create(results)
+        batteries.append((battery, hit, templates))
+    return workers, batteries
+
+
+def get_lookups(workers, batteries):
+    battery, hit, templates = batteries[len(batteries) // 2]
+    worker_id = workers[len(workers) // 2]
+    return [
+        ("serve: completed experiments of a worker in a battery",
+         Result.objects.filter(worker_id=worker_id, battery=battery,
+                               completed=True).values_list("experiment_id")),
+        ("credit: completed results of a worker",
+         Result.objects.filter(worker_id=worker_id, completed=True)),
+        ("export: completed results of a battery",
+         Result.objects.filter(battery=battery, completed=True).values_list(
+             "id")),
+        ("variable index: results of an experiment in a battery",
+         Result.objects.filter(battery=battery,
+                               experiment=templates[0]).values_list("id")),
+        ("manage hit: assignments of a HIT by status",
+         Assignment.objects.filter(hit=hit, status=Assignment.SUBMITTED)),
+        ("sync: assignment by mturk id",
+         Assignment.objects.filter(
+             mturk_id="BENCH0_%s" % (len(workers) - 1))),
+    ]
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    prefix = "EXPLAIN "
+    if connection.vendor == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [" ".join(str(x) for x in row) for row in cursor.fetchall()]
+
+
+def timed(queryset):
+    start = time.time()
+    for _ in range(N_REPEAT):
+        list(queryset.all())
+    return (time.time() - start) / N_REPEAT
+
+
+def report(title, lookups):
+    print("\n%s\n%s" % (title, "=" * len(title)))
+    times = []
+    for name, queryset in lookups:
+        seconds = timed(queryset)
+        times.append(seconds)
+        print("\n%s: %.2f ms" % (name, seconds * 1000))
+        for line in explain(queryset):
+            print("    %s" % line)
+    return times
+
+
+def drop_indexes():
+    with connection.schema_editor() as schema_editor:
+        for model in [Result, Assignment]:
+            for index in model._meta.indexes:
+                schema_editor.remove_index(model, index)
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            for name, _, _, _ in PARTIAL_INDEXES:
+                cursor.execute("DROP INDEX IF EXISTS %s" % name)
+
+
+with transaction.atomic():
+    print("Seeding %s batteries with %s experiments and %s workers..." % (
+        N_BATTERIES, N_EXPERIMENTS, N_WORKERS))
+    workers, batteries = seed()
+    print("%s results, %s assignments" % (Result.objects.count(),
+                                          Assignment.objects.count()))
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE turk_result")
+            cursor.execute("ANALYZE turk_assignment")
+
+    lookups = get_lookups(workers, batteries)
+    after = report("With indexes", lookups)
+    drop_indexes()
+    before = report("Without indexes", lookups)
+
+    print("\nSummary (ms without / with indexes)")
+    for (name, _), old, new in zip(lookups, before, after):
+        print("%-60s %8.2f %8.2f  %.1fx" % (name, old * 1000, new * 1000,
+                                            old / max(new, 1e-9)))
+
+    transaction.set_rollback(True)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''Benchmark for the results data frame used by battery exports.
+
+Times make_results_df of expdj.apps.experiments.utils on a synthetic battery.
+Run from the application root (eg, inside the uwsgi container):
+
+    python scripts/benchmark_results_df.py
+
+The size of the synthetic battery is set with environment variables:
+
+    BENCHMARK_RESULTS         number of completed results (default 10000)
+    BENCHMARK_TRIALS          trials per result (default 300)
+
+Database objects (user, battery, experiments) are created in a transaction
+that is rolled back at the end, results are kept in memory.
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'expdj.settings')
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from expdj.apps.experiments.models import (Battery, Experiment,
+                                           ExperimentTemplate)
+from expdj.apps.experiments.utils import make_results_df
+
+N_RESULTS = int(os.environ.get("BENCHMARK_RESULTS", 10000))
+N_TRIALS = int(os.environ.get("BENCHMARK_TRIALS", 300))
+N_EXPERIMENTS = 10
+
+
+class SyntheticResult(object):
+    '''a stand in for turk.models.Result, with the fields used for export'''
+
+    def __init__(self, worker_id, experiment, taskdata):
+        self.worker_id = worker_id
+        self.experiment = experiment
+        self.experiment_id = experiment.exp_id
+        self.taskdata = taskdata
+        self.platform = "Linux,"
+        self.browser = "Chrome,54.0.2840"
+        self.completed = True
+
+
+def make_taskdata(n_trials):
+    taskdata = []
+    for t in range(n_trials):
+        trialdata = {"trial_index": t,
+                     "trial_type": "poldrack-single-stim",
+                     "internal_node_id": "0.0-%s.0" % t,
+                     "rt": random.randint(200, 1200),
+                     "key_press": random.choice([37, 39]),
+                     "correct": random.random() > 0.2,
+                     "stimulus": "<div class='centerbox'></div>",
+                     "time_elapsed": t * 1500,
+                     "exp_id": "bench_task"}
+        taskdata.append({"current_trial": t,
+                         "dateTime": 1477000000000 + t * 1500,
+                         "trialdata": trialdata})
+    return taskdata
+
+
+def timed(func, *args):
+    start = time.time()
+    output = func(*args)
+    return output, time.time() - start
+
+
+with transaction.atomic():
+    owner = User.objects.create(username="benchmark_results_df",
+                                email="benchmark@expfactory.org")
+    battery = Battery.objects.create(name="benchmark_results_df",
+                                     owner=owner,
+                                     credentials="dummy.cred",
+                                     maximum_time=120,
+                                     number_of_experiments=N_EXPERIMENTS)
+    templates = []
+    for e in range(N_EXPERIMENTS):
+        template = ExperimentTemplate.objects.create(
+            exp_id="benchmark_task_%s" % e,
+            name="Benchmark Task %s" % e,
+            time=5,
+            reference="",
+            template="jspsych")
+        battery.experiments.add(Experiment.objects.create(template=template))
+        templates.append(template)
+
+    print("Generating %s results with %s trials each..." % (N_RESULTS,
+                                                            N_TRIALS))
+    results = [SyntheticResult("worker_%s" % (r // N_EXPERIMENTS),
+                               templates[r % N_EXPERIMENTS],
+                               make_taskdata(N_TRIALS))
+               for r in range(N_RESULTS)]
+
+    df, elapsed = timed(make_results_df, battery, results)
+    print("make_results_df: %s rows x %s columns in %.2f s" % (
+        df.shape[0], df.shape[1], elapsed))
+
+    transaction.set_rollback(True)
@@ -102,9 +102,35 @@ var ExpFactory = function(uniqueId) {
 		return taskdata.getQuestionData();
 	};
 
-	// Save data to server
-	self.saveData = function(callbacks) {
-    console.log("Saving data...");
+	// Save data to server, only the trials recorded since the last save
+	// are sent and appended to the result. Saves can overlap, so the count
+	// of synced trials only moves forward, to the end of the saved chunk.
+	// The run code that expfactory generates for a battery does not call
+	// it, and still posts the full taskdata on every update
+	var synced = 0;
+	self.saveData = function(djstatus, callbacks) {
+		var data = taskdata.getTrialData(),
+		    start = synced,
+		    trials = data.slice(start);
+		callbacks = callbacks || {};
+		console.log("Saving data...");
+		$.ajax({
+			type: "POST",
+			url: "/sync/" + uniqueId + "/",
+			contentType: "application/json",
+			headers: {"X-CSRFToken": (document.cookie.match(/csrftoken=([^;]+)/) || [])[1]},
+			data: JSON.stringify({"trials": trials,
+			                      "start": start,
+			                      "currenttrial": taskdata.get("currenttrial"),
+			                      "djstatus": djstatus || "IN_PROGRESS"}),
+			success: function(response) {
+				synced = Math.max(synced, start + trials.length);
+				if (callbacks.success) { callbacks.success(response); }
+			},
+			error: function(response) {
+				if (callbacks.error) { callbacks.error(response); }
+			}
+		});
 	};
 
 	self.completeHIT = function() {